@@ -0,0 +1,123 @@
+"""Tokens per second of a model generating alone and with a draft model.
+
+Offline, a randomly initialised GPT-2 is drafted by an exact copy of itself
+(every proposal accepted, but the draft costs as much as the model) and by a
+small unrelated model (hardly any accepted: the overhead). The speedup needs
+a small draft that agrees with its model, i.e. real checkpoints sharing a
+tokenizer:
+
+    python -m benchmarks.bench_assisted
+    python -m benchmarks.bench_assisted --model gpt2-large --draft distilgpt2
+"""
+
+import argparse
+import copy
+import time
+
+import tokenizers
+import torch
+import transformers
+
+from herding_llamas.llama.model import LanguageModel, ResidentModel
+
+
+class BenchLlama(LanguageModel):
+    def __init__(self, models):
+        self.conf = {
+            "startup_model": "main",
+            "models": {key: {} for key in models},
+            "model_pool": {"max_models": len(models)},
+            "prefix_cache": {"max_memory_gb": 0},
+            "batching": {"window_seconds": 0},
+        }
+        self.prepared = models  # model_key -> (model, tokenizer)
+        LanguageModel.__init__(self)
+
+    def load(self, model_key):
+        resident = ResidentModel(model_key, self.conf)
+        resident.model, resident.tokenizer = self.prepared[model_key]
+        return resident
+
+
+def random_models():
+    vocab = {c: i for i, c in enumerate(["<unk>"] + list("abcdefghij :"))}
+    tokenizer = tokenizers.Tokenizer(
+        tokenizers.models.WordLevel(vocab, unk_token="<unk>")
+    )
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Split("", "isolated")
+    tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token="<unk>", eos_token="<unk>"
+    )
+
+    def gpt2(n_layer, n_embd):
+        torch.manual_seed(n_layer)
+        return transformers.GPT2LMHeadModel(
+            transformers.GPT2Config(
+                vocab_size=len(vocab),
+                n_layer=n_layer,
+                n_head=8,
+                n_embd=n_embd,
+                bos_token_id=0,
+                eos_token_id=-1,  # never stop early
+                initializer_range=1.0,
+            )
+        ).eval()
+
+    main = gpt2(12, 512)
+    return {
+        "main": (main, tokenizer),
+        "copy": (copy.deepcopy(main), tokenizer),
+        "small": (gpt2(2, 64), tokenizer),
+    }
+
+
+def pretrained_models(model_path, draft_path):
+    tokenizer = transformers.AutoTokenizer.from_pretrained(model_path)
+    return {
+        "main": (
+            transformers.AutoModelForCausalLM.from_pretrained(model_path).eval(),
+            tokenizer,
+        ),
+        "draft": (
+            transformers.AutoModelForCausalLM.from_pretrained(draft_path).eval(),
+            tokenizer,
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="main model path, random GPT-2 if omitted")
+    parser.add_argument("--draft", help="draft model path with the same tokenizer")
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.model:
+        models = pretrained_models(args.model, args.draft)
+        prompt = "The history of the llama begins"
+    else:
+        models = random_models()
+        prompt = "abc: defghij abc: hij"
+    llama = BenchLlama(models)
+    for draft_key in [None] + [key for key in models if key != "main"]:
+        llama.conf["models"]["main"]["draft_model"] = draft_key
+        llama.models.clear()
+        llama.resident("main")
+        request = {
+            "infer_input": prompt,
+            "param": {"max_new_tokens": args.max_new_tokens, "stop_words": []},
+        }
+        llama.infer_one(dict(request))  # warm up
+        _start = time.time()
+        responses = [llama.infer_one(dict(request)) for _ in range(args.repeat)]
+        _seconds = time.time() - _start
+        _tokens = sum(r["output_tokens"] - r["input_tokens"] for r in responses)
+        print(
+            f"draft {draft_key or '-':>6}: {_tokens / _seconds:8.1f} tokens/s, "
+            f"acceptance {responses[-1].get('draft_acceptance_rate', '-')}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Micro-benchmark of stop-word matching per generated token.
+
+Compares the former per-sequence Python loop (first row only) with the
+compiled StopWords matcher (all rows at once).
+
+    python -m benchmarks.bench_stop_words
+"""
+
+import timeit
+
+import torch
+
+from herding_llamas.llama.model import StopWords
+
+
+def loop_matches(stops, input_ids):
+    # Former StoppingCriteriaSub.__call__
+    for stop in stops:
+        if torch.all((stop == input_ids[0][-len(stop) :])).item():
+            return True
+    return False
+
+
+def main(steps=2000):
+    torch.manual_seed(0)
+    print(f"{'stop seqs':>9} {'batch':>5} {'loop us':>9} {'compiled us':>11}")
+    for num_stops in [4, 16, 64]:
+        stops = [torch.randint(100, 32000, (n % 5 + 1,)) for n in range(num_stops)]
+        stop_words = StopWords(stops, "cpu")
+        for batch_size in [1, 8]:
+            input_ids = torch.randint(100, 32000, (batch_size, 512))
+            _loop = timeit.timeit(lambda: loop_matches(stops, input_ids), number=steps)
+            _compiled = timeit.timeit(
+                lambda: stop_words.matches(input_ids), number=steps
+            )
+            print(
+                f"{num_stops:>9} {batch_size:>5} "
+                f"{_loop / steps * 1e6:>9.1f} {_compiled / steps * 1e6:>11.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""Replays a JSONL request file against a herder and reports latency.
+
+By default a herder is started in a scratch directory with `--nodes` stub
+llama nodes (benchmarks/stub_node.py) as its only nodes, so changes to the
+task queue and routing can be compared without GPUs:
+
+    python -m benchmarks.load_test requests.jsonl --rate 5 --requests 200 \
+        --nodes 2 --save benchmarks/results/baseline.json
+    python -m benchmarks.load_test requests.jsonl --rate 5 --requests 200 \
+        --nodes 2 --baseline benchmarks/results/baseline.json
+
+`--rate` sends requests at Poisson arrival times (open loop), `--concurrency`
+keeps that many in flight (closed loop). A line is sent as is if it has a
+`prompt_key` and `raw_inputs`; otherwise its `text`, `prompt`, `body` or
+`title` becomes the text of `--prompt-key`. A `token` field sends the line as
+another user. `--herder-url` targets a running herder instead.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import yaml
+
+HERDER_DIR = Path(__file__).resolve().parents[1] / "herding_llamas" / "herder"
+TEXT_FIELDS = ["text", "prompt", "body", "title"]
+
+
+def read_requests(path, prompt_key):
+    requests = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            _line = json.loads(line)
+            if "prompt_key" in _line and "raw_inputs" in _line:
+                requests.append(_line)
+                continue
+            _text = next((_line[key] for key in TEXT_FIELDS if key in _line), None)
+            if _text is None:
+                raise ValueError(f"No prompt_key/raw_inputs or text in line: {line}")
+            _request = {"prompt_key": prompt_key, "raw_inputs": {"text": _text}}
+            if "token" in _line:
+                _request["token"] = _line["token"]
+            requests.append(_request)
+    return requests
+
+
+def percentile(values, q):
+    """Linearly interpolated percentile, q in 0..100."""
+    if not values:
+        return None
+    values = sorted(values)
+    _rank = (len(values) - 1) * q / 100
+    _low = int(_rank)
+    _high = min(_low + 1, len(values) - 1)
+    return values[_low] + (values[_high] - values[_low]) * (_rank - _low)
+
+
+def distribution(values):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": sum(values) / len(values) if values else None,
+    }
+
+
+def summarize(results, seconds):
+    """results: one dict per request with status, latency, cache hit and the
+    herder's queue and node seconds (None without a node call)."""
+    _ok = [r for r in results if r["status"] == 200]
+    _errors = {}
+    for r in results:
+        if r["status"] != 200:
+            _errors[str(r["status"])] = _errors.get(str(r["status"]), 0) + 1
+    return {
+        "requests": len(results),
+        "ok": len(_ok),
+        "cache_hits": sum(1 for r in _ok if r["cache_hit"]),
+        "errors": _errors,
+        "seconds": seconds,
+        "throughput": len(_ok) / seconds if seconds else None,
+        "latency": distribution([r["latency"] for r in _ok]),
+        "queue_wait": distribution([r["queue"] for r in _ok if r["queue"] is not None]),
+        "node": distribution([r["node"] for r in _ok if r["node"] is not None]),
+    }
+
+
+def compare(summary, baseline):
+    """Lines of current vs baseline figures; lower is better except throughput."""
+    _lines = []
+    _metrics = [("throughput", None)] + [
+        (group, key)
+        for group in ["latency", "queue_wait", "node"]
+        for key in ["p50", "p95", "p99"]
+    ]
+    for group, key in _metrics:
+        _now = summary[group] if key is None else summary[group][key]
+        _then = baseline[group] if key is None else baseline[group][key]
+        _name = group if key is None else f"{group} {key}"
+        if _now is None or not _then:
+            _lines.append(f"{_name:>16}: {_then} -> {_now}")
+            continue
+        _lines.append(
+            f"{_name:>16}: {_then:8.3f} -> {_now:8.3f} ({(_now - _then) / _then:+.1%})"
+        )
+    return _lines
+
+
+def print_summary(summary):
+    print(
+        f"{summary['ok']}/{summary['requests']} ok ({summary['cache_hits']} cached) "
+        f"in {summary['seconds']:.1f}s, {summary['throughput'] or 0:.2f} requests/s, "
+        f"errors: {summary['errors'] or '-'}"
+    )
+    print(f"{'seconds':>10} {'p50':>8} {'p95':>8} {'p99':>8} {'mean':>8}")
+    for group in ["latency", "queue_wait", "node"]:
+        _values = [summary[group][key] for key in ["p50", "p95", "p99", "mean"]]
+        print(
+            f"{group:>10} "
+            + " ".join("       -" if v is None else f"{v:8.3f}" for v in _values)
+        )
+
+
+async def send(client, request, token):
+    _body = {key: value for key, value in request.items() if key != "token"}
+    _start = time.monotonic()
+    try:
+        response = await client.post(
+            "/api/v1/infer",
+            json=_body,
+            headers={"Authorization": f"Bearer {request.get('token', token)}"},
+        )
+        status = response.status_code
+        _json = response.json() if status == 200 else {}
+    except httpx.HTTPError as e:
+        print(f"WARNING: {e!r}")
+        status, _json = type(e).__name__, {}
+    timings = _json.get("timings", {})
+    return {
+        "status": status,
+        "cache_hit": _json.get("cache_hit", False),
+        "latency": time.monotonic() - _start,
+        "queue": timings.get("queue"),
+        "node": timings.get("node"),
+    }
+
+
+async def run_load(herder_url, token, requests, rate=None, concurrency=1, seed=0):
+    """Sends the requests in order; returns (results, seconds)."""
+    rng = random.Random(seed)
+    async with httpx.AsyncClient(
+        base_url=herder_url, timeout=None, limits=httpx.Limits(max_connections=None)
+    ) as client:
+        _start = time.monotonic()
+        if rate:
+            _tasks = []
+            _at = 0.0
+            for request in requests:
+                await asyncio.sleep(max(0.0, _start + _at - time.monotonic()))
+                _tasks.append(asyncio.create_task(send(client, request, token)))
+                _at += rng.expovariate(rate)
+            results = await asyncio.gather(*_tasks)
+        else:
+            _pending = iter(requests)
+            results = []
+
+            async def user():
+                for request in _pending:
+                    results.append(await send(client, request, token))
+
+            await asyncio.gather(*[user() for _ in range(concurrency)])
+        return results, time.monotonic() - _start
+
+
+def prepare_herder_dir(node_ports, node_concurrency):
+    """Scratch directory with the herder's files, the stub nodes as its only
+    llamas and every role allowed on them."""
+    workdir = Path(tempfile.mkdtemp(prefix="herder_load_test_"))
+    for path in HERDER_DIR.iterdir():
+        if path.name not in ["llamas.yml", "roles.yml", "herder.sqlite"]:
+            (workdir / path.name).symlink_to(path)
+    _llamas = {
+        f"stub_{i + 1}": {
+            "node_type": "herding_llamas",
+            "host": "127.0.0.1",
+            "port": port,
+            "base_url": f"http://127.0.0.1:{port}",
+            "API_KEY_NAME": "HERDING_LLAMAS_SECRET",
+            "max_concurrency": node_concurrency,
+        }
+        for i, port in enumerate(node_ports)
+    }
+    with open(HERDER_DIR / "roles.yml") as f:
+        _roles = yaml.safe_load(f)
+    for role in _roles.values():
+        role["allow_nodes"] = list(_llamas)
+    with open(workdir / "llamas.yml", "w") as f:
+        yaml.safe_dump(_llamas, f)
+    with open(workdir / "roles.yml", "w") as f:
+        yaml.safe_dump(_roles, f)
+    return workdir
+
+
+async def wait_until(url, headers=None, attempts=100):
+    async with httpx.AsyncClient(timeout=5) as client:
+        for _ in range(attempts):
+            try:
+                if (await client.get(url, headers=headers)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def start_stack(args):
+    """Starts stub nodes and a herder; returns (herder_url, processes, workdir)."""
+    _env = {**os.environ}
+    _env.setdefault("HERDING_LLAMAS_SECRET", "load-test")
+    _node_ports = [args.port + 1 + i for i in range(args.nodes)]
+    processes = []
+    for i, port in enumerate(_node_ports):
+        _command = [sys.executable, "-m", "benchmarks.stub_node", "--port", str(port)]
+        _command += ["--slots", str(args.slots), "--first-token", args.first_token]
+        _command += ["--tokens-per-second", args.tokens_per_second]
+        _command += [
+            "--output-tokens",
+            args.output_tokens,
+            "--seed",
+            str(args.seed + i),
+        ]
+        processes.append(
+            subprocess.Popen(_command, cwd=HERDER_DIR.parents[1], env=_env)
+        )
+    workdir = prepare_herder_dir(_node_ports, args.node_concurrency)
+    _log = open(workdir / "herder.log", "w")
+    processes.append(
+        subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(args.port)],
+            cwd=workdir,
+            env=_env,
+            stdout=_log,
+            stderr=subprocess.STDOUT,
+        )
+    )
+    print(f"INFO: herder on port {args.port}, log in {workdir / 'herder.log'}")
+    return f"http://127.0.0.1:{args.port}", processes, workdir
+
+
+async def prepare(herder_url, token, node_ports):
+    for port in node_ports:
+        await wait_until(f"http://127.0.0.1:{port}/api/v1/models")
+    _headers = {"Authorization": f"Bearer {token}"}
+    await wait_until(f"{herder_url}/api/v1/llamas", _headers)
+    async with httpx.AsyncClient(base_url=herder_url, timeout=30) as client:
+        (await client.get("/api/v1/start_workers", headers=_headers)).raise_for_status()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("requests_file", help="JSONL, one request per line")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--rate", type=float, help="requests per second (open loop)")
+    load.add_argument(
+        "--concurrency", type=int, default=1, help="requests in flight (closed loop)"
+    )
+    parser.add_argument("--requests", type=int, help="default: one pass of the file")
+    parser.add_argument("--prompt-key", default="llama_2_plain_vanilla")
+    parser.add_argument("--token", default="admin_token")
+    parser.add_argument("--herder-url", help="use a running herder and its nodes")
+    parser.add_argument("--port", type=int, default=8190, help="herder, nodes above")
+    parser.add_argument("--nodes", type=int, default=2)
+    parser.add_argument("--node-concurrency", type=int, default=4, help="llamas.yml")
+    parser.add_argument("--slots", type=int, default=4, help="stub node generations")
+    parser.add_argument("--first-token", default="lognormal:0.2,0.5")
+    parser.add_argument("--tokens-per-second", default="normal:30,5")
+    parser.add_argument("--output-tokens", default="uniform:20,200")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with a saved JSON file")
+    args = parser.parse_args()
+
+    _requests = read_requests(args.requests_file, args.prompt_key)
+    _count = args.requests or len(_requests)
+    _requests = [_requests[i % len(_requests)] for i in range(_count)]
+
+    processes, workdir, results = [], None, []
+    try:
+        if args.herder_url:
+            herder_url = args.herder_url
+            asyncio.run(prepare(herder_url, args.token, []))
+        else:
+            herder_url, processes, workdir = start_stack(args)
+            _node_ports = [args.port + 1 + i for i in range(args.nodes)]
+            asyncio.run(prepare(herder_url, args.token, _node_ports))
+        results, seconds = asyncio.run(
+            run_load(
+                herder_url,
+                args.token,
+                _requests,
+                args.rate,
+                args.concurrency,
+                args.seed,
+            )
+        )
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if workdir is not None:
+            if results and all(r["status"] == 200 for r in results):
+                shutil.rmtree(workdir, ignore_errors=True)
+            else:
+                print(f"INFO: herder log kept in {workdir / 'herder.log'}")
+
+    summary = summarize(results, seconds)
+    print_summary(summary)
+    if args.baseline:
+        with open(args.baseline) as f:
+            _baseline = json.load(f)
+        print(f"compared with {args.baseline} ({_baseline['created']}):")
+        print("\n".join(compare(summary, _baseline["summary"])))
+    if args.save:
+        Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "config": {k: v for k, v in vars(args).items() if k != "token"},
+                    "summary": summary,
+                },
+                f,
+                indent=2,
+            )
+        print(f"saved {args.save}")
+
+
+if __name__ == "__main__":
+    main()
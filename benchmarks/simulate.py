@@ -0,0 +1,266 @@
+"""Discrete-event simulation of the herder's TaskQueue and Workers.
+
+Runs the real queue and worker code on an event loop whose clock jumps to the
+next timer instead of sleeping, so an hour of traffic takes seconds. Nodes
+replay the durations and token counts of requests recorded in herder.sqlite
+(sampled per prompt), arrivals are Poisson at `--rate` requests per minute:
+
+    python -m benchmarks.simulate --rate 40 --prompt-key llama_2_entity_recognition \
+        --nodes 1,2,3 --policies first_free,least_loaded --minutes 60
+
+For each routing policy and node count it reports slot utilisation, queue
+length, queue wait and end-to-end latency. A node runs `--node-concurrency`
+requests at once, each as long as recorded: batching is assumed not to slow
+requests down. `--node-key` models all nodes on one recorded node, otherwise
+the recorded nodes take turns.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import selectors
+import types
+from pathlib import Path
+
+from benchmarks.load_test import distribution, percentile
+from herding_llamas.herder import llm_queue
+from herding_llamas.herder.database import Database
+from herding_llamas.herder.llm_queue import TaskQueue, Worker
+
+HERDER_DIR = Path(__file__).resolve().parents[1] / "herding_llamas" / "herder"
+
+
+class VirtualSelector(selectors.SelectSelector):
+    """Never waits: advances the loop's clock by the timeout instead."""
+
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError("Simulation stalled: nothing left to wait for")
+        self.loop.now += timeout
+        return []
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.now = 0.0
+        super().__init__(VirtualSelector(self))
+
+    def time(self):
+        return self.now
+
+
+def run_virtual(coro):
+    """Runs `coro` on a virtual clock, which llm_queue reads as time.monotonic."""
+    loop = VirtualClockLoop()
+    _time = llm_queue.time
+    llm_queue.time = types.SimpleNamespace(monotonic=loop.time)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        llm_queue.time = _time
+        loop.close()
+
+
+class NodeModel:
+    """Service times of one recorded node, sampled from its own requests of the
+    same prompt (any of its requests if it never served the prompt)."""
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.by_prompt = {}
+        for call in calls:
+            self.by_prompt.setdefault(call["prompt_key"], []).append(call)
+
+    def sample(self, prompt_key, draw):
+        """draw in [0, 1) picks the recorded call."""
+        _calls = self.by_prompt.get(prompt_key) or self.calls
+        return _calls[int(draw * len(_calls))]
+
+
+def node_models(calls, node_key=None):
+    _by_node = {}
+    for call in calls:
+        if node_key is None or call["node_key"] == node_key:
+            _by_node.setdefault(call["node_key"], []).append(call)
+    if not _by_node:
+        raise ValueError(f"No recorded node calls for node '{node_key}'")
+    return [NodeModel(_by_node[key]) for key in sorted(_by_node)]
+
+
+async def simulate(
+    models,
+    workload,
+    nodes,
+    policy="first_free",
+    rate_per_minute=10,
+    minutes=60,
+    node_concurrency=1,
+    timeout=None,
+    seed=0,
+    sample_seconds=1.0,
+):
+    """Poisson arrivals drawn from `workload` (recorded calls giving prompt and
+    user) for `minutes`, served by `nodes` workers; runs until drained. Every
+    policy and node count sees the same arrivals and service time draws."""
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    task_queue = TaskQueue()
+    _skills = sorted({call["prompt_key"] for call in workload})
+    _nodes = {f"node_{i + 1}": models[i % len(models)] for i in range(nodes)}
+    workers = [
+        Worker(node_id, task_queue, _skills, node_concurrency) for node_id in _nodes
+    ]
+    _worker_tasks = [asyncio.create_task(worker.start()) for worker in workers]
+    outcome = {"latency": [], "queue_wait": [], "rejected": 0, "timed_out": 0}
+    queue_lengths = []
+
+    async def call_node(node_id, call, enqueued_at, draw):
+        outcome["queue_wait"].append(loop.time() - enqueued_at)
+        _served = _nodes[node_id].sample(call["prompt_key"], draw)
+        await asyncio.sleep(_served["elapsed_seconds"])
+        task_queue.record_tokens(
+            node_id,
+            _served["output_tokens"] or 0,
+            _served["elapsed_seconds"],
+            skill=call["prompt_key"],
+        )
+        return node_id, _served
+
+    async def request(call, draw):
+        _start = loop.time()
+        if timeout is not None:
+            if not task_queue.admit(call["prompt_key"], timeout=timeout)["admitted"]:
+                outcome["rejected"] += 1
+                return
+        task_id = await task_queue.enqueue_task(
+            lambda node_id: call_node(node_id, call, _start, draw),
+            call["prompt_key"],
+            flow=call["user_key"],
+            deadline=None if timeout is None else _start + timeout,
+            routing=policy,
+        )
+        try:
+            await asyncio.wait_for(task_queue.result_events[task_id].wait(), timeout)
+            task_queue.results.pop(task_id)
+            outcome["latency"].append(loop.time() - _start)
+        except asyncio.TimeoutError:
+            outcome["timed_out"] += 1
+        finally:
+            task_queue.cancel_task(task_id)
+
+    async def sample_queue():
+        while True:
+            queue_lengths.append(task_queue.qsize())
+            await asyncio.sleep(sample_seconds)
+
+    _sampler = asyncio.create_task(sample_queue())
+    _requests = []
+    _at = rng.expovariate(rate_per_minute / 60)
+    while _at < minutes * 60:
+        await asyncio.sleep(_at - loop.time())
+        _call = rng.choice(workload)
+        _requests.append(asyncio.create_task(request(_call, rng.random())))
+        _at += rng.expovariate(rate_per_minute / 60)
+    await asyncio.gather(*_requests)
+    _seconds = loop.time()
+    for task in _worker_tasks + [_sampler]:
+        task.cancel()
+    await asyncio.gather(*_worker_tasks, _sampler, return_exceptions=True)
+
+    _busy = sum(slot["busy_seconds"] for w in workers for slot in w.slot_stats)
+    return {
+        "policy": policy,
+        "nodes": nodes,
+        "requests": len(_requests),
+        "completed": len(outcome["latency"]),
+        "rejected": outcome["rejected"],
+        "timed_out": outcome["timed_out"],
+        "seconds": _seconds,
+        "utilization": _busy / (nodes * node_concurrency * _seconds),
+        "queue_length": {
+            "mean": sum(queue_lengths) / len(queue_lengths),
+            "p95": percentile(queue_lengths, 95),
+            "max": max(queue_lengths),
+        },
+        "queue_wait": distribution(outcome["queue_wait"]),
+        "latency": distribution(outcome["latency"]),
+    }
+
+
+def print_results(results):
+    print(
+        f"{'policy':>12} {'nodes':>5} {'done':>6} {'lost':>5} {'util':>6} "
+        f"{'queue':>6} {'max':>4} {'wait95':>7} {'p50':>7} {'p95':>7} {'p99':>7}"
+    )
+    for r in results:
+        _latency = [r["latency"][key] for key in ["p50", "p95", "p99"]]
+        print(
+            f"{r['policy']:>12} {r['nodes']:>5} {r['completed']:>6} "
+            f"{r['rejected'] + r['timed_out']:>5} {r['utilization']:>6.1%} "
+            f"{r['queue_length']['mean']:>6.1f} {r['queue_length']['max']:>4} "
+            f"{r['queue_wait']['p95'] or 0:>7.1f} "
+            + " ".join("      -" if v is None else f"{v:>7.1f}" for v in _latency)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--db", default=str(HERDER_DIR / "herder.sqlite"), help="recorded herder.sqlite"
+    )
+    parser.add_argument("--rate", type=float, default=10, help="requests per minute")
+    parser.add_argument("--minutes", type=float, default=60)
+    parser.add_argument("--prompt-key", help="only this prompt, default: recorded mix")
+    parser.add_argument("--node-key", help="model every node on this recorded node")
+    parser.add_argument("--nodes", default="1,2,4", help="node counts to compare")
+    parser.add_argument("--policies", default=",".join(TaskQueue.ROUTING_POLICIES))
+    parser.add_argument("--node-concurrency", type=int, default=1)
+    parser.add_argument("--timeout", type=float, help="admission and deadline, s")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    if not Path(args.db).exists():
+        parser.error(f"{args.db} not found")
+    calls = Database(f"sqlite:///{args.db}").list_node_calls()
+    models = node_models(calls, args.node_key)
+    workload = [c for c in calls if args.prompt_key in (None, c["prompt_key"])]
+    if not workload:
+        parser.error(f"No recorded requests for prompt '{args.prompt_key}'")
+    print(
+        f"INFO: {len(calls)} recorded node calls, {len(models)} node model(s), "
+        f"{len(workload)} requests in the workload"
+    )
+
+    results = [
+        run_virtual(
+            simulate(
+                models,
+                workload,
+                nodes,
+                policy,
+                args.rate,
+                args.minutes,
+                args.node_concurrency,
+                args.timeout,
+                args.seed,
+            )
+        )
+        for policy in args.policies.split(",")
+        for nodes in [int(n) for n in args.nodes.split(",")]
+    ]
+    print_results(results)
+    if args.save:
+        Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+        print(f"saved {args.save}")
+
+
+if __name__ == "__main__":
+    main()
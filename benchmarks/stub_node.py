@@ -0,0 +1,129 @@
+"""Stand-in for a llama node without a model or GPU, for load tests.
+
+Serves /api/v1/models and /api/v1/infer like a herding_llamas node. Each
+inference waits for one of `--slots` generation slots, then sleeps for a time
+to first token plus its output tokens at a tokens/s rate, each drawn from a
+distribution (see parse_distribution):
+
+    python -m benchmarks.stub_node --port 8081 --first-token lognormal:0.2,0.5 \
+        --tokens-per-second normal:30,5 --output-tokens uniform:20,200
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from fastapi import FastAPI
+
+DEFAULT_MODEL = "TheBloke/Llama-2-13B-chat-GPTQ"
+
+
+def parse_distribution(spec):
+    """A sampler taking a random.Random from "<value>", "uniform:low,high",
+    "normal:mean,sd", "lognormal:median,sigma" or "exp:mean". Samples are
+    never negative."""
+    kind, _, args = str(spec).partition(":")
+    if not args:
+        value = float(kind)
+        return lambda rng: value
+    params = [float(arg) for arg in args.split(",")]
+    samplers = {
+        "uniform": lambda rng, low, high: rng.uniform(low, high),
+        "normal": lambda rng, mean, sd: rng.gauss(mean, sd),
+        "lognormal": lambda rng, median, sigma: median * rng.lognormvariate(0, sigma),
+        "exp": lambda rng, mean: rng.expovariate(1 / mean),
+    }
+    if kind not in samplers:
+        raise ValueError(f"Unknown distribution '{kind}' in '{spec}'")
+    return lambda rng: max(0.0, samplers[kind](rng, *params))
+
+
+def create_app(
+    model=DEFAULT_MODEL,
+    slots=4,
+    first_token="lognormal:0.2,0.5",
+    tokens_per_second="normal:30,5",
+    output_tokens="uniform:20,200",
+    seed=None,
+):
+    app = FastAPI()
+    rng = random.Random(seed)
+    sample_first_token = parse_distribution(first_token)
+    sample_rate = parse_distribution(tokens_per_second)
+    sample_tokens = parse_distribution(output_tokens)
+    state = {"queued": 0, "running": 0, "slots": None}
+
+    @app.get("/api/v1/models")
+    async def api_models():
+        return {
+            "models": [{"option": model, "selected": True}],
+            "loaded_model": model,
+            "system_stats": {},
+            "queue": {"queued": state["queued"], "running": state["running"]},
+        }
+
+    @app.post("/api/v1/infer")
+    async def api_infer(data: dict):
+        if state["slots"] is None:  # bound to the server's event loop
+            state["slots"] = asyncio.Semaphore(slots)
+        _start = time.time()
+        input_tokens = len(data.get("infer_input", "").split())
+        new_tokens = int(sample_tokens(rng))
+        max_new_tokens = data.get("param", {}).get("max_new_tokens")
+        if max_new_tokens is not None:
+            new_tokens = min(new_tokens, max_new_tokens)
+        time_to_first_token = sample_first_token(rng)
+        generate_seconds = time_to_first_token + new_tokens / max(sample_rate(rng), 0.1)
+
+        state["queued"] += 1
+        async with state["slots"]:
+            state["queued"] -= 1
+            state["running"] += 1
+            _wait = time.time() - _start
+            try:
+                await asyncio.sleep(generate_seconds)
+            finally:
+                state["running"] -= 1
+        return {
+            "response": " ".join(["llama"] * new_tokens),
+            "input_tokens": input_tokens,
+            "output_tokens": input_tokens + new_tokens,  # like the real node
+            "elapsed_seconds": round(time.time() - _start, 4),
+            "time_to_first_token": round(_wait + time_to_first_token, 4),
+            "model_name": model,
+            "timings": {
+                "batch_wait": round(_wait, 4),
+                "generate": round(generate_seconds, 4),
+            },
+        }
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--slots", type=int, default=4, help="parallel generations")
+    parser.add_argument("--first-token", default="lognormal:0.2,0.5")
+    parser.add_argument("--tokens-per-second", default="normal:30,5")
+    parser.add_argument("--output-tokens", default="uniform:20,200")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    app = create_app(
+        args.model,
+        args.slots,
+        args.first_token,
+        args.tokens_per_second,
+        args.output_tokens,
+        args.seed,
+    )
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
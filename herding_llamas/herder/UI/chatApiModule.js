@@ -38,6 +38,18 @@ export default class ChatAPI {
         return await response.json();
     }
 
+    async fetchTelemetry(minutes = 60, points = 60) {
+        let token = this.get_or_set_token();
+        const response = await fetch(this.apiURL + `/telemetry?minutes=${minutes}&points=${points}`, {
+            method: 'GET',
+            headers: {
+                'Content-Type': 'application/json',
+                'Authorization': `Bearer ${token}`,
+            }
+        });
+        return await response.json();
+    }
+
     async switchModel(model_key, node_key) {
         let token = this.get_or_set_token();
         const response = await fetch(this.apiURL + "/switch_model", {
@@ -114,6 +126,45 @@ export default class ChatAPI {
         return responseBody;
     }
 
+    async postMessageStream(messageData, prompt_key, onToken) {
+        let token = this.get_or_set_token();
+        const response = await fetch(this.apiURL + '/infer', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Authorization': `Bearer ${token}`,
+            },
+            body: JSON.stringify({
+                raw_inputs: messageData,
+                prompt_key: prompt_key,
+                stream: true
+            })
+        });
+        if (!response.ok) {
+            const responseBody = await response.json();
+            throw new Error(responseBody.detail);
+        }
+        // Newline-delimited JSON: {"token": ...} chunks, then {"done": true, ...}
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (!line) continue;
+                const chunk = JSON.parse(line);
+                if (chunk.error) throw new Error(chunk.error);
+                if (chunk.done) return chunk;
+                onToken(chunk.token);
+            }
+        }
+        throw new Error('Stream ended before the response was complete');
+    }
+
     async submitScore(inference_id, score) {
         let token = this.get_or_set_token();
         const response = await fetch(this.apiURL + '/score', {
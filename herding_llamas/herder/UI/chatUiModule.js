@@ -8,6 +8,7 @@ export default class ChatUI {
         this.setupTabs();
         this.nodesDropdown = document.getElementById('nodes-dropdown');
         this.modelCardContainer = document.getElementById('model-card-container');
+        this.fleetTimeline = document.getElementById('fleet-timeline');
         this.promptSelect = document.getElementById('promptSelect');
         this.historyContainer = document.getElementById('historyContainer');
         this.promptsContainer = document.getElementById('promptsContainer');
@@ -28,6 +29,53 @@ export default class ChatUI {
         })
         const nodes = await this.chatAPI.fetchNodes();
         this.populateModelCards(nodes);
+        this.populateTimeline();
+    }
+
+    async populateTimeline() {
+        // Last hour of the whole fleet, from the herder's node snapshot
+        const timeline = await this.chatAPI.fetchTelemetry();
+        const charts = [
+            ['tokens_per_second', 'Tokens/s'],
+            ['running', 'Running on nodes'],
+            ['queued', 'Waiting on nodes'],
+            ['gpu_memory_used', 'GPU memory (GB)'],
+            ['cpu_utilization', 'CPU (%)'],
+        ];
+        this.fleetTimeline.innerHTML = '';
+        charts.forEach(([field, label]) => {
+            const values = (timeline.fleet || {})[field];
+            if (!values) return;
+            const row = document.createElement('div');
+            row.className = 'row fleet-row';
+            const known = values.filter(value => value !== null);
+            const last = known.length ? known[known.length - 1].toFixed(1) : '-';
+            row.innerHTML = `<div class="col-3">${label}</div>`
+                + `<div class="col-7">${this.sparkline(values)}</div>`
+                + `<div class="col-2"><b>${last}</b></div>`;
+            this.fleetTimeline.appendChild(row);
+        });
+    }
+
+    sparkline(values, width = 300, height = 30) {
+        // Inline SVG polyline, gaps where no node reported
+        const max = Math.max(1e-9, ...values.filter(value => value !== null));
+        const step = width / Math.max(1, values.length - 1);
+        let segments = [];
+        let points = [];
+        values.forEach((value, i) => {
+            if (value === null) {
+                points.length && segments.push(points);
+                points = [];
+                return;
+            }
+            points.push(`${(i * step).toFixed(1)},${(height - (value / max) * height).toFixed(1)}`);
+        });
+        points.length && segments.push(points);
+        const lines = segments.map(segment =>
+            `<polyline fill="none" stroke="#dc3545" stroke-width="1.5" points="${segment.join(' ')}"/>`
+        ).join('');
+        return `<svg width="${width}" height="${height}" title="max ${max.toFixed(1)}">${lines}</svg>`;
     }
 
     async populateModelCards(nodes) {
@@ -103,11 +151,19 @@ export default class ChatUI {
             nodeName: nodeId,
             models: node.models.map(model => ({
                 name: model.option,
-                selected: model.selected ? 'selected' : ''
+                selected: model.selected ? 'selected' : '',
+                resident: model.resident,
             })),
             system_stats: node.system_stats,
             infer_stats: node.infer_stats,
             worker_started: node.worker_started,
+            worker_stats: node.worker_stats,
+            node_queue: node.node_queue,
+            // model being loaded in the background, the current one keeps serving
+            loading: node.load_status && node.load_status.status === 'loading' ? {
+                model_key: node.load_status.model_key,
+                progress_pct: node.load_status.progress == null ? null : Math.round(node.load_status.progress * 100),
+            } : null,
         };
 
         // Render the template with the data
@@ -171,6 +227,22 @@ export default class ChatUI {
     }
 
 
+    latencyBreakdown(item) {
+        // Where the time of a request went: herder stages, node stages in brackets
+        const format = (label, seconds) => seconds == null ? null : `${label} ${seconds.toFixed(2)}s`;
+        const nodeStages = [
+            format('tokenize', item.tokenize_seconds),
+            format('generate', item.generate_seconds),
+            format('decode', item.decode_seconds),
+        ].filter(Boolean).join(', ');
+        const stages = [
+            format('render', item.render_seconds),
+            format('queue', item.queue_seconds),
+            format('node', item.node_seconds) && format('node', item.node_seconds) + (nodeStages ? ` (${nodeStages})` : ''),
+        ].filter(Boolean);
+        return stages.length ? stages.join(' · ') : null;
+    }
+
     async populateHistory() {
         const data = await this.chatAPI.getHistory();
         this.historyContainer.innerHTML = '';
@@ -186,6 +258,8 @@ export default class ChatUI {
                         ...item,
                         infer_input: item.infer_input, //.replace("<", '&lt;').replace(">", '&gt;'),
                         elapsed_seconds: item.elapsed_seconds.toFixed(1),
+                        time_to_first_token: item.time_to_first_token == null ? null : item.time_to_first_token.toFixed(1),
+                        latency: this.latencyBreakdown(item),
                     })),
                 };
 
@@ -213,12 +287,23 @@ export default class ChatUI {
             this.loadingSpinner.title = "Waiting for LLM response..";
             this.loadingSpinner.style.display = 'block';
 
+            // Tokens are shown while they arrive, then replaced by the scorable message
+            const streamElement = document.createElement('p');
+            streamElement.classList = "assistantMessage";
             try {
-                const responseData = await this.chatAPI.postMessage(messageData, prompt_key);
+                const responseData = await this.chatAPI.postMessageStream(messageData, prompt_key, (token) => {
+                    if (!streamElement.isConnected) {
+                        this.loadingSpinner.style.display = 'none';
+                        this.chatWindow.prepend(streamElement);
+                    }
+                    streamElement.textContent += token;
+                });
                 this.loadingSpinner.style.display = 'none';
+                streamElement.remove();
                 this.appendAssistantMessage(responseData['text'], responseData['inference_id']);
             } catch (error) {
                 this.loadingSpinner.style.display = 'none';
+                streamElement.remove();
                 this.appendErrorMessage(error.message);
             }
         });
@@ -41,4 +41,9 @@ async def startup_event():
     await main_herder.initialize()
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await main_herder.herder.close()
+
+
 app.mount(f"/", main_herder.app)
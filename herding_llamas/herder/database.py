@@ -6,7 +6,9 @@ from sqlalchemy import (
     String,
     Text,
     DateTime,
+    Boolean,
     func,
+    inspect,
     desc,
     cast,
     text,
@@ -18,6 +20,7 @@ from sqlalchemy.orm import relationship, sessionmaker
 from datetime import datetime, timedelta, timezone
 
 
+import json
 import uuid
 
 
@@ -39,6 +42,15 @@ class Inference(Base):
     input_tokens = Column(Integer)
     output_tokens = Column(Integer)
     elapsed_seconds = Column(Float)
+    time_to_first_token = Column(Float)  # seconds until the node produced a token
+    cache_hit = Column(Boolean, default=False)  # served from the response cache
+    # Where the time went, in seconds: herder stages, then the node's own
+    render_seconds = Column(Float)  # prompt rendering
+    queue_seconds = Column(Float)  # until a node picked the request up
+    node_seconds = Column(Float)  # herder -> node call, including the node stages
+    tokenize_seconds = Column(Float)
+    generate_seconds = Column(Float)
+    decode_seconds = Column(Float)
     session_id = Column(String(255))
     score = Column(Integer)  # between 1-5
     feedback = Column(Text)
@@ -46,63 +58,94 @@ class Inference(Base):
     updated_ts = Column(DateTime, onupdate=func.now())
 
 
+class ResponseCacheEntry(Base):
+    __tablename__ = "response_cache"
+
+    cache_key = Column(String(64), primary_key=True)
+    model_name = Column(String(255))
+    response_json = Column(Text)
+    expires_ts = Column(Float)  # unix time
+    created_ts = Column(DateTime, default=func.now())
+
+
 class Database:
     def __init__(self, db_url):
         self.engine = create_engine(db_url)
         Base.metadata.create_all(self.engine)
+        self.add_missing_columns()
         self.Session = sessionmaker(bind=self.engine)
 
+    def add_missing_columns(self):
+        # create_all() does not alter existing tables: add columns introduced
+        # after a database file was created.
+        _inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            _existing = {c["name"] for c in _inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in _existing:
+                    _type = column.type.compile(dialect=self.engine.dialect)
+                    _statement = (
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {_type}"
+                    )
+                    print(f"INFO: Adding column {table.name}.{column.name}")
+                    with self.engine.begin() as connection:
+                        connection.execute(text(_statement))
+
     def get_session(self):
         return self.Session()
 
     # inference CRUD operation
     def list_inference(self):
-        session = self.Session()
-        inference = (
-            session.query(Inference)
-            .order_by(desc(Inference.created_ts))
-            .limit(50)
-            .all()
-        )
+        with self.Session() as session:
+            inference = (
+                session.query(Inference)
+                .order_by(desc(Inference.created_ts))
+                .limit(50)
+                .all()
+            )
         return inference
 
     def create_inference(self, inference_data):
-        session = self.Session()
-        inference = Inference(**inference_data)
-        session.add(inference)
-        session.commit()
-        return inference.id
+        with self.Session() as session:
+            inference = Inference(**inference_data)
+            session.add(inference)
+            session.commit()
+            return inference.id
 
     def update_inference(self, id, inference_data):
-        session = self.Session()
-        inference = session.query(Inference).filter(Inference.id == id).first()
-        if not inference:
-            raise ValueError(f"Inference with id {id} not found")
+        with self.Session() as session:
+            inference = session.query(Inference).filter(Inference.id == id).first()
+            if not inference:
+                raise ValueError(f"Inference with id {id} not found")
 
-        for key, value in inference_data.items():
-            if hasattr(inference, key):
-                setattr(inference, key, value)
+            for key, value in inference_data.items():
+                if hasattr(inference, key):
+                    setattr(inference, key, value)
 
-        session.commit()
+            session.commit()
 
     def get_user_statistics(self, user_key, hours):
-        session = self.Session()
         n_hours_ago = datetime.now(timezone.utc) - timedelta(hours=hours)
 
-        result = (
-            session.query(
-                func.count(Inference.id).label("request_count"),
-                coalesce(func.sum(Inference.input_tokens), 0).label("sum_input_tokens"),
-                coalesce(func.sum(Inference.output_tokens), 0).label(
-                    "sum_output_tokens"
-                ),
-                coalesce(func.sum(Inference.elapsed_seconds), 0).label(
-                    "sum_elapsed_seconds"
-                ),
+        with self.Session() as session:
+            result = (
+                session.query(
+                    func.count(Inference.id).label("request_count"),
+                    coalesce(func.sum(Inference.input_tokens), 0).label(
+                        "sum_input_tokens"
+                    ),
+                    coalesce(func.sum(Inference.output_tokens), 0).label(
+                        "sum_output_tokens"
+                    ),
+                    coalesce(func.sum(Inference.elapsed_seconds), 0).label(
+                        "sum_elapsed_seconds"
+                    ),
+                )
+                .filter(
+                    Inference.user_key == user_key, Inference.created_ts >= n_hours_ago
+                )
+                .first()
             )
-            .filter(Inference.user_key == user_key, Inference.created_ts >= n_hours_ago)
-            .first()
-        )
         result = result._asdict()
         result["request"] = result["request_count"]
         result["token"] = result["sum_input_tokens"] + result["sum_output_tokens"]
@@ -110,26 +153,30 @@ class Database:
         return result
 
     def get_node_statistics(self, hours=24):
-        session = self.Session()
-
         twenty_four_hours_ago = datetime.now(timezone.utc) - timedelta(hours=hours)
 
-        results = (
-            session.query(
-                Inference.node_key,
-                func.count(Inference.id).label("record_count"),
-                func.avg(Inference.input_tokens).label("average_input_tokens"),
-                func.sum(Inference.input_tokens).label("sum_input_tokens"),
-                func.avg(Inference.output_tokens).label("average_output_tokens"),
-                func.sum(Inference.output_tokens).label("sum_output_tokens"),
-                func.avg(Inference.elapsed_seconds).label("average_elapsed_seconds"),
-                func.sum(Inference.elapsed_seconds).label("sum_elapsed_seconds"),
+        with self.Session() as session:
+            results = (
+                session.query(
+                    Inference.node_key,
+                    func.count(Inference.id).label("record_count"),
+                    func.avg(Inference.input_tokens).label("average_input_tokens"),
+                    func.sum(Inference.input_tokens).label("sum_input_tokens"),
+                    func.avg(Inference.output_tokens).label("average_output_tokens"),
+                    func.sum(Inference.output_tokens).label("sum_output_tokens"),
+                    func.avg(Inference.elapsed_seconds).label(
+                        "average_elapsed_seconds"
+                    ),
+                    func.sum(Inference.elapsed_seconds).label("sum_elapsed_seconds"),
+                )
+                .filter(
+                    Inference.created_ts >= twenty_four_hours_ago,
+                    coalesce(Inference.cache_hit, False) == False,  # no node time used
+                )
+                .group_by(Inference.node_key)
+                .order_by(Inference.node_key)
+                .all()
             )
-            .filter(Inference.created_ts >= twenty_four_hours_ago)
-            .group_by(Inference.node_key)
-            .order_by(Inference.node_key)
-            .all()
-        )
 
         results = [row._asdict() for row in results]
 
@@ -156,3 +203,62 @@ class Database:
             }
 
         return data
+
+    def list_node_calls(self, node_key=None, prompt_key=None):
+        """Duration and token counts of the requests answered by a node (not
+        from the cache), e.g. to model nodes in benchmarks/simulate.py."""
+        with self.Session() as session:
+            query = session.query(
+                Inference.node_key,
+                Inference.prompt_key,
+                Inference.user_key,
+                Inference.input_tokens,
+                Inference.output_tokens,
+                Inference.elapsed_seconds,
+            ).filter(
+                Inference.elapsed_seconds > 0,
+                coalesce(Inference.cache_hit, False) == False,  # no node time used
+            )
+            if node_key is not None:
+                query = query.filter(Inference.node_key == node_key)
+            if prompt_key is not None:
+                query = query.filter(Inference.prompt_key == prompt_key)
+            return [row._asdict() for row in query.all()]
+
+    # response cache
+    def load_cached_responses(self):
+        """Drops expired entries, returns the others oldest first."""
+        with self.Session() as session:
+            session.query(ResponseCacheEntry).filter(
+                ResponseCacheEntry.expires_ts < datetime.now(timezone.utc).timestamp()
+            ).delete()
+            session.commit()
+            return [
+                {
+                    "cache_key": entry.cache_key,
+                    "value": json.loads(entry.response_json),
+                    "expires_at": entry.expires_ts,
+                }
+                for entry in session.query(ResponseCacheEntry).order_by(
+                    ResponseCacheEntry.created_ts
+                )
+            ]
+
+    def put_cached_response(self, cache_key, model_name, value, expires_at):
+        with self.Session() as session:
+            session.merge(
+                ResponseCacheEntry(
+                    cache_key=cache_key,
+                    model_name=model_name,
+                    response_json=json.dumps(value),
+                    expires_ts=expires_at,
+                )
+            )
+            session.commit()
+
+    def delete_cached_response(self, cache_key):
+        with self.Session() as session:
+            session.query(ResponseCacheEntry).filter(
+                ResponseCacheEntry.cache_key == cache_key
+            ).delete()
+            session.commit()
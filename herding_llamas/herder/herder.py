@@ -6,20 +6,60 @@ import json
 import os
 from urllib.parse import urlparse
 import asyncio
+import math
+import time
 
 from prompter import Prompter
 from database import Database
 from llm_queue import TaskQueue, Worker
+from node_clients import NodeClients
+from single_flight import SingleFlight
+from response_cache import ResponseCache
+import metrics
 
 
 class Herder:
+    LLAMAS_TTL_SECONDS = 10  # age after which the node snapshot is refreshed
+    LOAD_POLL_SECONDS = 2  # while a node loads a model
+    TELEMETRY_MINUTES = 60  # history fetched from each node with its snapshot
+    TELEMETRY_POINTS = 120
+    # fleet timeline: these series add up over nodes, the others are averaged
+    FLEET_SUM_FIELDS = [
+        "memory_used",
+        "gpu_memory_used",
+        "tokens_per_second",
+        "queued",
+        "running",
+    ]
+
     def __init__(self):  # , prompter, database, task_queue):
         self.load_users()
         self.load_roles()
+        self.load_settings()
         self.prompter = Prompter()
         self.database = Database(db_url="sqlite:///herder.sqlite")
         self.workers = {}
         self.task_queue = TaskQueue()
+        self.node_clients = NodeClients()
+        self.single_flight = SingleFlight()
+        _cache_conf = self.settings.get("response_cache", {})
+        self.response_cache = ResponseCache(
+            database=self.database if _cache_conf.get("persist", True) else None,
+            max_bytes=int(_cache_conf.get("max_memory_mb", 64) * 1024**2),
+            ttl_seconds=_cache_conf.get("ttl_seconds", 3600),
+        )
+        self.llamas = {}
+        self.llamas_loaded_at = None  # monotonic time of the last node discovery
+        self._llamas_refresh = None  # background refresh in progress
+        self.model_switches = {}  # node_key -> task waiting for a model load
+
+    async def close(self):
+        for _switch in self.model_switches.values():
+            _switch.cancel()
+        for worker_id in list(self.workers):
+            await self.stop_worker(worker_id)
+        await self.node_clients.close()
+        self.response_cache.close()
 
     def load_users(self):
         with open("users.yml", "r") as f:
@@ -29,6 +69,14 @@ class Herder:
         with open("roles.yml", "r") as f:
             self.roles = yaml.safe_load(f)
 
+    def load_settings(self):
+        # herder.yml is optional, every setting has a default
+        try:
+            with open("herder.yml", "r") as f:
+                self.settings = yaml.safe_load(f) or {}
+        except FileNotFoundError:
+            self.settings = {}
+
     async def refresh(self):
         while True:
             await asyncio.sleep(3600)
@@ -65,39 +113,160 @@ class Herder:
         # Finally
         return {"authorized": True}
 
+    async def fetch_llama(self, llama_key, llama, llama_stats):
+        print("loading llama", llama_key)
+        try:
+            _models = await asyncio.wait_for(
+                self.node_clients.request(
+                    llama_key, llama, "GET", "/api/v1/models", timeout=5.0
+                ),
+                timeout=llama.get("discovery_timeout", 5.0),
+            )
+            _models_json = _models.json()
+            llama["models"] = _models_json["models"]
+            llama["loaded_model"] = _models_json["loaded_model"]
+            llama["system_stats"] = _models_json.get("system_stats", {})
+            llama["node_queue"] = _models_json.get("queue", {})
+            llama["load_status"] = _models_json.get("load_status", {})
+            if llama["node_queue"]:
+                self.task_queue.report_node_load(
+                    llama_key,
+                    llama["node_queue"]["queued"],
+                    llama["node_queue"]["running"],
+                )
+            llama["infer_stats"] = llama_stats
+            # Models kept loaded on the node; it serves the prompts of all of them
+            llama["resident_models"] = [
+                model["model_key"] for model in _models_json.get("resident_models", [])
+            ] or [llama["loaded_model"]]
+            llama["mapped_prompts"] = [
+                key
+                for key, value in self.prompter.prompts.items()
+                if set(llama["resident_models"]) & set(value["target_models"])
+            ]
+            if llama.get("node_type") == "herding_llamas":
+                llama["telemetry"] = await self.fetch_telemetry(llama_key, llama)
+        except Exception as e:
+            print(f"WARNING: Could not fetch '{llama_key}': {e!r}")
+            llama["models"] = [{"option": "offline?"}]
+            llama["loaded_model"] = "offline?"
+            llama["system_stats"] = {}
+            llama["node_queue"] = {}
+            llama["load_status"] = {}
+            llama["infer_stats"] = {}
+            llama["resident_models"] = []
+            llama["mapped_prompts"] = []
+        return llama
+
+    async def fetch_telemetry(self, llama_key, llama):
+        try:
+            _sent = time.time()
+            _response = await self.node_clients.request(
+                llama_key,
+                llama,
+                "GET",
+                "/api/v1/telemetry",
+                params={
+                    "minutes": self.TELEMETRY_MINUTES,
+                    "points": self.TELEMETRY_POINTS,
+                },
+                timeout=5.0,
+            )
+            _response.raise_for_status()
+            _telemetry = _response.json()
+            # The node read its clock about halfway through the round trip
+            _midway = (_sent + time.time()) / 2
+            _telemetry["clock_offset"] = _telemetry.get("now", _midway) - _midway
+            return _telemetry
+        except Exception as e:
+            print(f"WARNING: No telemetry from '{llama_key}': {e!r}")
+            return {}
+
+    def fleet_timeline(self, minutes=60, points=60, now=None):
+        """Telemetry of all nodes from the cached snapshot on one time axis,
+        plus fleet-wide series. Nodes are not polled for it. Node timestamps
+        are moved to the herder clock by the offset measured when fetching."""
+        _end = time.time() if now is None else now
+        _start = _end - minutes * 60
+        _width = minutes * 60 / points
+        _nodes = {}
+        for llama_key, llama in self.llamas.items():
+            _telemetry = llama.get("telemetry")
+            if not _telemetry:
+                continue
+            _buckets = {field: {} for field in _telemetry["series"]}
+            _offset = _telemetry.get("clock_offset", 0.0)
+            for i, t in enumerate(_telemetry["time"]):
+                t -= _offset
+                if not _start <= t < _end:
+                    continue
+                _bucket = int((t - _start) / _width)
+                for field, values in _telemetry["series"].items():
+                    if values[i] is not None:
+                        _buckets[field].setdefault(_bucket, []).append(values[i])
+            _nodes[llama_key] = {
+                field: [
+                    sum(by_bucket[b]) / len(by_bucket[b]) if b in by_bucket else None
+                    for b in range(points)
+                ]
+                for field, by_bucket in _buckets.items()
+            }
+
+        _fleet = {}
+        for field in dict.fromkeys(f for series in _nodes.values() for f in series):
+            _fleet[field] = []
+            for b in range(points):
+                _values = [
+                    series[field][b]
+                    for series in _nodes.values()
+                    if field in series and series[field][b] is not None
+                ]
+                if not _values:
+                    _fleet[field].append(None)
+                elif field in self.FLEET_SUM_FIELDS:
+                    _fleet[field].append(sum(_values))
+                else:
+                    _fleet[field].append(sum(_values) / len(_values))
+        return {
+            "start": _start,
+            "bucket_seconds": _width,
+            "time": [_start + (b + 0.5) * _width for b in range(points)],
+            "fleet": _fleet,
+            "nodes": _nodes,
+        }
+
     async def load_llamas(self, load_stats=True):
         with open("llamas.yml") as f:
             self.conf = yaml.safe_load(f)
-        self.llamas = self.conf
+        # Build a new snapshot and swap it in, readers never see a partial one.
+        _llamas = {key: dict(value) for key, value in self.conf.items()}
         if load_stats:
-            _llama_stats = self.database.get_node_statistics()
-            for _llama in self.llamas.copy():
-                print("loading llama", _llama)
-                try:
-                    _url = f"{self.conf[_llama]['base_url']}/api/v1/models"
-                    _headers = self.get_header(self.conf[_llama])
-                    async with httpx.AsyncClient() as client:
-                        _models = await client.get(_url, headers=_headers)
-                    _models_json = _models.json()
-                    self.llamas[_llama]["models"] = _models_json["models"]
-                    self.llamas[_llama]["loaded_model"] = _models_json["loaded_model"]
-                    self.llamas[_llama]["system_stats"] = _models_json.get(
-                        "system_stats", {}
-                    )
-                    self.llamas[_llama]["infer_stats"] = _llama_stats.get(_llama, {})
-                    self.llamas[_llama]["worker_started"] = _llama in self.workers
-                    self.llamas[_llama]["mapped_prompts"] = [
-                        key
-                        for key, value in self.prompter.prompts.items()
-                        if self.llamas[_llama]["loaded_model"] in value["target_models"]
-                    ]
-                except Exception as e:
-                    print(f"WARNING: Could not fetch '{_llama}': {e}")
-                    self.llamas[_llama]["models"] = [{"option": "offline?"}]
-                    self.llamas[_llama]["loaded_model"] = "offline?"
-                    self.llamas[_llama]["system_stats"] = {}
-                    self.llamas[_llama]["infer_stats"] = {}
-                    self.llamas[_llama]["mapped_prompts"] = []
+            _llama_stats = await asyncio.to_thread(self.database.get_node_statistics)
+            await asyncio.gather(
+                *[
+                    self.fetch_llama(key, value, _llama_stats.get(key, {}))
+                    for key, value in _llamas.items()
+                ]
+            )
+            self.llamas_loaded_at = time.monotonic()
+        self.llamas = _llamas
+        return self.llamas
+
+    async def get_llamas(self):
+        """Cached node snapshot; refreshed in the background once older than the TTL."""
+        if self.llamas_loaded_at is None:
+            await self.load_llamas()
+        elif time.monotonic() - self.llamas_loaded_at > self.LLAMAS_TTL_SECONDS and (
+            self._llamas_refresh is None or self._llamas_refresh.done()
+        ):
+            self._llamas_refresh = asyncio.create_task(self.load_llamas())
+        # Queue and connection pool figures are in memory, always current.
+        for _llama, value in self.llamas.items():
+            value["worker_started"] = _llama in self.workers
+            value["worker_stats"] = (
+                self.workers[_llama].stats() if _llama in self.workers else {}
+            )
+            value["pool_stats"] = self.node_clients.pool_stats(_llama)
         return self.llamas
 
     async def start_worker(self, worker_id, skills):
@@ -105,18 +274,20 @@ class Herder:
         print(f"INFO: Starting worker '{worker_id}' listening to prompts: {skills}")
         if worker_id in self.workers:
             await self.stop_worker(worker_id)
-        task = asyncio.create_task(
-            Worker(
-                worker_id=worker_id, task_queue=self.task_queue, skills=skills
-            ).start()
+        worker = Worker(
+            worker_id=worker_id,
+            task_queue=self.task_queue,
+            skills=skills,
+            max_concurrency=self.llamas.get(worker_id, {}).get("max_concurrency", 1),
         )
-        self.workers[worker_id] = task
+        worker.task = asyncio.create_task(worker.start())
+        self.workers[worker_id] = worker
         print("workers after:", [w for w in self.workers])
 
     async def stop_worker(self, worker_id):
-        task = self.workers.get(worker_id)
-        if task:
-            task.cancel()
+        worker = self.workers.get(worker_id)
+        if worker:
+            worker.task.cancel()
             del self.workers[worker_id]
 
     async def start_workers(self):
@@ -136,24 +307,76 @@ class Herder:
         print(f"INFO: {len(_workers_skipped)} queue worker skipped: {_workers_skipped}")
 
     async def switch_model(self, data: dict):
-        _url = f"{self.conf[data['node_key']]['base_url']}/api/v1/load_model"
-        _headers = self.get_header(self.conf[data["node_key"]])
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            _response = await client.post(url=_url, headers=_headers, json=data)
-        await self.load_llamas()
-        if data["node_key"] in self.workers:
-            print("stopping worker:", data["node_key"])
-            # print(self.workers)
-            await self.stop_worker(data["node_key"])
-        await self.start_worker(
-            data["node_key"], self.llamas[data["node_key"]]["mapped_prompts"]
+        """Starts loading a model on the node; its prompts and worker are remapped
+        in the background once the node reports the model ready."""
+        _response = await self.node_clients.request(
+            data["node_key"],
+            self.conf[data["node_key"]],
+            "POST",
+            "/api/v1/load_model",
+            json=data,
+            timeout=30.0,
+        )
+        if _response.status_code != 200:
+            return _response
+        _switch = self.model_switches.get(data["node_key"])
+        if _switch is not None and not _switch.done():
+            _switch.cancel()  # superseded by this request
+        self.model_switches[data["node_key"]] = asyncio.create_task(
+            self.await_model(data["node_key"], data["model_key"], _response.json())
         )
-        # print("POST SWITCH WORKERS:", self.workers)
-        # print("POST SWITCH PROMPTS:", self.llamas[data["node_key"]]["mapped_prompts"])
         return _response
 
-    async def infer(self, data: dict):
+    async def await_model(self, node_key, model_key, status):
+        # Nodes without background loading (e.g. API wrappers) are ready at once
+        _conf = self.conf[node_key]
+        _started = time.monotonic()
+        _deadline = _started + _conf.get("load_timeout", 1800)
+        while status.get("status", "ready") == "loading":
+            if time.monotonic() > _deadline:
+                print(f"WARNING: '{node_key}' did not load '{model_key}' in time")
+                return
+            await asyncio.sleep(self.LOAD_POLL_SECONDS)
+            try:
+                _response = await self.node_clients.request(
+                    node_key, _conf, "GET", "/api/v1/load_status", timeout=5.0
+                )
+                status = _response.json()
+            except (httpx.HTTPError, ValueError) as e:
+                print(f"WARNING: Load status of '{node_key}' unavailable: {e!r}")
+        if status.get("status") == "failed":
+            print(f"WARNING: '{node_key}' failed to load '{model_key}': {status}")
+            return
+        if status.get("model_key", model_key) != model_key:
+            # e.g. another switch won: polling would not change that
+            print(
+                f"WARNING: '{node_key}' serves '{status['model_key']}', not '{model_key}'"
+            )
+            return
+        metrics.MODEL_SWITCH.labels(node_key).observe(time.monotonic() - _started)
+        await self.remap_worker(node_key)
+
+    async def remap_worker(self, node_key):
+        # Prompts follow the models now resident on the node
+        await self.load_llamas()
+        _skills = self.llamas[node_key]["mapped_prompts"]
+        if node_key in self.workers:
+            # Requests in flight on the node keep running
+            print(f"INFO: Worker '{node_key}' now listening to prompts: {_skills}")
+            self.workers[node_key].update_skills(_skills)
+        else:
+            await self.start_worker(node_key, _skills)
+
+    async def infer(self, data: dict, on_chunk=None):
+        """Returns (response, inference_id, status_code).
+
+        With `on_chunk`, tokens are handed to it as the node generates them.
+        The durations of its stages are left in data["timings"] (seconds).
+        """
+        _timings = {}
+        _start = time.monotonic()
         self.prompter.prepare_request(data)
+        _timings["render"] = time.monotonic() - _start
 
         # node candidates from roles
         _allowed_nodes = self.roles[self.users[data["user_key"]]["role"]]["allow_nodes"]
@@ -161,61 +384,327 @@ class Herder:
 
         # node candidates from prompt settings
 
+        # Deterministic requests answered before are served from the cache,
+        # identical ones in flight share one node call.
+        _coalesce_key = self.coalesce_key(data, _allowed_nodes)
+        _use_cache = _coalesce_key is not None and self.prompter.prompts[
+            data["prompt_key"]
+        ].get("cache", True)
+        _cached = None
+        if _use_cache:
+            _cached = self.response_cache.get(
+                self.candidate_models(data["prompt_key"], _allowed_nodes),
+                data["infer_input"],
+                data.get("param"),
+            )
+        if _cached is not None:
+            node_key = _cached["node_key"]
+            response = httpx.Response(200, json={**_cached, "cache_hit": True})
+            status_code = 200
+            if on_chunk is not None:
+                on_chunk({"token": _cached["response"]})
+        elif _coalesce_key is None or on_chunk is not None:
+            # a stream has its own node call, its tokens cannot be shared
+            node_key, response, status_code = await self.dispatch(
+                data, _allowed_nodes, on_chunk, timings=_timings
+            )
+        else:
+            # callers sharing another's node call only see their total time
+            (node_key, response, status_code), _shared = await self.single_flight.do(
+                _coalesce_key,
+                lambda: self.dispatch(data, _allowed_nodes, timings=_timings),
+            )
+        if status_code != 200:
+            return response, None, status_code
+        mask_history = self.users[data["user_key"]].get(
+            "opt_out_history_content", False
+        )
+        # Content of users opting out of the history is not kept in the cache.
+        if _use_cache and _cached is None and not mask_history:
+            _response_json = response.json()
+            self.response_cache.put(
+                _response_json.get("model_name"),
+                data["infer_input"],
+                data.get("param"),
+                {**_response_json, "node_key": node_key},
+            )
+
+        response_json = response.json()
+        if _cached is None:
+            for name, seconds in response_json.get("timings", {}).items():
+                _timings[f"node_{name}"] = seconds
+        db_inference_record = {
+            "user_key": data.get("user_key", "unknown"),
+            "node_key": node_key,
+            "model_name": response_json.get("model_name"),
+            "prompt_key": data.get("prompt_key", "unknown"),
+            "prompt_version": "TBD",
+            "input_tokens": response_json.get("input_tokens", 0),
+            "output_tokens": response_json.get("output_tokens", 0),
+            "elapsed_seconds": (
+                response_json.get("elapsed_seconds", 0) if _cached is None else 0
+            ),  # no node time used for cache hits
+            "time_to_first_token": (
+                response_json.get("time_to_first_token") if _cached is None else 0
+            ),
+            "cache_hit": _cached is not None,
+            "render_seconds": _timings.get("render"),
+            "queue_seconds": _timings.get("queue"),
+            "node_seconds": _timings.get("node"),
+            "tokenize_seconds": _timings.get("node_tokenize"),
+            "generate_seconds": _timings.get("node_generate"),
+            "decode_seconds": _timings.get("node_decode"),
+            "raw_input": (
+                json.dumps(data["raw_inputs"]) if not mask_history else "masked"
+            ),
+            "infer_input": data["infer_input"] if not mask_history else "masked",
+            "response": response.json()["response"] if not mask_history else "masked",
+        }
+        _db_start = time.monotonic()
+        db_inference_id = self.database.create_inference(db_inference_record)
+        _timings["db"] = time.monotonic() - _db_start  # not stored: it is the store
+        _timings["total"] = time.monotonic() - _start
+        data["timings"] = {name: round(value, 4) for name, value in _timings.items()}
+
+        return response, db_inference_id, status_code
+
+    async def infer_stream(self, data: dict):
+        """Yields {"token": ...} chunks, then a final {"done": True, ...} or
+        {"error": ...} chunk."""
+        _chunks = asyncio.Queue()
+        _infer = asyncio.create_task(self.infer(data, on_chunk=_chunks.put_nowait))
+        _infer.add_done_callback(lambda _task: _chunks.put_nowait(None))
+        try:
+            while (chunk := await _chunks.get()) is not None:
+                yield chunk
+            response, inference_id, status_code = _infer.result()
+        finally:
+            _infer.cancel()  # the client went away: frees the queue slot
+
+        if status_code != 200:
+            yield {
+                "error": response["message"],
+                "status_code": status_code,
+                "retry_after": response.get("retry_after"),
+            }
+            return
+        response_json = response.json()
+        yield {
+            "done": True,
+            "text": response_json["response"],
+            "inference_id": inference_id,
+            "model": response_json.get("model_name"),
+            "cache_hit": response_json.get("cache_hit", False),
+            "time_to_first_token": response_json.get("time_to_first_token"),
+            "timings": data.get("timings", {}),
+        }
+
+    def candidate_models(self, prompt_key, allowed_nodes):
+        # Models loaded on allowed nodes serving the prompt, then its targets.
+        _models = [
+            self.node_model(key, prompt_key)
+            for key, value in self.llamas.items()
+            if key in allowed_nodes and prompt_key in value.get("mapped_prompts", [])
+        ] + self.prompter.prompts[prompt_key]["target_models"]
+        return list(dict.fromkeys(_models))
+
+    def node_model(self, node_key, prompt_key):
+        """Model a node should use for the prompt: its default model if that is a
+        target of the prompt, otherwise the first resident target."""
+        _llama = self.llamas[node_key]
+        _targets = self.prompter.prompts[prompt_key]["target_models"]
+        if _llama.get("loaded_model") in _targets:
+            return _llama["loaded_model"]
+        for model in _targets:
+            if model in _llama.get("resident_models", []):
+                return model
+        return _llama.get("loaded_model")
+
+    def coalesce_key(self, data: dict, allowed_nodes):
+        # Only deterministic generations give the same answer twice.
+        _param = data.get("param") or {}
+        if _param.get("do_sample", False) and _param.get("temperature", 0.7) != 0:
+            return None
+        # A shared call is queued on the first caller's terms: only callers with
+        # the same priority and timeout share it, so none waits longer than its own.
+        _queue_conf = self.get_queue_conf(data["user_key"])
+        return (
+            tuple(self.candidate_models(data["prompt_key"], allowed_nodes)),
+            tuple(sorted(allowed_nodes)),
+            _queue_conf["priority"],
+            self.request_timeout(data, _queue_conf),
+            data["infer_input"],
+            json.dumps(_param, sort_keys=True),
+        )
+
+    async def dispatch(self, data: dict, allowed_nodes, on_chunk=None, timings=None):
+        """Queue one node call; returns (node_key, response, status_code).
+
+        Queue wait and node call durations are added to `timings` if given.
+        """
+        timings = {} if timings is None else timings
+
         # Wrapper for queue
         # node_key is injected through lambda function from picking up worker!
         # worker_id == node_key
         async def send_request(data, node_key):
+            _start = time.monotonic()
+            timings["queue"] = _start - _enqueued_at
+            metrics.QUEUE_WAIT.labels(data["prompt_key"]).observe(timings["queue"])
+            _status = "error"
+            try:
+                node_key, response = await call_node(data, node_key)
+                _status = str(response.status_code)
+                return node_key, response
+            except asyncio.CancelledError:
+                _status = "cancelled"
+                raise
+            finally:
+                timings["node"] = time.monotonic() - _start
+                metrics.NODE_LATENCY.labels(node_key).observe(timings["node"])
+                metrics.NODE_RESPONSES.labels(node_key, _status).inc()
+
+        async def call_node(data, node_key):
             _node_conf = self.llamas[node_key]
-            url = f'{_node_conf["base_url"]}{_node_conf.get("infer_path","/api/v1/infer")}'
-            headers = self.get_header(self.llamas[node_key])
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(url=url, headers=headers, json=data)
+            _remaining = max(0.0, _deadline - time.monotonic())
+            # Remaining time budget, the node stops generating after it
+            _headers = {"X-Deadline-Seconds": f"{_remaining:.3f}"}
+            if _node_conf.get("node_type") == "herding_llamas":
+                # name the resident model that serves the prompt
+                data = {
+                    **data,
+                    "model_key": self.node_model(node_key, data["prompt_key"]),
+                }
+            if on_chunk is not None and _node_conf.get("node_type") == "herding_llamas":
+                return node_key, await stream_request(data, node_key, _headers)
+            response = await self.node_clients.request(
+                node_key,
+                _node_conf,
+                "POST",
+                _node_conf.get("infer_path", "/api/v1/infer"),
+                json=data,
+                headers=_headers,
+            )
+            if on_chunk is not None and response.status_code == 200:
+                # node cannot stream: the whole answer is a single chunk
+                on_chunk({"token": response.json()["response"]})
             return node_key, response
 
+        # Holds the queue slot until the node sent its last token
+        async def stream_request(data, node_key, headers):
+            _node_conf = self.llamas[node_key]
+            async with self.node_clients.stream(
+                node_key,
+                _node_conf,
+                "POST",
+                _node_conf.get("infer_stream_path", "/api/v1/infer_stream"),
+                json=data,
+                headers=headers,
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    return response
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("done"):
+                        return httpx.Response(200, json=chunk)
+                    on_chunk(chunk)
+            return httpx.Response(502, text="stream ended before the final chunk")
+
+        # Priority class and fair share weight from the role (user may override)
+        _queue_conf = self.get_queue_conf(data["user_key"])
+        _timeout = self.request_timeout(data, _queue_conf)
+
+        # Admission control: reject right away what cannot finish in time
+        _admission = self.task_queue.admit(
+            data["prompt_key"],
+            allowed_nodes,
+            priority=_queue_conf["priority"],
+            timeout=_timeout,
+            queue_class=_queue_conf["class"],
+        )
+        if not _admission["admitted"]:
+            response = {
+                "message": _admission["message"],
+                "retry_after": _admission["retry_after"],
+            }
+            # No node at all vs. backlog too long for the deadline
+            status_code = 503 if _admission["expected_seconds"] is None else 429
+            return None, response, status_code
+
         # Adding request to queue
+        _enqueued_at = time.monotonic()
+        _deadline = _enqueued_at + _timeout
         task_id = await self.task_queue.enqueue_task(
             lambda node_key: send_request(data, node_key),
             data["prompt_key"],
-            _allowed_nodes,
+            allowed_nodes,
+            flow=data["user_key"],
+            priority=_queue_conf["priority"],
+            weight=_queue_conf["weight"],
+            queue_class=_queue_conf["class"],
+            deadline=_deadline,
+            routing=self.prompter.prompts[data["prompt_key"]].get(
+                "routing", "first_free"
+            ),
         )
 
         # wait for queue complete event and pick up results
         try:
             await asyncio.wait_for(
-                self.task_queue.result_events[task_id].wait(), timeout=30  # 60 * 5
+                self.task_queue.result_events[task_id].wait(), timeout=_timeout
             )
-            node_key, response = self.task_queue.results.pop(task_id)
-            status_code = 200
+            result = self.task_queue.results.pop(task_id)
         except asyncio.TimeoutError:
-            response = {"message": "TIMEOUT: No allowed Llama available!"}
+            response = {
+                "message": "TIMEOUT: No allowed Llama available!",
+                "retry_after": math.ceil(_timeout),
+            }
             status_code = 503
-            db_inference_id = None
-            return response, db_inference_id, status_code
+            return None, response, status_code
+        finally:
+            # Drops the task if still queued or cancels it if running (no-op
+            # once done), and frees its result slot.
+            self.task_queue.cancel_task(task_id)
+
+        if isinstance(result, Exception):
+            response = {"message": f"Llama request failed: {result!r}"}
+            return None, response, 502
+        node_key, response = result
+        if response.status_code != 200:
+            response = {"message": f"Llama '{node_key}' answered: {response.text}"}
+            return node_key, response, 502
 
-        mask_history = self.users[data["user_key"]].get(
-            "opt_out_history_content", False
-        )
         response_json = response.json()
-        db_inference_record = {
-            "user_key": data.get("user_key", "unknown"),
-            "node_key": node_key,
-            "model_name": response_json.get("model_name"),
-            "prompt_key": data.get("prompt_key", "unknown"),
-            "prompt_version": "TBD",
-            "input_tokens": response_json.get("input_tokens", 0),
-            "output_tokens": response_json.get("output_tokens", 0),
-            "elapsed_seconds": response_json.get("elapsed_seconds", 0),
-            "raw_input": json.dumps(data["raw_inputs"])
-            if not mask_history
-            else "masked",
-            "infer_input": data["infer_input"] if not mask_history else "masked",
-            "response": response.json()["response"] if not mask_history else "masked",
-        }
-        db_inference_id = self.database.create_inference(db_inference_record)
+        _input_tokens = response_json.get("input_tokens", 0)
+        _output_tokens = response_json.get("output_tokens", 0)
+        if self.llamas[node_key].get("node_type") == "herding_llamas":
+            # their output_tokens include the prompt
+            _output_tokens = max(0, _output_tokens - _input_tokens)
+        metrics.INPUT_TOKENS.labels(node_key).inc(_input_tokens)
+        metrics.OUTPUT_TOKENS.labels(node_key).inc(_output_tokens)
+        self.task_queue.record_tokens(
+            node_key,
+            response_json.get("output_tokens", 0),
+            response_json.get("elapsed_seconds", 0),
+            # generation speed as measured by the node, if it reports one
+            response_json.get("tokens_per_second"),
+            skill=data["prompt_key"],
+        )
+        return node_key, response, 200
 
-        return response, db_inference_id, status_code
+    def request_timeout(self, data: dict, queue_conf):
+        # A request may ask for less time than its role allows, never for more.
+        return min(data.get("timeout", queue_conf["timeout"]), queue_conf["timeout"])
 
-    def get_header(self, llama: dict):
-        API_KEY_NAME = llama["API_KEY_NAME"]
-        API_KEY = os.environ.get(API_KEY_NAME)
-        return {API_KEY_NAME: API_KEY}
+    def get_queue_conf(self, user_key):
+        _user = self.users[user_key]
+        _role_queue = self.roles[_user["role"]].get("queue", {})
+        return {
+            "class": _role_queue.get("class", _user["role"]),
+            "priority": _role_queue.get("priority", 1),
+            "weight": _user.get("queue_weight", _role_queue.get("weight", 1)),
+            "timeout": _role_queue.get("timeout", 30),  # seconds
+        }
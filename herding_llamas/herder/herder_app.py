@@ -3,6 +3,7 @@ from fastapi.security import OAuth2PasswordBearer
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from starlette.requests import Request
@@ -19,7 +20,10 @@ import pprint
 import time
 import os
 
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+
 from herder import Herder
+from metrics import HerderCollector
 
 
 class HerderApp:
@@ -35,6 +39,7 @@ class HerderApp:
         self.app.mount("/UI", StaticFiles(directory="UI"), name="UI")
         self.oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
         self.herder = Herder()
+        REGISTRY.register(HerderCollector(self.herder))
 
         class User(BaseModel):
             user_key: str
@@ -107,6 +112,12 @@ class HerderApp:
 
             return wrapper
 
+        @self.app.get("/metrics")
+        async def api_metrics():
+            # Prometheus text format; not behind a token, so that scrapers need
+            # no user: restrict access to it on the network level.
+            return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
         @self.app.get("/api/v1/allowed_tabs")
         @authorize_endpoint
         async def api_allowed_tabs(request: Request):
@@ -121,7 +132,8 @@ class HerderApp:
             Get a list of connected large language model instances (llamas).
 
             This function retrieves the list of connected llamas, which will be
-            displayed in an admin form.
+            displayed in an admin form. Served from a snapshot that is refreshed in
+            the background, so a slow or dead node does not delay the response.
 
             Args:
                 None
@@ -133,9 +145,77 @@ class HerderApp:
                 HTTPException: If the user is not authorized to access this endpoint.
 
             """
-            self.herder.llamas = await self.herder.load_llamas()
-            # pprint.pprint(herder_instance.llamas)
-            return self.herder.llamas
+            return await self.herder.get_llamas()
+
+        @self.app.get("/api/v1/queue_stats")
+        @authorize_endpoint
+        async def api_get_queue_stats(request: Request):
+            """
+            Get queue depth and wait-time statistics per priority class.
+
+            Classes and their priority / fair share weight are configured per role
+            (`queue` section in roles.yml).
+
+            Args:
+                None
+
+            Returns:
+                dict: Per class the number of queued tasks and the average, max,
+                    p50 and p99 queue wait in seconds.
+
+            Raises:
+                HTTPException: If the user is not authorized to access this endpoint.
+
+            """
+            return self.herder.task_queue.queue_stats()
+
+        @self.app.get("/api/v1/cache_stats")
+        @authorize_endpoint
+        async def api_get_cache_stats(request: Request):
+            """
+            Get statistics of the response cache for deterministic requests.
+
+            Args:
+                None
+
+            Returns:
+                dict: Hits, misses, hit ratio, evictions, number of entries and
+                    their size in bytes.
+
+            Raises:
+                HTTPException: If the user is not authorized to access this endpoint.
+
+            """
+            return self.herder.response_cache.cache_stats()
+
+        @self.app.get("/api/v1/telemetry")
+        @authorize_endpoint
+        async def api_get_telemetry(
+            request: Request, minutes: float = 60, points: int = 60
+        ):
+            """
+            Get the recent system stats, load and tokens/s of all llamas.
+
+            Built from the node snapshot (see /api/v1/llamas), which carries each
+            node's telemetry history, so viewing it does not poll the nodes.
+
+            Args:
+                minutes (float): Length of the timeline, at most one hour.
+                points (int): Number of buckets the timeline is averaged into.
+
+            Returns:
+                dict: Bucket times, fleet-wide series (memory, tokens/s and backlog
+                    summed, utilization and load averaged) and the series per node.
+
+            Raises:
+                HTTPException: If the user is not authorized to access this endpoint.
+
+            """
+            _max_minutes = self.herder.TELEMETRY_MINUTES
+            if not 0 < minutes <= _max_minutes or not 1 <= points <= 500:
+                raise HTTPException(status_code=400, detail="Invalid minutes or points")
+            await self.herder.get_llamas()
+            return self.herder.fleet_timeline(minutes, points)
 
         @self.app.get("/api/v1/start_workers")
         @authorize_endpoint
@@ -169,6 +249,7 @@ class HerderApp:
             _allowed_nodes = self.herder.roles[request.state.user.user_key][
                 "allow_nodes"
             ]
+            _llamas = await self.herder.get_llamas()
             _prompt_options = [
                 {"prompt": key, "name": key}  # value["name"]}
                 for key, value in self.herder.prompter.prompts.items()
@@ -183,14 +264,14 @@ class HerderApp:
                 # Check which available nodes are mapped to the prompt (and can be used)
                 _full_prompts[prompt_k]["allowed_nodes"] = [
                     llama_k
-                    for llama_k, llama_v in self.herder.llamas.items()
+                    for llama_k, llama_v in _llamas.items()
                     if prompt_k in llama_v.get("mapped_prompts", [])
                     and llama_k in _allowed_nodes
                 ]
                 # Check which available nodes are mapped to the prompt (and can NOT be used)
                 _full_prompts[prompt_k]["not_allowed_nodes"] = [
                     llama_k
-                    for llama_k, llama_v in self.herder.llamas.items()
+                    for llama_k, llama_v in _llamas.items()
                     if prompt_k in llama_v.get("mapped_prompts", [])
                     and llama_k not in _allowed_nodes
                 ]
@@ -202,7 +283,7 @@ class HerderApp:
 
         @self.app.post("/api/v1/infer")
         @authorize_endpoint
-        async def api_post_infer(request: Request, data: dict):
+        async def api_post_infer(request: Request, data: dict, http_response: Response):
             """
             Process inference of a user request.
 
@@ -219,17 +300,44 @@ class HerderApp:
                 {
                     'infer_input':  <raw request>,
                     'prompt_key':   <key from prompt store>,
-                    'param':        <Optional overwrite of generation parameter like temperature or max output tokens>
+                    'param':        <Optional overwrite of generation parameter like temperature or max output tokens>,
+                    'stream':       <Optional, true for newline-delimited JSON chunks: {"token": ...} while generating, then {"done": true, ...}>
                 }
 
             Returns:
                 dict: A dictionary containing the inference result text and the inference ID.
+                    Durations of the stages (prompt rendering, queue wait, node call and
+                    the node's own stages, database) are returned in `timings` and as a
+                    Server-Timing header.
 
             Raises:
                 HTTPException: If the user is not authorized to access this endpoint.
 
             """
             data["user_key"] = request.state.user.user_key
+            if data.get("stream", False):
+                _chunks = self.herder.infer_stream(data)
+                # Rejections (admission, timeout, node errors) before the first
+                # token still get a proper status code.
+                _first_chunk = await _chunks.__anext__()
+                if "error" in _first_chunk:
+                    _headers = {"WWW-Authenticate": "Bearer"}
+                    if _first_chunk["retry_after"] is not None:
+                        _headers["Retry-After"] = str(_first_chunk["retry_after"])
+                    raise HTTPException(
+                        status_code=_first_chunk["status_code"],
+                        detail=_first_chunk["error"],
+                        headers=_headers,
+                    )
+
+                async def ndjson_lines():
+                    yield json.dumps(_first_chunk) + "\n"
+                    async for chunk in _chunks:
+                        yield json.dumps(chunk) + "\n"
+
+                return StreamingResponse(
+                    ndjson_lines(), media_type="application/x-ndjson"
+                )
             response, inference_id, status_code = await self.herder.infer(data)
 
             if status_code == 200:
@@ -238,13 +346,22 @@ class HerderApp:
                     "text": response_json["response"],
                     "inference_id": inference_id,
                     "model": response_json.get("model"),
+                    "cache_hit": response_json.get("cache_hit", False),
+                    "timings": data["timings"],
                 }
+                http_response.headers["Server-Timing"] = ", ".join(
+                    f"{name};dur={seconds * 1000:.1f}"
+                    for name, seconds in data["timings"].items()
+                )
                 return response_data
             else:
+                _headers = {"WWW-Authenticate": "Bearer"}
+                if "retry_after" in response:
+                    _headers["Retry-After"] = str(response["retry_after"])
                 raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    status_code=status_code,
                     detail=response["message"],
-                    headers={"WWW-Authenticate": "Bearer"},
+                    headers=_headers,
                 )
 
         @self.app.post("/api/v1/score")
@@ -339,4 +456,11 @@ class HerderApp:
                 HTTPException: If the user is not authorized to access this endpoint.
             """
             response = await self.herder.switch_model(data)
+            if response.status_code != 200:
+                # e.g. 404 for an unknown model, 409 while another load runs
+                try:
+                    _detail = response.json().get("detail", response.text)
+                except ValueError:
+                    _detail = response.text
+                raise HTTPException(status_code=response.status_code, detail=_detail)
             return response.json()
@@ -1,65 +1,631 @@
 import asyncio
+import heapq
+import itertools
+import math
+import time
 import uuid
+from collections import deque
+
+
+# Task definition
+class Task:
+    def __init__(
+        self,
+        task_id,
+        task_func,
+        skill_required,
+        allowed_workers,
+        seq,
+        priority=1,
+        finish_tag=0.0,
+        queue_class="default",
+        deadline=None,
+        routing="first_free",
+    ):
+        self.task_id = task_id
+        self.task_func = task_func
+        self.skill_required = skill_required
+        self.allowed_workers = allowed_workers
+        self.seq = seq  # global arrival order, breaks ties between equal tags
+        self.priority = priority  # lower value is served first
+        self.finish_tag = finish_tag  # weighted fair queuing tag within a priority
+        self.queue_class = queue_class
+        self.enqueued_at = time.monotonic()
+        self.deadline = deadline  # monotonic time after which nobody waits for it
+        self.handle = None  # asyncio.Task running it, once claimed by a worker
+        self.routing = routing  # first_free | least_loaded
+
+    def expired(self, now=None):
+        return self.deadline is not None and (now or time.monotonic()) > self.deadline
+
+    def sort_key(self):
+        return (self.priority, self.finish_tag, self.seq)
+
+    def index_keys(self):
+        # A task is indexed once per eligible worker (or once as wildcard if
+        # any worker serving the skill may pick it up).
+        if not self.allowed_workers:
+            return [(self.skill_required, None)]
+        return [(self.skill_required, w) for w in self.allowed_workers]
+
+
+# Queue wait statistics per class
+class WaitStats:
+    def __init__(self, window=1000):
+        self.count = 0
+        self.expired = 0  # dropped from the queue after their deadline passed
+        self.cancelled = 0  # given up by the waiter before a node picked it up
+        self.rejected = 0  # refused by admission control
+        self.sum_seconds = 0.0
+        self.max_seconds = 0.0
+        self.recent = deque(maxlen=window)  # for percentiles over recent tasks
+
+    def add(self, seconds):
+        self.count += 1
+        self.sum_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.recent.append(seconds)
+
+    def percentile(self, pct):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "expired": self.expired,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+            "average_wait_seconds": (
+                round(self.sum_seconds / self.count, 3) if self.count else 0.0
+            ),
+            "max_wait_seconds": round(self.max_seconds, 3),
+            "p50_wait_seconds": round(self.percentile(50), 3),
+            "p99_wait_seconds": round(self.percentile(99), 3),
+        }
 
 
 # TaskQueue definition
 class TaskQueue:
+    # Weight of the latest observation in the per worker moving averages
+    SERVICE_TIME_ALPHA = 0.2
+    ROUTING_POLICIES = ("first_free", "least_loaded")
+    # Queued tasks a worker looks at past the ones it leaves to faster workers
+    ROUTING_LOOKAHEAD = 32
+    # Backlog reported by a node is ignored once older: nodes are only polled
+    # now and then, and the backlog drains meanwhile.
+    NODE_LOAD_TTL_SECONDS = 5
+
     def __init__(self):
-        self.queue = asyncio.Queue()
-        self.new_task_event = asyncio.Event()
+        # (skill, worker_id or None) -> heap of (sort_key, task_id). Entries of
+        # tasks claimed through another index are dropped lazily.
+        self.pending = {}
+        self.tasks = {}  # task_id -> Task, for all tasks not yet claimed
+        self.waiters = {}  # worker_id -> (skills, asyncio.Event)
+        self.slots = {}  # worker_id -> number of tasks the worker runs concurrently
         self.results = {}  # To store results of completed tasks
         self.result_events = {}  # To store events corresponding to each task
+        self.virtual_time = {}  # priority -> finish tag of the last dequeued task
+        self.last_finish = {}  # (priority, flow) -> finish tag of the flow's last task
+        self.wait_stats = {}  # queue_class -> WaitStats
+        self.depth = {}  # (skill, priority) -> number of queued tasks
+        self.service_time = {}  # worker_id -> moving average of seconds per task
+        self.skill_service_time = {}  # (worker_id, skill) -> moving average seconds
+        self.tokens_per_second = {}  # worker_id -> moving average of output tokens/s
+        self.skill_tokens = {}  # skill -> moving average of output tokens per task
+        self.in_flight = {}  # worker_id -> number of claimed, unfinished tasks
+        self.node_load = {}  # worker_id -> (requests not claimed here, reported at)
+        self.running = {}  # task_id -> (worker_id, Task) of claimed tasks
+        self._seq = itertools.count()
+        self._stale = 0
+
+    def register_worker(self, worker_id, skills, slots=1):
+        event = asyncio.Event()
+        self.waiters[worker_id] = (set(skills), event)
+        self.slots[worker_id] = slots
+        event.set()  # check for tasks queued before the worker came up
+        return event
+
+    def unregister_worker(self, worker_id, event=None):
+        # A restarted worker may register before the old one has shut down.
+        if event is None or self.waiters.get(worker_id, (None, None))[1] is event:
+            self.waiters.pop(worker_id, None)
+            self.slots.pop(worker_id, None)
+            # Tasks deferred to this worker need someone else now.
+            for _skills, _event in self.waiters.values():
+                _event.set()
+
+    def update_worker_skills(self, worker_id, skills):
+        # Remapped prompts take effect without restarting the worker.
+        if worker_id in self.waiters:
+            _skills, event = self.waiters[worker_id]
+            self.waiters[worker_id] = (set(skills), event)
+            event.set()  # tasks of the new skills may already be queued
+
+    def qsize(self):
+        return len(self.tasks)
 
-    async def enqueue_task(self, task_func, skill_required, allowed_workers=None):
+    async def enqueue_task(
+        self,
+        task_func,
+        skill_required,
+        allowed_workers=None,
+        flow=None,
+        priority=1,
+        weight=1.0,
+        queue_class="default",
+        deadline=None,
+        routing="first_free",
+    ):
+        if routing not in self.ROUTING_POLICIES:
+            raise ValueError(
+                f"Unknown routing '{routing}', expected one of {self.ROUTING_POLICIES}"
+            )
         task_id = str(uuid.uuid4())
         self.result_events[task_id] = asyncio.Event()  # Create an event for this task
-        await self.queue.put(
-            (task_id, task_func, skill_required, allowed_workers or [])
+
+        # Self-clocked fair queuing: a flow with weight w advances by 1/w per
+        # task, so under contention flows are served in proportion to weight.
+        flow_key = (priority, flow if flow is not None else task_id)
+        start_tag = max(
+            self.virtual_time.get(priority, 0.0), self.last_finish.get(flow_key, 0.0)
+        )
+        finish_tag = start_tag + 1.0 / max(weight, 1e-6)
+        if flow is not None:
+            self.last_finish[flow_key] = finish_tag
+
+        task = Task(
+            task_id,
+            task_func,
+            skill_required,
+            allowed_workers or [],
+            next(self._seq),
+            priority=priority,
+            finish_tag=finish_tag,
+            queue_class=queue_class,
+            deadline=deadline,
+            routing=routing,
         )
-        self.new_task_event.set()
+        self.tasks[task_id] = task
+        _depth_key = (skill_required, priority)
+        self.depth[_depth_key] = self.depth.get(_depth_key, 0) + 1
+        for key in task.index_keys():
+            heapq.heappush(self.pending.setdefault(key, []), (task.sort_key(), task_id))
+        self._wake(task)
         return task_id
 
+    def _remove(self, task):
+        del self.tasks[task.task_id]
+        _depth_key = (task.skill_required, task.priority)
+        self.depth[_depth_key] -= 1
+        if not self.depth[_depth_key]:
+            del self.depth[_depth_key]
+
+    def _drop(self, task):
+        self._remove(task)
+        self._stale += len(task.index_keys())
+
+    def _expire(self, task):
+        # Nobody waits for the result any more: never send it to a node.
+        self._drop(task)
+        self.forget(task.task_id)
+        self.wait_stats.setdefault(task.queue_class, WaitStats()).expired += 1
+        print(f"INFO: Dropped expired task {task.task_id} ({task.skill_required})")
+
+    def _eligible_workers(self, skill_required, allowed_workers=None):
+        return [
+            worker_id
+            for worker_id, (skills, _event) in self.waiters.items()
+            if skill_required in skills
+            and (not allowed_workers or worker_id in allowed_workers)
+        ]
+
+    def _wake(self, task):
+        # Only wake workers that could actually serve this task.
+        for worker_id in self._eligible_workers(
+            task.skill_required, task.allowed_workers
+        ):
+            self.waiters[worker_id][1].set()
+
+    def expected_service_time(self, worker_id, skill):
+        """Seconds a `skill` task takes on `worker_id`, None if never measured.
+
+        The typical output length of the skill at the worker's current tokens/s,
+        else the measured latency of the worker for the skill or for any task.
+        """
+        _tokens_per_second = self.tokens_per_second.get(worker_id)
+        if skill in self.skill_tokens and _tokens_per_second:
+            return self.skill_tokens[skill] / _tokens_per_second
+        return self.skill_service_time.get(
+            (worker_id, skill), self.service_time.get(worker_id)
+        )
+
+    def expected_completion(self, worker_id, skill, queued=0):
+        """Expected seconds until `worker_id` would finish a new `skill` task,
+        behind `queued` tasks left to it first."""
+        _latency = self.expected_service_time(worker_id, skill)
+        if _latency is None:
+            return 0.0  # never measured: try it first to learn its latency
+        _slots = self.slots.get(worker_id, 1)
+        _busy = (
+            self.in_flight.get(worker_id, 0)
+            + self.current_node_load(worker_id)
+            + queued
+        )
+        _waiting = max(0, _busy - _slots + 1)
+        return _latency * (1 + _waiting / _slots)
+
+    def _route(self, task, worker_id, deferred):
+        # Worker with the lowest expected completion time, ties by name.
+        # `deferred` counts the tasks ahead of this one left to each worker.
+        _workers = set(
+            self._eligible_workers(task.skill_required, task.allowed_workers)
+        )
+        return min(
+            _workers | {worker_id},
+            key=lambda w: (
+                self.expected_completion(w, task.skill_required, deferred.get(w, 0)),
+                w != worker_id,  # a tie goes to the worker asking, it is free
+                w,
+            ),
+        )
+
+    def _lookahead(self, key):
+        # Live tasks of an index in queue order, at most ROUTING_LOOKAHEAD.
+        if self._head(key) is None:
+            return []
+        _now = time.monotonic()
+        _tasks = []
+        for _sort_key, task_id in heapq.nsmallest(
+            self.ROUTING_LOOKAHEAD + self._stale, self.pending[key]
+        ):
+            task = self.tasks.get(task_id)
+            if task is not None and not task.expired(_now):
+                _tasks.append(task)
+                if len(_tasks) == self.ROUTING_LOOKAHEAD:
+                    break
+        return _tasks
+
+    def _head(self, key):
+        # Drop entries claimed through another index, return the next live task.
+        heap = self.pending.get(key)
+        now = time.monotonic()
+        while heap:
+            task = self.tasks.get(heap[0][1])
+            if task is not None and task.expired(now):
+                self._expire(task)
+                task = None
+            if task is not None:
+                return task
+            heapq.heappop(heap)
+            self._stale -= 1
+        if heap is not None:
+            del self.pending[key]
+        return None
+
+    def _compact(self):
+        # Tasks indexed for several workers leave entries behind in the heaps of
+        # the workers that did not claim them; rebuild once they pile up.
+        now = time.monotonic()
+        for task in [t for t in self.tasks.values() if t.expired(now)]:
+            self._expire(task)
+        for key in list(self.pending):
+            heap = [entry for entry in self.pending[key] if entry[1] in self.tasks]
+            if heap:
+                heapq.heapify(heap)
+                self.pending[key] = heap
+            else:
+                del self.pending[key]
+        self._stale = 0
+
     async def try_dequeue_task(self, skills, worker_id):
-        if self.queue.empty():
+        candidates = []
+        for skill in skills:
+            for key in ((skill, worker_id), (skill, None)):
+                candidates.extend(
+                    (task.sort_key(), key, task) for task in self._lookahead(key)
+                )
+        best, best_key = None, None
+        deferred = {}  # worker_id -> tasks ahead left to it
+        for _sort_key, key, task in sorted(candidates, key=lambda c: c[0]):
+            if task.routing == "least_loaded":
+                _target = self._route(task, worker_id, deferred)
+                if _target != worker_id:
+                    # Leave it to the faster node and make sure it looks; the
+                    # tasks behind it may still be done sooner here.
+                    deferred[_target] = deferred.get(_target, 0) + 1
+                    self.waiters[_target][1].set()
+                    continue
+            best, best_key = task, key
+            break
+        if best is None:
             return None, None
-        task_id, task_func, skill_required, allowed_workers = await self.queue.get()
-        if skill_required in skills and (
-            not allowed_workers or worker_id in allowed_workers
-        ):
-            return task_id, task_func
+        self._remove(best)
+        self.running[best.task_id] = (worker_id, best)
+        self.in_flight[worker_id] = self.in_flight.get(worker_id, 0) + 1
+        if self.pending[best_key][0][1] == best.task_id:
+            heapq.heappop(self.pending[best_key])
+            self._stale += len(best.index_keys()) - 1
         else:
-            await self.queue.put((task_id, task_func, skill_required, allowed_workers))
-            return None, None
+            # claimed from behind the head: its entries are dropped lazily
+            self._stale += len(best.index_keys())
+        if self._stale > 2 * len(self.tasks) + 64:
+            self._compact()
+
+        self.virtual_time[best.priority] = max(
+            self.virtual_time.get(best.priority, 0.0), best.finish_tag
+        )
+        if not self.tasks:
+            # Queue drained: reset the clocks so tags do not grow forever.
+            self.virtual_time.clear()
+            self.last_finish.clear()
+        self.wait_stats.setdefault(best.queue_class, WaitStats()).add(
+            time.monotonic() - best.enqueued_at
+        )
+        return best.task_id, best.task_func
+
+    def _ewma(self, averages, key, value):
+        _previous = averages.get(key)
+        averages[key] = (
+            value
+            if _previous is None
+            else _previous + self.SERVICE_TIME_ALPHA * (value - _previous)
+        )
+
+    def record_service_time(self, worker_id, seconds, skill=None):
+        self._ewma(self.service_time, worker_id, seconds)
+        if skill is not None:
+            self._ewma(self.skill_service_time, (worker_id, skill), seconds)
+
+    def record_tokens(
+        self, worker_id, output_tokens, seconds, tokens_per_second=None, skill=None
+    ):
+        if tokens_per_second is None and output_tokens and seconds > 0:
+            tokens_per_second = output_tokens / seconds
+        if tokens_per_second:
+            self._ewma(self.tokens_per_second, worker_id, tokens_per_second)
+            if skill is not None and seconds > 0:
+                # tokens counted the way the rate was, so their ratio is seconds
+                self._ewma(self.skill_tokens, skill, tokens_per_second * seconds)
+
+    def attach(self, task_id, handle):
+        # Remember what runs a claimed task, so the waiter can cancel it.
+        _worker_id, task = self.running.get(task_id, (None, None))
+        if task is not None:
+            task.handle = handle
+
+    def complete(self, task_id, result):
+        # Result (or exception) for the waiter, if it is still waiting.
+        if task_id in self.result_events:
+            self.results[task_id] = result
+            self.result_events[task_id].set()  # Signal that the result is available
+
+    def cancel_task(self, task_id):
+        """The waiter gave up: drop the task if queued, cancel it if running."""
+        task = self.tasks.get(task_id)
+        if task is not None:
+            self._drop(task)
+            self.wait_stats.setdefault(task.queue_class, WaitStats()).cancelled += 1
+        else:
+            _worker_id, task = self.running.get(task_id, (None, None))
+            if task is not None and task.handle is not None:
+                task.handle.cancel()
+        self.forget(task_id)
+
+    def forget(self, task_id):
+        # Result slots live only as long as somebody waits for them.
+        self.results.pop(task_id, None)
+        self.result_events.pop(task_id, None)
+
+    def task_done(self, task_id, seconds=None):
+        """Release a claimed task; `seconds` is its service time if it succeeded."""
+        worker_id, task = self.running.pop(task_id, (None, None))
+        if worker_id is None:
+            return
+        self.in_flight[worker_id] -= 1
+        if seconds is not None:
+            self.record_service_time(worker_id, seconds, task.skill_required)
+
+    def report_node_load(self, worker_id, queued, running):
+        """Backlog reported by the node itself, e.g. from other clients."""
+        self.node_load[worker_id] = (
+            max(0, queued + running - self.in_flight.get(worker_id, 0)),
+            time.monotonic(),
+        )
+
+    def current_node_load(self, worker_id):
+        _load, _reported_at = self.node_load.get(worker_id, (0, None))
+        if _reported_at is None:
+            return 0
+        if time.monotonic() - _reported_at > self.NODE_LOAD_TTL_SECONDS:
+            return 0
+        return _load
+
+    def node_stats(self, worker_id):
+        return {
+            "in_flight": self.in_flight.get(worker_id, 0),
+            "node_load": self.current_node_load(worker_id),
+            "ewma_latency_seconds": round(self.service_time.get(worker_id, 0.0), 2),
+            "ewma_tokens_per_second": round(
+                self.tokens_per_second.get(worker_id, 0.0), 2
+            ),
+        }
+
+    def estimate_completion(self, skill_required, allowed_workers=None, priority=1):
+        """Expected seconds until a new task would be finished, None if unknown.
+
+        Raises LookupError if no registered worker can serve the task at all.
+        """
+        _workers = self._eligible_workers(skill_required, allowed_workers)
+        if not _workers:
+            raise LookupError(f"No worker available for '{skill_required}'")
+        _known = [self.service_time[w] for w in _workers if w in self.service_time]
+        if not _known:
+            return None  # no observations yet, cannot judge
+        _default = sum(_known) / len(_known)  # for workers without observations
+        _rate = sum(
+            self.slots.get(w, 1) / max(self.service_time.get(w, _default), 1e-3)
+            for w in _workers
+        )
+        _ahead = sum(
+            count
+            for (skill, prio), count in self.depth.items()
+            if skill == skill_required and prio <= priority
+        )
+        # Tasks ahead plus the ones being served, then this task itself.
+        return (_ahead + sum(self.slots.get(w, 1) for w in _workers)) / _rate
+
+    def admit(
+        self,
+        skill_required,
+        allowed_workers=None,
+        priority=1,
+        timeout=None,
+        queue_class="default",
+    ):
+        """Decide whether a task can be finished within `timeout` seconds.
+
+        Returns a dict with `admitted` and, for rejected tasks, a `message`
+        and `retry_after` (seconds) to hand back to the client.
+        """
+        try:
+            _expected = self.estimate_completion(
+                skill_required, allowed_workers, priority
+            )
+        except LookupError as e:
+            _expected, _message = None, str(e)
+            _retry_after = 30
+        else:
+            if _expected is None or timeout is None or _expected <= timeout:
+                return {"admitted": True, "expected_seconds": _expected}
+            _message = (
+                f"Overloaded: expected {_expected:.1f}s exceeds deadline of {timeout}s"
+            )
+            _retry_after = math.ceil(_expected - timeout)
+        self.wait_stats.setdefault(queue_class, WaitStats()).rejected += 1
+        return {
+            "admitted": False,
+            "message": _message,
+            "retry_after": max(1, _retry_after),
+            "expected_seconds": _expected,
+        }
+
+    def queue_stats(self):
+        stats = {
+            queue_class: {"queued": 0, **wait_stats.as_dict()}
+            for queue_class, wait_stats in self.wait_stats.items()
+        }
+        for task in self.tasks.values():
+            stats.setdefault(task.queue_class, {"queued": 0, **WaitStats().as_dict()})[
+                "queued"
+            ] += 1
+        return stats
 
 
 # Worker definition
 class Worker:
-    def __init__(self, worker_id, task_queue, skills):
+    def __init__(self, worker_id, task_queue, skills, max_concurrency=1):
         self.worker_id = worker_id
         self.task_queue = task_queue
         self.skills = skills
-        self.is_free = True
+        self.max_concurrency = max(1, max_concurrency)
+        self.running = {}  # task_id -> asyncio.Task of tasks in flight
+        self.free_slots = list(range(self.max_concurrency))
+        self.slot_stats = [
+            {"slot": slot, "busy": False, "tasks": 0, "busy_seconds": 0.0}
+            for slot in range(self.max_concurrency)
+        ]
+        self.started_at = time.monotonic()
+        self.task = None  # asyncio.Task running start(), set by the owner
+
+    @property
+    def is_free(self):
+        return len(self.running) < self.max_concurrency
 
     async def start(self):
+        event = self.task_queue.register_worker(
+            self.worker_id, self.skills, self.max_concurrency
+        )
         try:
             while True:
+                # Clear before checking, so a task enqueued while we run is not missed.
+                event.clear()
+                if not self.is_free:  # All slots busy, wait for one to finish
+                    await event.wait()
+                    continue
+
                 task_id, task_func = await self.task_queue.try_dequeue_task(
                     self.skills, self.worker_id
                 )
 
                 if not task_id:  # If no task matches the skills
-                    await self.task_queue.new_task_event.wait()
-                    self.task_queue.new_task_event.clear()
+                    await event.wait()
                     continue  # Go back and check the queue again
 
-                self.is_free = False
-                result = await task_func(
-                    self.worker_id
-                )  # Pass the worker_id to the task function
-                self.task_queue.results[task_id] = result
-                self.task_queue.result_events[
-                    task_id
-                ].set()  # Signal that the result is available
-                self.is_free = True
+                slot = self.free_slots.pop()
+                running = asyncio.create_task(self.run_task(task_id, task_func, slot))
+                self.running[task_id] = running
+                self.task_queue.attach(task_id, running)
+                running.add_done_callback(
+                    lambda _done, task_id=task_id, slot=slot: self.release(
+                        task_id, slot, event
+                    )
+                )
         except asyncio.CancelledError:
-            pass
+            for running in self.running.values():
+                running.cancel()
+        finally:
+            self.task_queue.unregister_worker(self.worker_id, event)
+
+    def update_skills(self, skills):
+        self.skills = skills
+        self.task_queue.update_worker_skills(self.worker_id, skills)
+
+    async def run_task(self, task_id, task_func, slot):
+        _stats = self.slot_stats[slot]
+        _stats["busy"] = True
+        _start = time.monotonic()
+        _succeeded = False
+        try:
+            result = await task_func(
+                self.worker_id
+            )  # Pass the worker_id to the task function
+            _succeeded = True
+        except Exception as e:
+            print(f"WARNING: Task {task_id} failed on '{self.worker_id}': {e!r}")
+            result = e  # handed to the waiter instead of letting it time out
+        except asyncio.CancelledError:
+            # The worker was stopped: fail the waiter now, not at its timeout.
+            _error = RuntimeError(f"Worker '{self.worker_id}' stopped")
+            self.task_queue.complete(task_id, _error)
+            raise
+        finally:
+            _elapsed = time.monotonic() - _start
+            _stats["busy"] = False
+            _stats["tasks"] += 1
+            _stats["busy_seconds"] += _elapsed
+            self.task_queue.task_done(task_id, _elapsed if _succeeded else None)
+        self.task_queue.complete(task_id, result)
+
+    def release(self, task_id, slot, event):
+        self.running.pop(task_id, None)
+        self.free_slots.append(slot)
+        event.set()  # a slot is free again
+
+    def stats(self):
+        _uptime = max(time.monotonic() - self.started_at, 1e-6)
+        return {
+            **self.task_queue.node_stats(self.worker_id),
+            "max_concurrency": self.max_concurrency,
+            "in_flight": len(self.running),
+            "slots": [
+                {
+                    **slot,
+                    "busy_seconds": round(slot["busy_seconds"], 2),
+                    "pct_utilization": round(slot["busy_seconds"] / _uptime * 100, 2),
+                }
+                for slot in self.slot_stats
+            ],
+        }
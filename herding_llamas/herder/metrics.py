@@ -0,0 +1,86 @@
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Prometheus metrics of the herder, served in text format on /metrics.
+# Counters and histograms are updated in memory as requests pass; gauges are
+# read from the queue and caches when scraped (HerderCollector).
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+QUEUE_WAIT = Histogram(
+    "herder_queue_wait_seconds",
+    "Time from enqueueing a request until a node picked it up",
+    ["prompt_key"],
+    buckets=LATENCY_BUCKETS,
+)
+NODE_LATENCY = Histogram(
+    "herder_node_request_seconds",
+    "Duration of inference calls to a node, streams until their last token",
+    ["node_key"],
+    buckets=LATENCY_BUCKETS,
+)
+NODE_RESPONSES = Counter(
+    "herder_node_responses",
+    "Inference responses per node and HTTP status",
+    ["node_key", "status"],
+)
+INPUT_TOKENS = Counter(
+    "herder_input_tokens", "Prompt tokens sent to a node", ["node_key"]
+)
+OUTPUT_TOKENS = Counter(
+    "herder_output_tokens",
+    "Tokens generated by a node, without the prompt",
+    ["node_key"],
+)
+MODEL_SWITCH = Histogram(
+    "herder_model_switch_seconds",
+    "From a model switch request until the node reported the model ready",
+    ["node_key"],
+    buckets=(5, 10, 30, 60, 120, 300, 600, 1800),
+)
+
+
+class HerderCollector:
+    def __init__(self, herder):
+        self.herder = herder
+
+    def collect(self):
+        _task_queue = self.herder.task_queue
+        depth = GaugeMetricFamily(
+            "herder_queue_depth", "Requests waiting for a node", labels=["prompt_key"]
+        )
+        _depth = dict.fromkeys(self.herder.prompter.prompts, 0)
+        for (skill, _priority), count in _task_queue.depth.items():
+            _depth[skill] = _depth.get(skill, 0) + count
+        for prompt_key, count in _depth.items():
+            depth.add_metric([prompt_key], count)
+        yield depth
+
+        in_flight = GaugeMetricFamily(
+            "herder_node_in_flight",
+            "Requests a node is working on for this herder",
+            labels=["node_key"],
+        )
+        for node_key, count in _task_queue.in_flight.items():
+            in_flight.add_metric([node_key], count)
+        yield in_flight
+
+        _cache_stats = self.herder.response_cache.stats
+        cache = CounterMetricFamily(
+            "herder_response_cache_lookups",
+            "Lookups of deterministic requests in the response cache",
+            labels=["result"],
+        )
+        cache.add_metric(["hit"], _cache_stats["hits"])
+        cache.add_metric(["miss"], _cache_stats["misses"])
+        yield cache
+
+        _flight_stats = self.herder.single_flight.stats
+        coalesced = CounterMetricFamily(
+            "herder_coalesced_requests",
+            "Identical requests in flight answered by one node call",
+            labels=["result"],
+        )
+        coalesced.add_metric(["called"], _flight_stats["calls"])
+        coalesced.add_metric(["shared"], _flight_stats["shared"])
+        yield coalesced
@@ -0,0 +1,155 @@
+import contextlib
+import httpx
+import os
+import time
+
+
+# Pooled, long-lived HTTP clients between the herder and its llama nodes
+class NodeClients:
+    def __init__(self):
+        self.clients = {}  # node_key -> (conf signature, httpx.AsyncClient)
+        self.stats = {}  # node_key -> request counters
+        self.leases = {}  # httpx.AsyncClient -> requests using it
+        self.retired = set()  # replaced clients, closed once their requests end
+
+    def get_header(self, llama: dict):
+        API_KEY_NAME = llama["API_KEY_NAME"]
+        API_KEY = os.environ.get(API_KEY_NAME, "")
+        return {API_KEY_NAME: API_KEY}
+
+    def _signature(self, conf):
+        # Settings the pooled client is built from; a change rebuilds it.
+        return (
+            conf["base_url"],
+            conf["API_KEY_NAME"],
+            conf.get("max_concurrency", 1),
+            conf.get("connect_timeout", 5.0),
+            conf.get("read_timeout", 120.0),
+            conf.get("keepalive_expiry", 60.0),
+        )
+
+    def _create(self, conf):
+        _concurrency = conf.get("max_concurrency", 1)
+        return httpx.AsyncClient(
+            base_url=conf["base_url"],
+            headers=self.get_header(conf),
+            limits=httpx.Limits(
+                # in-flight inferences plus room for discovery / control calls
+                max_connections=_concurrency + 2,
+                max_keepalive_connections=_concurrency + 2,
+                keepalive_expiry=conf.get("keepalive_expiry", 60.0),
+            ),
+            timeout=httpx.Timeout(
+                conf.get("read_timeout", 120.0),
+                connect=conf.get("connect_timeout", 5.0),
+            ),
+        )
+
+    async def get(self, node_key, conf):
+        _signature = self._signature(conf)
+        _entry = self.clients.get(node_key)
+        if _entry is not None and _entry[0] == _signature:
+            return _entry[1]
+        if _entry is not None:
+            # Requests in flight keep using the old client until they finish.
+            self.retired.add(_entry[1])
+            if not self.leases.get(_entry[1]):
+                await self._close(_entry[1])
+        print(f"INFO: Opening connection pool for '{node_key}' ({conf['base_url']})")
+        client = self._create(conf)
+        self.clients[node_key] = (_signature, client)
+        self.stats.setdefault(
+            node_key,
+            {
+                "requests": 0,
+                "errors": 0,
+                "in_flight": 0,
+                "sum_seconds": 0.0,
+            },
+        )
+        return client
+
+    async def _close(self, client):
+        self.retired.discard(client)
+        self.leases.pop(client, None)
+        await client.aclose()
+
+    @contextlib.asynccontextmanager
+    async def _lease(self, node_key, conf):
+        client = await self.get(node_key, conf)
+        self.leases[client] = self.leases.get(client, 0) + 1
+        try:
+            yield client
+        finally:
+            self.leases[client] -= 1
+            if client in self.retired and not self.leases[client]:
+                await self._close(client)
+
+    def _timeout(self, conf, kwargs):
+        # A plain number per call replaces the read timeout only.
+        _timeout = kwargs.get("timeout")
+        if isinstance(_timeout, (int, float)):
+            kwargs["timeout"] = httpx.Timeout(
+                _timeout, connect=conf.get("connect_timeout", 5.0)
+            )
+        return kwargs
+
+    @contextlib.contextmanager
+    def _track(self, node_key):
+        _stats = self.stats[node_key]
+        _stats["requests"] += 1
+        _stats["in_flight"] += 1
+        _start = time.monotonic()
+        try:
+            yield
+        except httpx.HTTPError:
+            _stats["errors"] += 1
+            raise
+        finally:
+            _stats["in_flight"] -= 1
+            _stats["sum_seconds"] += time.monotonic() - _start
+
+    async def request(self, node_key, conf, method, path, **kwargs):
+        async with self._lease(node_key, conf) as client:
+            with self._track(node_key):
+                return await client.request(method, path, **self._timeout(conf, kwargs))
+
+    @contextlib.asynccontextmanager
+    async def stream(self, node_key, conf, method, path, **kwargs):
+        """Like request(), but the body is read while it arrives."""
+        async with self._lease(node_key, conf) as client:
+            with self._track(node_key):
+                async with client.stream(
+                    method, path, **self._timeout(conf, kwargs)
+                ) as response:
+                    yield response
+
+    def pool_stats(self, node_key):
+        _stats = self.stats.get(node_key)
+        if _stats is None:
+            return {}
+        _connections = []
+        _entry = self.clients.get(node_key)
+        if _entry is not None:
+            # httpcore does not offer a public API for the pool state
+            _pool = getattr(_entry[1]._transport, "_pool", None)
+            _connections = getattr(_pool, "connections", [])
+        return {
+            "requests": _stats["requests"],
+            "errors": _stats["errors"],
+            "in_flight": _stats["in_flight"],
+            "average_seconds": (
+                round(_stats["sum_seconds"] / _stats["requests"], 3)
+                if _stats["requests"]
+                else 0.0
+            ),
+            "open_connections": len(_connections),
+            "idle_connections": len([c for c in _connections if c.is_idle()]),
+        }
+
+    async def close(self):
+        for _signature, client in self.clients.values():
+            await client.aclose()
+        for client in list(self.retired):
+            await self._close(client)
+        self.clients = {}
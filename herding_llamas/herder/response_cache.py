@@ -0,0 +1,101 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Cache of node responses for deterministic requests
+class ResponseCache:
+    def __init__(self, database=None, max_bytes=64 * 1024 * 1024, ttl_seconds=3600):
+        self.database = database  # optional SQLite persistence
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # key -> (expires_at, size, value), LRU first
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.writer = None
+        if database is not None:
+            # Lookups stay in memory; the database is filled at startup and
+            # written behind by one thread, off the event loop.
+            self.writer = ThreadPoolExecutor(max_workers=1)
+            for row in database.load_cached_responses():
+                self._store(row["cache_key"], row["value"], row["expires_at"])
+
+    def make_key(self, model_name, infer_input, param):
+        return hashlib.sha256(
+            json.dumps([model_name, infer_input, param or {}], sort_keys=True).encode()
+        ).hexdigest()
+
+    def get(self, model_names, infer_input, param):
+        """Cached response of the first model in `model_names` that has one."""
+        _now = time.time()
+        for model_name in model_names:
+            key = self.make_key(model_name, infer_input, param)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < _now:
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[2]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, model_name, infer_input, param, value):
+        key = self.make_key(model_name, infer_input, param)
+        _expires_at = time.time() + self.ttl_seconds
+        self._store(key, value, _expires_at)
+        if self.writer is not None:
+            self.writer.submit(self._persist, key, model_name, value, _expires_at)
+
+    def close(self):
+        """Waits for the pending writes."""
+        if self.writer is not None:
+            self.writer.shutdown(wait=True)
+
+    def _persist(self, key, model_name, value, expires_at):
+        try:
+            self.database.put_cached_response(key, model_name, value, expires_at)
+        except Exception as e:
+            print(f"WARNING: Could not persist cached response: {e!r}")
+
+    def _delete(self, key):
+        try:
+            self.database.delete_cached_response(key)
+        except Exception as e:
+            print(f"WARNING: Could not delete cached response: {e!r}")
+
+    def _store(self, key, value, expires_at):
+        _size = len(json.dumps(value))
+        if _size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._evict(key)
+        self.entries[key] = (expires_at, _size, value)
+        self.bytes += _size
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+
+    def _evict(self, key):
+        _expires_at, _size, _value = self.entries.pop(key)
+        self.bytes -= _size
+
+    def _drop(self, key):
+        # Evicted or expired: its row goes too, so the table stays as small
+        # as the cache and restarts only load what fits.
+        self._evict(key)
+        if self.writer is not None:
+            self.writer.submit(self._delete, key)
+
+    def cache_stats(self):
+        _lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": round(self.stats["hits"] / _lookups, 3) if _lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
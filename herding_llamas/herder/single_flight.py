@@ -0,0 +1,33 @@
+import asyncio
+
+
+# Share one in-flight call between concurrent callers asking for the same key
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}  # key -> {"task": asyncio.Task, "waiters": int}
+        self.stats = {"calls": 0, "shared": 0}
+
+    async def do(self, key, func):
+        """Await func() once per key; returns (result, shared)."""
+        call = self.calls.get(key)
+        shared = call is not None
+        if call is None:
+            call = {"task": asyncio.create_task(func()), "waiters": 0}
+            self.calls[key] = call
+            # Once done, the next caller starts a fresh call.
+            call["task"].add_done_callback(lambda _task: self._done(key, call))
+            self.stats["calls"] += 1
+        else:
+            self.stats["shared"] += 1
+        call["waiters"] += 1
+        try:
+            # shield: one caller giving up must not cancel it for the others
+            return await asyncio.shield(call["task"]), shared
+        finally:
+            call["waiters"] -= 1
+            if call["waiters"] == 0 and not call["task"].done():
+                call["task"].cancel()  # nobody is interested any more
+
+    def _done(self, key, call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
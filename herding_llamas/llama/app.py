@@ -1,20 +1,42 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
 from starlette.requests import Request
 
 import logging
 import yaml
 import pprint
+import json
 import os
+import time
 
-from model import LanguageModel
+from executor import InferenceExecutor, QueueFull
+from metrics import LlamaCollector, observe_response
+from model import LanguageModel, NotResident
 from sys_stats import SystemStats
 
 
 class Llama(LanguageModel):
     def __init__(self):
         self.load_conf()
-        self.system_stats = SystemStats()
+        self.system_stats = SystemStats(
+            **self.conf.get("system_stats", {}), node_stats=self.node_stats
+        )
+        self.executor = InferenceExecutor(**self.conf.get("executor", {}))
         LanguageModel.__init__(self)
+        self.tokens_sampled = (time.time(), self.generated_tokens)
+        self.system_stats.start()
+
+    def node_stats(self):
+        """Throughput and backlog, recorded with every system stats sample."""
+        _now, _tokens = time.time(), self.generated_tokens
+        _then, _tokens_then = self.tokens_sampled
+        self.tokens_sampled = (_now, _tokens)
+        return {
+            "tokens_per_second": (_tokens - _tokens_then) / max(_now - _then, 1e-9),
+            "queued": self.executor.queued,
+            "running": self.executor.running,
+        }
 
     def load_conf(self):
         with open("conf.yml") as f:
@@ -22,6 +44,7 @@ class Llama(LanguageModel):
 
 
 llama = Llama()
+REGISTRY.register(LlamaCollector(llama))
 
 logging.basicConfig(level=logging.INFO)
 
@@ -45,31 +68,157 @@ def get_api_key(request: Request):
 @app.get("/api/v1/models")
 async def api_get_models(api_key: str = Depends(get_api_key)):
     _models = [
-        {"option": key, "selected": key == llama.loaded_model}
+        {
+            "option": key,
+            "selected": key == llama.loaded_model,
+            "resident": key in llama.models,
+        }
         for key, value in llama.conf["models"].items()
     ]
     _system_stats = llama.system_stats.collect_system_stats()
     return {
         "models": _models,
         "loaded_model": llama.loaded_model,
+        "resident_models": llama.resident_stats(),  # kept loaded, LRU first
+        "load_status": llama.load_status(),
         "system_stats": _system_stats,
+        "batching": llama.batcher.stats,
+        "queue": llama.executor.stats(),  # the herder routes on this backlog
     }
 
 
 @app.post("/api/v1/load_model")
 async def api_load_model(data: dict, api_key: str = Depends(get_api_key)):
+    """Starts loading in the background, the current model keeps serving.
+    Poll /api/v1/load_status until it reports "ready"."""
     print("DATA:", data)
-    _result = llama.load_model(data["model_key"])
+    try:
+        _result = llama.start_load(data["model_key"])
+    except KeyError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
     return _result
 
 
+@app.get("/api/v1/load_status")
+async def api_load_status(api_key: str = Depends(get_api_key)):
+    return llama.load_status()
+
+
+def apply_deadline(request: Request, data: dict):
+    # Time budget left for this request, as forwarded by the herder
+    _deadline_seconds = request.headers.get("X-Deadline-Seconds")
+    if _deadline_seconds is not None:
+        data["max_time"] = float(_deadline_seconds)
+        if data["max_time"] <= 0:
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail="Deadline passed before inference started",
+            )
+
+
+def queue_full(e: QueueFull):
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=f"Inference queue full: {e}",
+        headers={"Retry-After": "1"},
+    )
+
+
+def not_resident(e: NotResident):
+    # Loading on request would stall the node: the herder switches models first
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail=f"{e} with /api/v1/load_model",
+    )
+
+
+def server_timing(timings: dict):
+    # Server-Timing header value, durations in milliseconds
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()
+    )
+
+
 @app.post("/api/v1/infer")
-async def api_infer(data: dict, api_key: str = Depends(get_api_key)):
+async def api_infer(
+    request: Request,
+    response: Response,
+    data: dict,
+    api_key: str = Depends(get_api_key),
+):
     pprint.pprint(data, width=120)
-    _response = llama.infer(data=data)
+    apply_deadline(request, data)
+    _start = time.time()
+    try:
+        # Concurrent requests meet in the batcher on the inference threads
+        _response = await llama.executor.run(llama.infer, data)
+    except QueueFull as e:
+        raise queue_full(e)
+    except KeyError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except NotResident as e:
+        raise not_resident(e)
+    observe_response(_response)
+    # including the wait for an inference thread
+    _response["timings"]["total"] = round(time.time() - _start, 4)
+    response.headers["Server-Timing"] = server_timing(_response["timings"])
     return _response
 
 
+async def prepend(first, chunks):
+    yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+@app.post("/api/v1/infer_stream")
+async def api_infer_stream(
+    request: Request, data: dict, api_key: str = Depends(get_api_key)
+):
+    pprint.pprint(data, width=120)
+    apply_deadline(request, data)
+    _chunks = llama.executor.stream(llama.infer_stream, data)
+    try:
+        _first_chunk = await _chunks.__anext__()
+    except QueueFull as e:
+        raise queue_full(e)
+    except KeyError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except NotResident as e:
+        raise not_resident(e)
+
+    # One JSON object per line: {"token": ...} chunks, then {"done": true, ...}
+    async def ndjson_lines():
+        try:
+            async for chunk in prepend(_first_chunk, _chunks):
+                if chunk.get("done"):
+                    observe_response(chunk)
+                yield json.dumps(chunk) + "\n"
+        finally:
+            await _chunks.aclose()  # the client went away: stop generating
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+
+@app.get("/metrics")
+async def api_metrics():
+    # Prometheus text format; no API key, so restrict access on the network level
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/api/v1/telemetry")
+async def api_telemetry(
+    minutes: float = 15, points: int = 60, api_key: str = Depends(get_api_key)
+):
+    """System stats, load and tokens/s of the last `minutes`, averaged into
+    `points` buckets (None where no sample fell into one)."""
+    if minutes <= 0 or not 1 <= points <= 1000:
+        raise HTTPException(status_code=400, detail="Invalid minutes or points")
+    return llama.system_stats.history(minutes, points)
+
+
 @app.get("/api/v1/system_stats")
 async def api_system_stats(api_key: str = Depends(get_api_key)):
     _response = llama.system_stats.collect_system_stats()
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFull(Exception):
+    pass
+
+
+# Runs blocking inferences on dedicated threads, so the event loop keeps
+# answering control endpoints (/api/v1/models, /api/v1/system_stats).
+class InferenceExecutor:
+    def __init__(self, max_workers=8, max_queue=32):
+        self.max_workers = max_workers  # match batching.max_batch_size
+        self.max_queue = max_queue  # waiting requests beyond that are rejected
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix="inference")
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.rejected = 0
+
+    def submit(self, func, *args):
+        with self.lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(f"{self.queued} inferences waiting")
+            self.queued += 1
+        return self.pool.submit(self._call, func, *args)
+
+    def _call(self, func, *args):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    async def run(self, func, *args):
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    async def stream(self, func, *args):
+        """Iterate the blocking generator func(*args) on an inference thread.
+
+        Closing this iterator early closes the generator at its next chunk.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        closed = threading.Event()
+
+        def produce():
+            if closed.is_set():  # gone while queued
+                return
+            generator = func(*args)
+            try:
+                for chunk in generator:
+                    if closed.is_set():
+                        break
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            finally:
+                generator.close()
+
+        future = self.submit(produce)
+        future.add_done_callback(
+            lambda _future: loop.call_soon_threadsafe(chunks.put_nowait, None)
+        )
+        try:
+            while (chunk := await chunks.get()) is not None:
+                yield chunk
+            future.result()  # raises what the generator raised
+        finally:
+            closed.set()
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "rejected": self.rejected,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+        }
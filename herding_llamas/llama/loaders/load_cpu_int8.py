@@ -0,0 +1,44 @@
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers.pytorch_utils import Conv1D
+
+
+def set_cpu_threads(llama):
+    # Per model settings win over the node wide `cpu` section of conf.yml
+    _cpu = {**llama.conf.get("cpu", {}), **llama.model_conf.get("cpu", {})}
+    if _cpu.get("num_threads"):
+        torch.set_num_threads(_cpu["num_threads"])
+    if _cpu.get("num_interop_threads"):
+        try:
+            torch.set_num_interop_threads(_cpu["num_interop_threads"])
+        except RuntimeError as e:
+            # can only be set before the first parallel work, i.e. once
+            print(f"WARNING: Keeping inter-op threads: {e}")
+
+
+def conv1d_to_linear(model):
+    # GPT-2 style models keep most weights in transformers' Conv1D, a Linear
+    # with transposed weights that quantize_dynamic does not know.
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                linear = torch.nn.Linear(*child.weight.shape)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, name, linear)
+    return model
+
+
+def load_cpu_int8(llama, model_key):
+    set_cpu_threads(llama)
+    llama.tokenizer = AutoTokenizer.from_pretrained(llama.model_conf["path"])
+    model = AutoModelForCausalLM.from_pretrained(
+        llama.model_conf["path"],
+        trust_remote_code=llama.model_conf.get("trust_remote_code", False),
+        torch_dtype=torch.float32,
+    )
+    # int8 weights for all linear layers, activations quantized on the fly
+    llama.model = torch.ao.quantization.quantize_dynamic(
+        conv1d_to_linear(model.eval()), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return {"loaded": model_key}
@@ -0,0 +1,113 @@
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Prometheus metrics of a llama node, served in text format on /metrics.
+# Per-inference figures are taken from each response; the executor, batcher,
+# caches and model pool are read when scraped (LlamaCollector).
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+INFERENCE_LATENCY = Histogram(
+    "llama_inference_seconds",
+    "Duration of an inference on the node, from batching until the last token",
+    ["model_key"],
+    buckets=LATENCY_BUCKETS,
+)
+FIRST_TOKEN_LATENCY = Histogram(
+    "llama_time_to_first_token_seconds",
+    "Time until the first token was generated",
+    ["model_key"],
+    buckets=LATENCY_BUCKETS,
+)
+INPUT_TOKENS = Counter("llama_input_tokens", "Prompt tokens", ["model_key"])
+OUTPUT_TOKENS = Counter("llama_output_tokens", "Generated tokens", ["model_key"])
+DRAFT_TOKENS = Counter(
+    "llama_draft_tokens",
+    "Tokens proposed by draft models, and how many of them were accepted",
+    ["model_key", "result"],
+)
+
+
+def observe_response(response: dict):
+    _model_key = response["model_name"]
+    INFERENCE_LATENCY.labels(_model_key).observe(response["elapsed_seconds"])
+    FIRST_TOKEN_LATENCY.labels(_model_key).observe(response["time_to_first_token"])
+    INPUT_TOKENS.labels(_model_key).inc(response["input_tokens"])
+    # output_tokens includes the prompt
+    OUTPUT_TOKENS.labels(_model_key).inc(
+        response["output_tokens"] - response["input_tokens"]
+    )
+    if "draft_tokens" in response:
+        DRAFT_TOKENS.labels(_model_key, "accepted").inc(
+            response["draft_accepted_tokens"]
+        )
+        DRAFT_TOKENS.labels(_model_key, "rejected").inc(
+            response["draft_tokens"] - response["draft_accepted_tokens"]
+        )
+
+
+class LlamaCollector:
+    def __init__(self, llama):
+        self.llama = llama
+
+    def collect(self):
+        _queue = self.llama.executor.stats()
+        executor = GaugeMetricFamily(
+            "llama_executor_requests",
+            "Inferences waiting for or running on an inference thread",
+            labels=["state"],
+        )
+        executor.add_metric(["queued"], _queue["queued"])
+        executor.add_metric(["running"], _queue["running"])
+        yield executor
+        yield CounterMetricFamily(
+            "llama_executor_rejected",
+            "Inferences rejected because the queue was full",
+            value=_queue["rejected"],
+        )
+
+        _batching = self.llama.batcher.stats
+        yield CounterMetricFamily(
+            "llama_batches", "generate calls of the batcher", value=_batching["batches"]
+        )
+        yield CounterMetricFamily(
+            "llama_batched_requests",
+            "Requests run through the batcher",
+            value=_batching["requests"],
+        )
+
+        load_seconds = GaugeMetricFamily(
+            "llama_model_load_seconds",
+            "Duration of the last load of a model",
+            labels=["model_key"],
+        )
+        for model_key, seconds in self.llama.load_seconds.items():
+            load_seconds.add_metric([model_key], seconds)
+        yield load_seconds
+
+        memory = GaugeMetricFamily(
+            "llama_resident_model_bytes",
+            "Memory of the models kept loaded",
+            labels=["model_key"],
+        )
+        prefix_lookups = CounterMetricFamily(
+            "llama_prefix_cache_lookups",
+            "Lookups of shared prompt prefixes in a model's attention cache",
+            labels=["model_key", "result"],
+        )
+        prefix_tokens = CounterMetricFamily(
+            "llama_prefix_cache_reused_tokens",
+            "Prompt tokens not computed again thanks to the prefix cache",
+            labels=["model_key"],
+        )
+        for model_key, resident in list(self.llama.models.items()):
+            memory.add_metric([model_key], self.llama.model_bytes.get(model_key, 0))
+            _stats = resident.prefix_cache.stats
+            prefix_lookups.add_metric([model_key, "hit"], _stats["hits"])
+            prefix_lookups.add_metric(
+                [model_key, "miss"], _stats["lookups"] - _stats["hits"]
+            )
+            prefix_tokens.add_metric([model_key], _stats["tokens_reused"])
+        yield memory
+        yield prefix_lookups
+        yield prefix_tokens
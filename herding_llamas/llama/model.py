@@ -2,84 +2,393 @@ import torch
 from transformers import (
     StoppingCriteria,
     StoppingCriteriaList,
+    TextIteratorStreamer,
 )
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from threading import Event, Lock, Thread, get_ident
+import copy
 import json
+import queue
 import time
 
 
 import gc  # garbage collection when switching models
 
 
+class NotResident(Exception):
+    pass
+
+
+class StopWords:
+    """Stop sequences compiled into one right-aligned tensor, so all of them
+    are checked against every row of a batch in a single operation."""
+
+    def __init__(self, sequences: list, device):
+        sequences = [seq for seq in sequences if len(seq) > 0]
+        self.length = max([len(seq) for seq in sequences], default=1)
+        self.ids = torch.zeros(
+            (len(sequences), self.length), dtype=torch.long, device=device
+        )
+        self.mask = torch.zeros(
+            (len(sequences), self.length), dtype=torch.bool, device=device
+        )
+        for i, seq in enumerate(sequences):
+            self.ids[i, self.length - len(seq) :] = seq
+            self.mask[i, self.length - len(seq) :] = True
+
+    def matches(self, input_ids: torch.LongTensor):
+        """One flag per row: does it end with any of the stop sequences?"""
+        if len(self.ids) == 0:
+            return torch.zeros(
+                input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+            )
+        window = input_ids[:, -self.length :]
+        if window.shape[1] < self.length:
+            # shorter than the longest stop sequence: -1 never matches an id
+            window = torch.nn.functional.pad(
+                window, (self.length - window.shape[1], 0), value=-1
+            )
+        hits = (window[:, None, :] == self.ids[None]) | ~self.mask[None]
+        return hits.all(dim=2).any(dim=1)
+
+
 class StoppingCriteriaSub(StoppingCriteria):
-    def __init__(self, stops=[], encounters=1):
+    def __init__(self, stop_words: StopWords):
         super().__init__()
-        self.stops = [stop.to("cuda") for stop in stops]
+        self.stop_words = stop_words
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
-        for stop in self.stops:
-            if torch.all((stop == input_ids[0][-len(stop) :])).item():
-                return True
+        # One flag per sequence, so a batch stops each request on its own
+        return self.stop_words.matches(input_ids)
 
+
+class FirstTokenTimer(StoppingCriteria):
+    # Called once per generated token, only notes when the first one arrived.
+    # Also collects the durations of the request's stages, in seconds.
+    def __init__(self):
+        super().__init__()
+        self.first_token_time = None
+        self.spans = {}
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
         return False
 
 
+class CancelFlag(StoppingCriteria):
+    # Stops the generation once set, e.g. when a stream's client went away.
+    def __init__(self):
+        super().__init__()
+        self.event = Event()
+
+    def set(self):
+        self.event.set()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        return self.event.is_set()
+
+
+class DraftCounter(StoppingCriteria):
+    """Counts the tokens a draft model proposed and the verification steps of
+    the main model during one assisted generation."""
+
+    def __init__(self, draft_model):
+        super().__init__()
+        self.draft_model = draft_model
+        self.drafted = 0
+        self.steps = 0
+
+    def __enter__(self):
+        # Entered by the generating thread: concurrent generations draft too
+        _thread = get_ident()
+
+        def count(module, args, output):
+            if get_ident() == _thread:
+                self.drafted += 1  # one forward pass per proposed token
+
+        self.hook = self.draft_model.register_forward_hook(count)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.hook.remove()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        self.steps += 1
+        return torch.zeros(
+            input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+        )
+
+    def stats(self, num_new_tokens):
+        # Every verification step adds one token of the main model's own
+        _accepted = max(0, num_new_tokens - self.steps)
+        return {
+            "draft_tokens": self.drafted,
+            "draft_accepted_tokens": _accepted,
+            "draft_acceptance_rate": (
+                round(_accepted / self.drafted, 3) if self.drafted else 0.0
+            ),
+        }
+
+
+class ResidentModel:
+    """A model with its tokenizer, as filled in by the loaders."""
+
+    def __init__(self, model_key, conf):
+        self.model_key = model_key
+        self.conf = conf
+        self.model_conf = conf["models"][model_key]
+        self.model = None
+        self.tokenizer = None
+        self.stop_words_cache = {}
+        self.draft = None  # ResidentModel proposing tokens, see `draft_model`
+        self.prefix_cache = PrefixCache(**conf.get("prefix_cache", {}))
+        self.last_used = time.time()
+
+    def memory_bytes(self):
+        _tensors = list(self.model.parameters()) + list(self.model.buffers())
+        _draft_bytes = self.draft.memory_bytes() if self.draft is not None else 0
+        return sum(t.numel() * t.element_size() for t in _tensors) + _draft_bytes
+
+    def compile_stop_words(self, stop_words: list):
+        """Tokenized stop sequences, compiled once per model and list."""
+        _key = tuple(stop_words)
+        if _key not in self.stop_words_cache:
+            _sequences = []
+            for stop_word in stop_words:
+                _ids = self.tokenizer(
+                    stop_word, add_special_tokens=False, return_tensors="pt"
+                ).input_ids[0]
+                # Workaround to cut out <s>
+                _sequences += [_ids, _ids[1:]]
+            self.stop_words_cache[_key] = StopWords(_sequences, self.model.device)
+        return self.stop_words_cache[_key]
+
+
 class ModelLoaders:
     def load(self, model_key):
-        self.model_conf = self.conf["models"][model_key]
-        custom_loader = self.model_conf.get("custom_loader", "default")
+        resident = ResidentModel(model_key, self.conf)
+        custom_loader = resident.model_conf.get("custom_loader", "load_default")
 
         # Dynamic loading of custom loaders
         module = __import__(f"loaders.{custom_loader}", fromlist=[custom_loader])
         load_func = getattr(module, custom_loader)
-        return load_func(self, model_key)
+        load_func(resident, model_key)
+        return resident
 
 
 class LanguageModel(ModelLoaders):
     def __init__(self):
+        self.models = OrderedDict()  # model_key -> ResidentModel, LRU first
+        self.model_bytes = {}  # model_key -> memory measured at its last load
+        self.pool_lock = Lock()  # guards self.models
+        self.load_lock = Lock()  # one load at a time
+        self.load_seconds = {}  # model_key -> duration of its last load
+        self.load_job = None  # background model switch, see start_load
+        self.load_job_lock = Lock()  # guards starting a load_job
+        self.generated_tokens = 0  # since startup, sampled as tokens/s
+        self.generated_tokens_lock = Lock()
         self.loaded_model = self.conf["startup_model"]
         self.load_model(self.loaded_model)
+        self.batcher = BatchScheduler(self, **self.conf.get("batching", {}))
+
+    @property
+    def model(self):
+        return self.models[self.loaded_model].model
+
+    @property
+    def tokenizer(self):
+        return self.models[self.loaded_model].tokenizer
 
     def load_model(self, model_key):
-        print("garbage collection..")
-        if hasattr(self, "model"):
-            del self.model
-        gc.collect()
-        torch.cuda.empty_cache()
-        # init
+        """Make `model_key` the default model; a pointer swap if it is resident.
+
+        The current default keeps serving while the new model loads (both are
+        resident for a moment), then requests switch over at once.
+        """
+        _was_resident = model_key in self.models
+        self.resident(model_key, keep=self.loaded_model)
         self.loaded_model = model_key
-        loaded = self.load(model_key)
-        return loaded
+        # the previous default may not fit the budget any more
+        self.evict(keep=model_key)
+        return {
+            "loaded": model_key,
+            "was_resident": _was_resident,
+            "resident_models": list(self.models),
+        }
 
-    def infer(self, data: dict):
-        start_time = time.time()
+    def start_load(self, model_key):
+        """Switch the default model in a background thread; see load_status."""
+        if model_key not in self.conf["models"]:
+            raise KeyError(f"Unknown model '{model_key}'")
+        with self.load_job_lock:
+            if self.load_job is not None and self.load_job["status"] == "loading":
+                if self.load_job["model_key"] == model_key:
+                    return self.load_status()
+                raise RuntimeError(f"Still loading '{self.load_job['model_key']}'")
+            self.load_job = {
+                "model_key": model_key,
+                "status": "loading",
+                "started_at": time.time(),
+                "finished_at": None,
+                "error": None,
+            }
+            Thread(target=self.run_load, args=(self.load_job,), daemon=True).start()
+        return self.load_status()
 
-        infer_input = data.get("infer_input", "NOTHING")
-        param = data.get("param", {})
-        _stop_words_ids = [
-            self.tokenizer(
-                stop_word,
-                add_special_tokens=False,
-                return_tensors="pt",
+    def run_load(self, job):
+        try:
+            job["result"] = self.load_model(job["model_key"])
+            job["status"] = "ready"
+        except Exception as e:
+            print(f"WARNING: Loading '{job['model_key']}' failed: {e!r}")
+            job["status"] = "failed"
+            job["error"] = repr(e)
+        job["finished_at"] = time.time()
+
+    def load_status(self):
+        if self.load_job is None:
+            return {"status": "ready", "model_key": self.loaded_model, "progress": 1.0}
+        _job = dict(self.load_job)
+        if _job["status"] == "loading":
+            # No progress hooks in from_pretrained: estimate from the last load
+            _expected = self.load_seconds.get(_job["model_key"])
+            _elapsed = time.time() - _job["started_at"]
+            _job["progress"] = (
+                round(min(0.99, _elapsed / _expected), 2) if _expected else None
             )
-            .input_ids.cuda()
-            .squeeze()
-            for stop_word in param.get("stop_words", [])
-        ]
-        # Workaround to cut out <s>
-        _stop_words_ids = _stop_words_ids + [x[1:] for x in _stop_words_ids]
+        else:
+            _job["progress"] = 1.0 if _job["status"] == "ready" else None
+        return _job
+
+    def resident(self, model_key=None, keep=None):
+        """The model named `model_key` (default: the loaded one), loaded on demand.
+
+        Loading never unloads `keep`.
+        """
+        model_key = model_key or self.loaded_model
+        if model_key not in self.conf["models"]:
+            raise KeyError(f"Unknown model '{model_key}'")
+        with self.pool_lock:
+            resident = self.models.get(model_key)
+            if resident is not None:
+                self.models.move_to_end(model_key)
+                resident.last_used = time.time()
+                return resident
+        with self.load_lock:
+            with self.pool_lock:
+                resident = self.models.get(model_key)
+            if resident is None:  # nobody loaded it while we waited
+                self.evict(incoming_bytes=self.estimate_bytes(model_key), keep=keep)
+                print(f"INFO: Loading model '{model_key}'")
+                _start = time.time()
+                resident = self.load(model_key)
+                _draft_key = resident.model_conf.get("draft_model")
+                if _draft_key:
+                    # loaded and unloaded together with the model it serves
+                    print(f"INFO: Loading draft model '{_draft_key}'")
+                    resident.draft = self.load(_draft_key)
+                resident.compile_stop_words(resident.model_conf.get("stop_words", []))
+                self.load_seconds[model_key] = time.time() - _start
+                self.model_bytes[model_key] = resident.memory_bytes()
+                with self.pool_lock:
+                    self.models[model_key] = resident
+                self.evict(keep=keep)
+            return resident
+
+    def serving(self, model_key=None):
+        """The resident model named `model_key` (default: the loaded one).
+
+        Requests never load a model: the load would stall the node and could
+        evict its default model. Models are loaded with start_load.
+        """
+        model_key = model_key or self.loaded_model
+        if model_key not in self.conf["models"]:
+            raise KeyError(f"Unknown model '{model_key}'")
+        with self.pool_lock:
+            resident = self.models.get(model_key)
+            if resident is None:
+                raise NotResident(f"Model '{model_key}' is not resident, load it first")
+            self.models.move_to_end(model_key)
+            resident.last_used = time.time()
+            return resident
+
+    def estimate_bytes(self, model_key):
+        """Memory of a model plus what its prefix cache may grow to."""
+        _model_conf = self.conf["models"][model_key]
+        _memory_gb = _model_conf.get("memory_gb", 0)
+        _prefix_gb = self.conf.get("prefix_cache", {}).get("max_memory_gb", 2)
+        if _model_conf.get("draft_model"):
+            _prefix_gb = 0  # assisted generation does not use the prefix cache
+        return (
+            self.model_bytes.get(model_key, _memory_gb * 1024**3) + _prefix_gb * 1024**3
+        )
+
+    def evict(self, incoming_bytes=None, keep=None):
+        """Unload least recently used models (never `keep`) until the pool, plus
+        an incoming model if given, fits `model_pool` in conf.yml. Memory
+        includes the prefix cache budget of each model."""
+        _conf = self.conf.get("model_pool", {})
+        _max_models = _conf.get("max_models", 1)
+        _max_bytes = _conf.get("max_memory_gb", float("inf")) * 1024**3
+        _incoming = 0 if incoming_bytes is None else 1
+        _evicted = []
+        with self.pool_lock:
+            while True:
+                # least recently used first, the newest model always stays
+                _candidates = [
+                    key
+                    for key in list(self.models)[: len(self.models) - 1 + _incoming]
+                    if key != keep
+                ]
+                _bytes = sum(self.estimate_bytes(key) for key in self.models)
+                if not _candidates or (
+                    len(self.models) + _incoming <= _max_models
+                    and _bytes + (incoming_bytes or 0) <= _max_bytes
+                ):
+                    break
+                _evicted.append(self.models.pop(_candidates[0]))
+        for resident in _evicted:
+            print(f"INFO: Evicting model '{resident.model_key}'")
+        if _evicted:
+            del _evicted, resident
+            print("garbage collection..")
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
 
-        ## uncomment here to debug non-stopping prompts
-        # print('STOP WORDS IDS:',_stop_words_ids)
-        # for x in _stop_words_ids:
-        #     print(f'STOP WORD: "{x}" -->"{self.tokenizer.decode(x)}"<--')
+    def resident_stats(self):
+        return [
+            {
+                "model_key": key,
+                "memory_gb": round(self.model_bytes.get(key, 0) / 1024**3, 2),
+                "device": str(resident.model.device),
+                "last_used": resident.last_used,
+                "prefix_cache": resident.prefix_cache.cache_stats(),
+            }
+            for key, resident in self.models.items()
+        ]
 
+    def prepare_generate(self, resident: ResidentModel, data: dict):
+        infer_input = data.get("infer_input", "NOTHING")
+        param = data.get("param", {})
+        _first_token_timer = FirstTokenTimer()
         _stopping_criteria = StoppingCriteriaList(
-            [StoppingCriteriaSub(stops=_stop_words_ids)]
+            [
+                StoppingCriteriaSub(
+                    resident.compile_stop_words(param.get("stop_words", []))
+                ),
+                _first_token_timer,
+            ]
         )
 
-        input_ids = self.tokenizer(infer_input, return_tensors="pt").input_ids.cuda()
-        num_input_tokens = input_ids.shape[1]
-        output = self.model.generate(
+        _start = time.time()
+        input_ids = resident.tokenizer(infer_input, return_tensors="pt").input_ids.to(
+            resident.model.device
+        )
+        _first_token_timer.spans["tokenize"] = time.time() - _start
+        generate_kwargs = dict(
             inputs=input_ids,
             stopping_criteria=_stopping_criteria,
             temperature=param.get("temperature", 0.7),
@@ -95,9 +404,17 @@ class LanguageModel(ModelLoaders):
             num_beams=param.get("num_beams", 1),
             penalty_alpha=param.get("penalty_alpha", 0),
             length_penalty=param.get("length_penalty", 1.0),
+            max_time=data.get("max_time"),  # stop generating once the caller gave up
         )
-        num_output_tokens = output.shape[1]
-        output_str = self.tokenizer.decode(output[0])
+        return infer_input, generate_kwargs, _first_token_timer
+
+    def build_response(
+        self, resident, infer_input, input_ids, output, start_time, timer
+    ):
+        num_input_tokens = input_ids.shape[1]
+        num_output_tokens = output.shape[1]  # includes the input tokens
+        _decode_start = time.time()
+        output_str = resident.tokenizer.decode(output[0])
         output_str = (
             output_str.replace(infer_input, "")
             .replace("<s>", "")
@@ -106,11 +423,406 @@ class LanguageModel(ModelLoaders):
         )
         end_time = time.time()
         elapsed_seconds = end_time - start_time
+        num_new_tokens = num_output_tokens - num_input_tokens
+        with self.generated_tokens_lock:
+            self.generated_tokens += num_new_tokens
 
         return {
             "response": output_str,
             "input_tokens": num_input_tokens,
             "output_tokens": num_output_tokens,
             "elapsed_seconds": elapsed_seconds,
-            "model_name": self.loaded_model,
+            "time_to_first_token": (timer.first_token_time or end_time) - start_time,
+            "tokens_per_second": (
+                num_new_tokens / elapsed_seconds if elapsed_seconds else 0.0
+            ),
+            "model_name": resident.model_key,
+            "timings": {
+                name: round(seconds, 4)
+                for name, seconds in {
+                    **timer.spans,
+                    "decode": end_time - _decode_start,
+                }.items()
+            },
         }
+
+    def infer(self, data: dict):
+        # Requests name their model, or get the default one at arrival
+        data["model_key"] = data.get("model_key") or self.loaded_model
+        data["queued_at"] = time.time()  # waiting for its batch from here
+        return self.batcher.submit(data)
+
+    def infer_one(self, data: dict):
+        start_time = time.time()
+        _resident = self.serving(data.get("model_key"))
+        infer_input, generate_kwargs, timer = self.prepare_generate(_resident, data)
+        if "queued_at" in data:
+            timer.spans["batch_wait"] = start_time - data["queued_at"]
+        _generate_start = time.time()
+        _reused = self.reuse_prefix(_resident, generate_kwargs)
+        _draft_counter = self.assist(_resident, generate_kwargs)
+        with _draft_counter or nullcontext():
+            output = _resident.model.generate(**generate_kwargs)
+        timer.spans["generate"] = time.time() - _generate_start
+        return self.finish_response(
+            _resident,
+            infer_input,
+            generate_kwargs["inputs"],
+            output,
+            start_time,
+            timer,
+            _reused,
+            _draft_counter,
+        )
+
+    def assist(self, resident, generate_kwargs):
+        """Let the resident's draft model propose tokens for its main model to
+        verify (assisted generation); returns the DraftCounter, if any."""
+        if resident.draft is None:
+            return None
+        _draft_counter = DraftCounter(resident.draft.model)
+        generate_kwargs["assistant_model"] = resident.draft.model
+        generate_kwargs["stopping_criteria"].append(_draft_counter)
+        return _draft_counter
+
+    def finish_response(
+        self,
+        resident,
+        infer_input,
+        input_ids,
+        output,
+        start_time,
+        timer,
+        prefix_tokens_reused,
+        draft_counter,
+    ):
+        response = self.build_response(
+            resident, infer_input, input_ids, output, start_time, timer
+        )
+        response["prefix_tokens_reused"] = prefix_tokens_reused
+        if draft_counter is not None:
+            response.update(
+                draft_counter.stats(
+                    response["output_tokens"] - response["input_tokens"]
+                )
+            )
+        return response
+
+    def reuse_prefix(self, resident, generate_kwargs):
+        """Start generation from the cached attention state of a shared prompt
+        prefix; returns the number of prompt tokens not computed again."""
+        if resident.prefix_cache.max_bytes <= 0 or resident.draft is not None:
+            # assisted generation does not resume from a prefilled cache
+            return 0
+        input_ids = generate_kwargs["inputs"]
+        _ids = input_ids[0].tolist()
+        _length = resident.prefix_cache.candidate(_ids)
+        if _length:
+            # A prefix shared with a recent request: compute it once on its own
+            _start = time.time()
+            with torch.no_grad():
+                _past = resident.model(
+                    input_ids[:, :_length], use_cache=True
+                ).past_key_values
+            resident.prefix_cache.store(
+                _ids[:_length],
+                _past,
+                kv_bytes(resident.model, _length),
+                time.time() - _start,
+            )
+        _length, _past = resident.prefix_cache.lookup(_ids)
+        if _past is not None:
+            generate_kwargs["past_key_values"] = _past
+        return _length
+
+    def infer_batch(self, batch: list):
+        """Generate requests sharing the same param with one padded generate call."""
+        start_time = time.time()
+        _resident = self.serving(batch[0].get("model_key"))
+        if len(batch) == 1 or _resident.draft is not None:
+            # assisted generation verifies one sequence at a time
+            return [self.infer_one(data) for data in batch]
+        _infer_input, generate_kwargs, timer = self.prepare_generate(
+            _resident, batch[0]
+        )
+
+        _pad_token_id = _resident.tokenizer.pad_token_id
+        if _pad_token_id is None:
+            _pad_token_id = _resident.tokenizer.eos_token_id
+        _start = time.time()
+        _rows = [
+            _resident.tokenizer(data.get("infer_input", "NOTHING"), return_tensors="pt")
+            .input_ids[0]
+            .to(_resident.model.device)
+            for data in batch
+        ]
+        timer.spans["tokenize"] += time.time() - _start
+        _width = max(len(row) for row in _rows)
+        # Left padding: every prompt ends where its generation starts
+        input_ids = torch.full(
+            (len(_rows), _width), _pad_token_id, device=_resident.model.device
+        )
+        attention_mask = torch.zeros_like(input_ids)
+        for i, row in enumerate(_rows):
+            input_ids[i, _width - len(row) :] = row
+            attention_mask[i, _width - len(row) :] = 1
+        _max_times = [data.get("max_time") for data in batch]
+        generate_kwargs.update(
+            inputs=input_ids,
+            attention_mask=attention_mask,
+            pad_token_id=_pad_token_id,
+            # the most patient caller; the others give up on their own
+            max_time=None if None in _max_times else max(_max_times),
+        )
+        _start = time.time()
+        output = _resident.model.generate(**generate_kwargs)
+        timer.spans["generate"] = time.time() - _start
+
+        responses = []
+        for i, row in enumerate(_rows):
+            # Sequences that stopped early are filled up with padding
+            _generated = output[i, _width:]
+            _kept = (_generated != _pad_token_id).nonzero()
+            _generated = _generated[: int(_kept[-1]) + 1 if len(_kept) else 0]
+            responses.append(
+                self.build_response(
+                    _resident,
+                    batch[i].get("infer_input", "NOTHING"),
+                    row[None],
+                    torch.cat([row, _generated])[None],
+                    start_time,
+                    timer,
+                )
+            )
+            if "queued_at" in batch[i]:
+                responses[-1]["timings"]["batch_wait"] = round(
+                    start_time - batch[i]["queued_at"], 4
+                )
+        return responses
+
+    def infer_stream(self, data: dict):
+        """Yield {"token": text} chunks while generating, then the full response."""
+        start_time = time.time()
+        _resident = self.serving(data.get("model_key"))
+        infer_input, generate_kwargs, timer = self.prepare_generate(_resident, data)
+        _generate_start = time.time()
+        _reused = self.reuse_prefix(_resident, generate_kwargs)
+        _draft_counter = self.assist(_resident, generate_kwargs)
+        _cancel = CancelFlag()
+        generate_kwargs["stopping_criteria"].append(_cancel)
+        streamer = TextIteratorStreamer(
+            _resident.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        result = {}
+
+        def _generate():
+            try:
+                with _draft_counter or nullcontext():
+                    result["output"] = _resident.model.generate(
+                        **generate_kwargs, streamer=streamer
+                    )
+                timer.spans["generate"] = time.time() - _generate_start
+            except Exception as e:
+                result["error"] = e
+                streamer.end()  # unblock the consumer below
+
+        thread = Thread(target=_generate)
+        thread.start()
+        try:
+            for text in streamer:
+                if text:
+                    yield {"token": text}
+        finally:
+            # closed before the end when the client went away: stop generating
+            _cancel.set()
+            thread.join()
+        if "error" in result:
+            raise result["error"]
+        yield {
+            "done": True,
+            **self.finish_response(
+                _resident,
+                infer_input,
+                generate_kwargs["inputs"],
+                result["output"],
+                start_time,
+                timer,
+                _reused,
+                _draft_counter,
+            ),
+        }
+
+
+class BatchScheduler:
+    """Gathers requests arriving within a short window and generates the ones
+    with the same param together."""
+
+    def __init__(self, llama, max_batch_size=8, window_seconds=0.02):
+        self.llama = llama
+        self.max_batch_size = max_batch_size
+        self.window_seconds = window_seconds
+        self.pending = queue.Queue()
+        self.stats = {"batches": 0, "requests": 0, "largest_batch": 0}
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, data: dict):
+        """Blocks until the request's batch ran; returns its response."""
+        request = {"data": data, "done": Event()}
+        self.pending.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["response"]
+
+    def gather(self):
+        batch = [self.pending.get()]
+        _window_end = time.monotonic() + self.window_seconds
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(
+                    self.pending.get(timeout=max(0, _window_end - time.monotonic()))
+                )
+            except queue.Empty:
+                break
+        return batch
+
+    def batch_key(self, data: dict):
+        # Only requests generated with identical settings can share a call
+        return json.dumps(
+            [data.get("model_key"), data.get("param", {})], sort_keys=True
+        )
+
+    def run(self):
+        while True:
+            _groups = {}
+            for request in self.gather():
+                _groups.setdefault(self.batch_key(request["data"]), []).append(request)
+            for group in _groups.values():
+                self.run_batch(group)
+
+    def run_batch(self, group: list):
+        try:
+            responses = self.llama.infer_batch([request["data"] for request in group])
+            for request, response in zip(group, responses):
+                request["response"] = response
+        except Exception as e:
+            for request in group:
+                request["error"] = e
+        finally:
+            self.stats["batches"] += 1
+            self.stats["requests"] += len(group)
+            self.stats["largest_batch"] = max(self.stats["largest_batch"], len(group))
+            for request in group:
+                request["done"].set()
+
+
+# Attention state (past_key_values) of prompt prefixes shared by requests,
+# e.g. the system message a prompt renders in front of every user text.
+class PrefixCache:
+    def __init__(self, max_memory_gb=2, min_tokens=32, recent_requests=64):
+        self.max_bytes = max_memory_gb * 1024**3
+        self.min_tokens = min_tokens  # shorter shared prefixes are not worth it
+        self.recent = deque(maxlen=recent_requests)  # token ids of recent prompts
+        self.entries = OrderedDict()  # prefix ids -> entry dict, LRU first
+        self.bytes = 0
+        self.lock = Lock()
+        self.stats = {
+            "lookups": 0,
+            "hits": 0,
+            "evictions": 0,
+            "tokens_reused": 0,
+            "prefill_seconds_saved": 0.0,
+        }
+
+    def candidate(self, ids: list):
+        """Length of a prefix `ids` shares with a recent prompt that is worth
+        caching, 0 if there is none (or it is cached already)."""
+        _ids = tuple(ids)
+        _length = 0
+        with self.lock:
+            for previous in self.recent:
+                _common = 0
+                for a, b in zip(previous, _ids):
+                    if a != b:
+                        break
+                    _common += 1
+                _length = max(_length, _common)
+            self.recent.append(_ids)
+        # at least one token must be left to compute
+        _length = min(_length, len(_ids) - 1)
+        if _length < self.min_tokens or _ids[:_length] in self.entries:
+            return 0
+        return _length
+
+    def store(self, prefix: list, past_key_values, nbytes, prefill_seconds):
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            self.entries[tuple(prefix)] = {
+                "past_key_values": past_key_values,
+                "bytes": nbytes,
+                "prefill_seconds": prefill_seconds,
+            }
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _prefix, _entry = self.entries.popitem(last=False)
+                self.bytes -= _entry["bytes"]
+                self.stats["evictions"] += 1
+
+    def lookup(self, ids: list):
+        """(length, past_key_values) of the longest cached prefix of `ids`, or
+        (0, None).
+
+        The returned cache is a deep copy the caller may extend: generate
+        appends to the cache object it is given. Each hit thus copies the
+        entry (a memcpy, far cheaper than the prefill it saves) and holds that
+        much more memory while its request runs.
+        """
+        _ids = tuple(ids)
+        with self.lock:
+            self.stats["lookups"] += 1
+            _best = None
+            for prefix in self.entries:
+                if len(prefix) < len(_ids) and _ids[: len(prefix)] == prefix:
+                    if _best is None or len(prefix) > len(_best):
+                        _best = prefix
+            if _best is None:
+                return 0, None
+            self.entries.move_to_end(_best)
+            _entry = self.entries[_best]
+            self.stats["hits"] += 1
+            self.stats["tokens_reused"] += len(_best)
+            self.stats["prefill_seconds_saved"] += _entry["prefill_seconds"]
+            # generate appends to the cache it is given
+            return len(_best), copy.deepcopy(_entry["past_key_values"])
+
+    def cache_stats(self):
+        return {
+            **self.stats,
+            "prefill_seconds_saved": round(self.stats["prefill_seconds_saved"], 3),
+            "hit_ratio": (
+                round(self.stats["hits"] / self.stats["lookups"], 3)
+                if self.stats["lookups"]
+                else 0.0
+            ),
+            "entries": len(self.entries),
+            "memory_gb": round(self.bytes / 1024**3, 3),
+        }
+
+
+def kv_bytes(model, num_tokens):
+    """Memory of the keys and values `model` keeps for `num_tokens` tokens."""
+    _config = model.config
+    _heads = _config.num_attention_heads
+    _kv_heads = getattr(_config, "num_key_value_heads", None) or _heads
+    _head_dim = _config.hidden_size // _heads
+    _element_size = next(model.parameters()).element_size()
+    return (
+        2
+        * _config.num_hidden_layers
+        * num_tokens
+        * _kv_heads
+        * _head_dim
+        * _element_size
+    )
@@ -4,14 +4,156 @@ import pprint
 import os
 import psutil
 import shutil
+import math
+import time
+from array import array
+from threading import Event, Lock, Thread
+
+try:
+    import pynvml  # nvidia-ml-py
+except ImportError:
+    pynvml = None
+
+PLACEHOLDER_XML = os.path.join(os.path.dirname(__file__), "nvidia_example.xml")
+
+
+class TelemetryHistory:
+    """Ring buffer of numeric samples, one preallocated array per field; the
+    oldest sample is overwritten once it is full."""
+
+    FIELDS = [
+        "cpu_utilization",
+        "system_load",
+        "memory_used",
+        "gpu_memory_used",  # GB, summed over all GPUs
+        "gpu_utilization",  # averaged over all GPUs
+        "tokens_per_second",
+        "queued",
+        "running",
+    ]
+
+    def __init__(self, size=720):
+        self.size = size
+        self.times = array("d", [0.0]) * size
+        self.values = {field: array("d", [math.nan]) * size for field in self.FIELDS}
+        self.next = 0  # slot the next sample is written to
+        self.count = 0
+
+    def append(self, timestamp, sample: dict):
+        self.times[self.next] = timestamp
+        for field, values in self.values.items():
+            _value = sample.get(field)
+            values[self.next] = math.nan if _value is None else float(_value)
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def window(self, seconds, points, now=None):
+        """The last `seconds` as `points` equally long buckets, averaging the
+        samples within each; None where a bucket has no sample."""
+        now = time.time() if now is None else now
+        _start = now - seconds
+        _width = seconds / points
+        _sums = {field: [0.0] * points for field in self.FIELDS}
+        _counts = {field: [0] * points for field in self.FIELDS}
+        for i in range(self.count):
+            _slot = (self.next - self.count + i) % self.size  # oldest first
+            if self.times[_slot] < _start:
+                continue
+            _bucket = min(points - 1, int((self.times[_slot] - _start) / _width))
+            for field, values in self.values.items():
+                if not math.isnan(values[_slot]):
+                    _sums[field][_bucket] += values[_slot]
+                    _counts[field][_bucket] += 1
+        return {
+            "start": _start,
+            "bucket_seconds": _width,
+            "time": [_start + (i + 0.5) * _width for i in range(points)],
+            "series": {
+                field: [
+                    _sums[field][i] / _counts[field][i] if _counts[field][i] else None
+                    for i in range(points)
+                ]
+                for field in self.FIELDS
+            },
+        }
 
 
 class SystemStats:
-    def __init__(self):
-        pass
+    """Samples system and GPU usage in a background thread. The endpoints
+    answer from the latest sample, the last `history_size` ones are kept as
+    telemetry."""
+
+    def __init__(self, interval_seconds=5, history_size=720, node_stats=None):
+        self.interval_seconds = interval_seconds
+        self.node_stats = node_stats  # callable adding load and throughput
+        self.latest = None
+        self.telemetry = TelemetryHistory(history_size)
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        self.gpu_source = self.find_gpu_source()
+        print(f"INFO: Reading GPU stats from {self.gpu_source}")
+
+    def find_gpu_source(self):
+        if pynvml is not None:
+            try:
+                pynvml.nvmlInit()
+                return "nvml"
+            except pynvml.NVMLError:
+                pass
+        if shutil.which("nvidia-smi"):
+            return "nvidia-smi"
+        # working without GPU
+        return "placeholder"
+
+    def start(self):
+        if self.thread is None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        psutil.cpu_percent()  # the first call only starts the measurement
+        while not self.stopped.wait(self.interval_seconds):
+            try:
+                self.sample()
+            except Exception as e:
+                # e.g. NVML or psutil failing once: keep sampling
+                print(f"WARNING: System stats sample failed: {e!r}")
+
+    def sample(self):
+        _sample = self.read_system_stats()
+        _sample["time"] = time.time()
+        _gpus = _sample.get("gpu_info", [])
+        _telemetry = {
+            **_sample,
+            "gpu_memory_used": sum(g["used"] for g in _gpus) if _gpus else None,
+            "gpu_utilization": (
+                sum(g["gpu_utilization"] for g in _gpus) / len(_gpus)
+                if _gpus and all("gpu_utilization" in g for g in _gpus)
+                else None
+            ),
+            **(self.node_stats() if self.node_stats else {}),
+        }
+        with self.lock:
+            self.latest = _sample
+            self.telemetry.append(_sample["time"], _telemetry)
+        return _sample
+
+    def history(self, minutes=15, points=60):
+        with self.lock:
+            return {
+                "interval_seconds": self.interval_seconds,
+                "now": time.time(),  # lets readers correct for clock offsets
+                **self.telemetry.window(minutes * 60, points),
+            }
 
     def get_gpu_info(self):
-        try:
+        if self.gpu_source == "nvml":
+            return self.get_gpu_info_nvml()
+        if self.gpu_source == "nvidia-smi":
             result = subprocess.run(
                 ["nvidia-smi", "-x", "-q"], capture_output=True, text=True
             )
@@ -19,41 +161,49 @@ class SystemStats:
             if result.returncode != 0:
                 # If the command failed, raise an exception
                 raise Exception("nvidia-smi failed: " + result.stderr)
+            return self.parse_gpu_xml(result.stdout)
+        with open(PLACEHOLDER_XML) as f:
+            return self.parse_gpu_xml(f.read())
 
-            # Parse the XML output
-            my_dict = xmltodict.parse(result.stdout)
-        except:
-            print("working without GPU, loading placeholder file")
-            file = "nvidia_example.xml"
-            # file = "nvidia-multi.xml"
-            with open(file) as f:
-                my_dict = xmltodict.parse(f.read())
-
-        if int(my_dict["nvidia_smi_log"]["attached_gpus"]) > 1:
-            gpu_info = []
-            for g in my_dict["nvidia_smi_log"]["gpu"]:
-                ginfo = {
-                    key: round(float(value.split()[0]) / 1024, 2)
-                    for key, value in g["fb_memory_usage"].items()
-                }
-                ginfo["gpu_pct_free"] = (ginfo["free"] / ginfo["total"]) * 100
-                ginfo["gpu_pct_used"] = (ginfo["used"] / ginfo["total"]) * 100
-                ginfo["gpu_name"] = g["product_name"]
-            gpu_info.append(gi)
-        elif int(my_dict["nvidia_smi_log"]["attached_gpus"]) == 1:
+    def get_gpu_info_nvml(self):
+        gpu_info = []
+        for i in range(pynvml.nvmlDeviceGetCount()):
+            handle = pynvml.nvmlDeviceGetHandleByIndex(i)
+            memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
             ginfo = {
-                key: round(float(value.split()[0]) / 1024, 2)
-                for key, value in my_dict["nvidia_smi_log"]["gpu"][
-                    "fb_memory_usage"
-                ].items()
+                key: round(getattr(memory, key) / 1024**3, 2)
+                for key in ["total", "used", "free"]
             }
             ginfo["gpu_pct_free"] = (ginfo["free"] / ginfo["total"]) * 100
             ginfo["gpu_pct_used"] = (ginfo["used"] / ginfo["total"]) * 100
-            ginfo["gpu_name"] = my_dict["nvidia_smi_log"]["gpu"]["product_name"]
-            gpu_info = [ginfo]
-        else:
-            gpu_info = []
+            ginfo["gpu_name"] = pynvml.nvmlDeviceGetName(handle)
+            if isinstance(ginfo["gpu_name"], bytes):  # older bindings
+                ginfo["gpu_name"] = ginfo["gpu_name"].decode()
+            ginfo["gpu_utilization"] = pynvml.nvmlDeviceGetUtilizationRates(handle).gpu
+            gpu_info.append(ginfo)
+        return gpu_info
 
+    def parse_gpu_xml(self, xml):
+        my_dict = xmltodict.parse(xml)
+        if int(my_dict["nvidia_smi_log"]["attached_gpus"]) == 0:
+            return []
+        gpus = my_dict["nvidia_smi_log"]["gpu"]
+        if not isinstance(gpus, list):  # a single <gpu> element
+            gpus = [gpus]
+
+        gpu_info = []
+        for g in gpus:
+            ginfo = {
+                key: round(float(value.split()[0]) / 1024, 2)
+                for key, value in g["fb_memory_usage"].items()
+            }
+            ginfo["gpu_pct_free"] = (ginfo["free"] / ginfo["total"]) * 100
+            ginfo["gpu_pct_used"] = (ginfo["used"] / ginfo["total"]) * 100
+            ginfo["gpu_name"] = g["product_name"]
+            _utilization = (g.get("utilization") or {}).get("gpu_util")
+            if _utilization:
+                ginfo["gpu_utilization"] = float(_utilization.split()[0])
+            gpu_info.append(ginfo)
         return gpu_info
 
     def get_system_usage(self):
@@ -72,8 +222,8 @@ class SystemStats:
         # System load
         system_load = round(os.getloadavg()[0], 2)  # Get 1-minute load average
 
-        # CPU utilization
-        cpu_utilization = psutil.cpu_percent(interval=0.5)
+        # CPU utilization since the previous sample, does not block
+        cpu_utilization = psutil.cpu_percent(interval=None)
 
         # Swap usage
         swap_info = psutil.swap_memory()
@@ -95,7 +245,7 @@ class SystemStats:
             "swap_usage": swap_used,
         }
 
-    def collect_system_stats(self):
+    def read_system_stats(self):
         try:
             system_stats = self.get_system_usage()
         except Exception as e:
@@ -107,3 +257,10 @@ class SystemStats:
             print(f"Error loading GPU stats: {e}")
 
         return system_stats
+
+    def collect_system_stats(self):
+        """The latest sample; only the very first call reads the system."""
+        with self.lock:
+            if self.latest is not None:
+                return dict(self.latest)
+        return self.sample()
@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def tiny_llama():
+    """Builds llama nodes serving tiny random GPT-2 models, offline:
+    tiny_llama(model_pool=..., prefix_cache=..., **batching)."""
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    tokenizers = pytest.importorskip("tokenizers")
+    import torch
+
+    from herding_llamas.llama.model import LanguageModel, ResidentModel
+
+    class TinyLlama(LanguageModel):
+        # Same architecture as the `placeholder` model in conf.yml
+        def __init__(self, model_pool=None, prefix_cache=None, **batching):
+            self.conf = {
+                "startup_model": "placeholder",
+                "models": {
+                    "placeholder": {"seed": 0},
+                    "placeholder_b": {"seed": 1},
+                    "placeholder_c": {"seed": 2},
+                    # same weights as `placeholder`, drafted by a copy or another model
+                    "placeholder_assisted": {"seed": 0, "draft_model": "placeholder"},
+                    "placeholder_drafted": {"seed": 0, "draft_model": "placeholder_b"},
+                },
+                "model_pool": model_pool or {},
+                "prefix_cache": prefix_cache or {},
+                "batching": batching,
+            }
+            self.loads = []
+            self.load_delay = 0
+            LanguageModel.__init__(self)
+
+        def load(self, model_key):
+            self.loads.append(model_key)
+            time.sleep(self.load_delay)
+            resident = ResidentModel(model_key, self.conf)
+            vocab = {c: i for i, c in enumerate(["<unk>"] + list("abcdefghij :"))}
+            tokenizer = tokenizers.Tokenizer(
+                tokenizers.models.WordLevel(vocab, unk_token="<unk>")
+            )
+            tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Split("", "isolated")
+            resident.tokenizer = transformers.PreTrainedTokenizerFast(
+                tokenizer_object=tokenizer, unk_token="<unk>", eos_token="<unk>"
+            )
+            torch.manual_seed(resident.model_conf["seed"])
+            resident.model = transformers.GPT2LMHeadModel(
+                transformers.GPT2Config(
+                    vocab_size=len(vocab),
+                    n_layer=2,
+                    n_head=2,
+                    n_embd=16,
+                    bos_token_id=0,
+                    eos_token_id=0,
+                    initializer_range=1.0,  # decisive logits, no near-ties
+                )
+            ).eval()
+            return resident
+
+    return TinyLlama
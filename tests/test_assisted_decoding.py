@@ -0,0 +1,23 @@
+import pytest
+
+pytest.importorskip("torch")
+
+
+def test_assisted_generation_keeps_output_and_reports_acceptance(tiny_llama):
+    llama = tiny_llama(model_pool={"max_models": 3})
+    request = {"infer_input": "hij ab", "param": {"max_new_tokens": 12}}
+    plain = llama.infer(dict(request))
+    assert "draft_tokens" not in plain
+
+    # a perfect draft: every proposed token is accepted
+    llama.load_model("placeholder_assisted")
+    assisted = llama.infer(dict(request))
+    assert assisted["response"] == plain["response"]
+    assert assisted["draft_acceptance_rate"] == 1.0
+
+    llama.load_model("placeholder_drafted")
+    drafted = llama.infer(dict(request))
+    assert drafted["response"] == plain["response"]
+    assert drafted["draft_tokens"] > 0
+    assert drafted["draft_acceptance_rate"] < 1.0
+    assert llama.models["placeholder_drafted"].draft.model_key == "placeholder_b"
@@ -0,0 +1,35 @@
+import threading
+
+import pytest
+
+pytest.importorskip("torch")
+
+
+def test_batched_generation_matches_single_requests(tiny_llama):
+    llama = tiny_llama()
+    param = {"max_new_tokens": 6, "stop_words": []}
+    inputs = ["abc", "hij ab", "j"]
+    batched = llama.infer_batch([{"infer_input": x, "param": param} for x in inputs])
+    for infer_input, response in zip(inputs, batched):
+        single = llama.infer_one({"infer_input": infer_input, "param": param})
+        assert response["response"] == single["response"]
+        assert response["output_tokens"] == single["output_tokens"]
+
+
+def test_concurrent_requests_share_one_generate_call(tiny_llama):
+    llama = tiny_llama(window_seconds=0.2)
+    param = {"max_new_tokens": 4, "stop_words": []}
+    responses = {}
+
+    def request(infer_input):
+        responses[infer_input] = llama.infer(
+            {"infer_input": infer_input, "param": param}
+        )
+
+    threads = [threading.Thread(target=request, args=(x,)) for x in ["ab", "cde"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert set(responses) == {"ab", "cde"}
+    assert llama.batcher.stats == {"batches": 1, "requests": 2, "largest_batch": 2}
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from herding_llamas.llama.executor import InferenceExecutor, QueueFull
+
+
+def test_event_loop_stays_responsive_during_inference():
+    async def run():
+        executor = InferenceExecutor(max_workers=1, max_queue=1)
+        release = threading.Event()
+        inference = asyncio.create_task(executor.run(release.wait, 5))
+        await asyncio.sleep(0.01)
+        # the loop still serves control calls and sees the inference running
+        assert executor.stats()["running"] == 1
+        with pytest.raises(QueueFull):
+            executor.submit(release.wait, 5)
+            executor.submit(release.wait, 5)
+        release.set()
+        assert await inference is True
+
+    asyncio.run(run())
+
+
+def test_stream_yields_chunks_from_inference_thread():
+    async def run():
+        executor = InferenceExecutor()
+
+        def generate():
+            yield from ["a", "b"]
+
+        assert [chunk async for chunk in executor.stream(generate)] == ["a", "b"]
+
+    asyncio.run(run())
+
+
+def test_closing_a_stream_closes_the_generator():
+    async def run():
+        executor = InferenceExecutor()
+        closed = threading.Event()
+
+        def generate():
+            try:
+                while True:
+                    yield "a"
+                    time.sleep(0.001)
+            finally:
+                closed.set()
+
+        chunks = executor.stream(generate)
+        assert await chunks.__anext__() == "a"
+        await chunks.aclose()  # the client went away
+        assert await asyncio.to_thread(closed.wait, 5)
+        assert executor.stats()["running"] == 0
+
+    asyncio.run(run())
@@ -0,0 +1,124 @@
+import asyncio
+import shutil
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("jinja2")
+pytest.importorskip("prometheus_client")
+httpx = pytest.importorskip("httpx")
+
+HERDER_DIR = Path(__file__).resolve().parents[1] / "herding_llamas" / "herder"
+
+
+@pytest.fixture
+def herder(tmp_path, monkeypatch):
+    # herder.py imports its modules from, and reads its yml files in, the cwd
+    for name in ["users.yml", "roles.yml", "prompts.yml", "llamas.yml"]:
+        shutil.copy(HERDER_DIR / name, tmp_path)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(HERDER_DIR))
+    from herder import Herder
+
+    herder = Herder()
+
+    async def dispatch(data, allowed_nodes, on_chunk=None, timings=None):
+        response = {
+            "response": "Stockholm",
+            "input_tokens": 3,
+            "output_tokens": 4,
+            "elapsed_seconds": 0.1,
+            "model_name": "TheBloke/Llama-2-13B-chat-GPTQ",
+        }
+        return "node_a", httpx.Response(200, json=response), 200
+
+    herder.dispatch = dispatch
+    yield herder
+    asyncio.run(herder.close())
+
+
+def cached_rows(herder):
+    from database import ResponseCacheEntry
+
+    herder.response_cache.close()  # wait for the writes behind
+    return herder.database.get_session().query(ResponseCacheEntry).count()
+
+
+def infer(herder, user_key):
+    data = {
+        "user_key": user_key,
+        "prompt_key": "llama_2_plain_vanilla",
+        "raw_inputs": {"text": "What is the capital of Sweden?"},
+        "param": {"do_sample": False},
+    }
+    response, inference_id, status_code = asyncio.run(herder.infer(data))
+    assert status_code == 200
+    return response
+
+
+def test_opted_out_content_is_not_cached(herder):
+    herder.users["admin"]["opt_out_history_content"] = True
+    infer(herder, "admin")
+    assert herder.response_cache.cache_stats()["entries"] == 0
+    assert cached_rows(herder) == 0
+
+
+def test_responses_are_cached_and_persisted(herder):
+    infer(herder, "admin")
+    assert infer(herder, "admin").json()["cache_hit"] is True
+    assert cached_rows(herder) == 1
+
+
+def test_switch_fails_fast_when_the_node_serves_another_model(herder):
+    herder.conf = {"node_a": {}}
+    remapped = []
+
+    async def remap_worker(node_key):
+        remapped.append(node_key)
+
+    herder.remap_worker = remap_worker
+    other = {"status": "ready", "model_key": "model_a"}
+    asyncio.run(asyncio.wait_for(herder.await_model("node_a", "model_b", other), 1))
+    assert remapped == []
+
+    ready = {"status": "ready", "model_key": "model_b"}
+    asyncio.run(herder.await_model("node_a", "model_b", ready))
+    assert remapped == ["node_a"]
+
+
+def test_remap_updates_the_running_worker_in_place(herder):
+    async def load_llamas():
+        herder.llamas = {"node_a": {"mapped_prompts": ["prompt_b"]}}
+
+    herder.load_llamas = load_llamas
+
+    async def run():
+        await herder.start_worker("node_a", ["prompt_a"])
+        worker = herder.workers["node_a"]
+        await asyncio.sleep(0)  # let it register with the queue
+        await herder.remap_worker("node_a")
+        assert herder.workers["node_a"] is worker and not worker.task.done()
+        assert herder.task_queue.waiters["node_a"][0] == {"prompt_b"}
+        await herder.stop_worker("node_a")
+
+    asyncio.run(run())
+
+
+def test_fleet_timeline_corrects_node_clock_offsets(herder):
+    def telemetry(clock_offset):
+        return {
+            "time": [1000.0 + clock_offset],
+            "series": {"queued": [2.0]},
+            "clock_offset": clock_offset,
+        }
+
+    herder.llamas = {
+        "node_a": {"telemetry": telemetry(0.0)},
+        "node_b": {"telemetry": telemetry(120.0)},  # its clock runs ahead
+    }
+    timeline = herder.fleet_timeline(minutes=10, points=10, now=1030.0)
+    assert (
+        timeline["nodes"]["node_b"]["queued"] == timeline["nodes"]["node_a"]["queued"]
+    )
+    assert timeline["fleet"]["queued"][-1] == 4.0
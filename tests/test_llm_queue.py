@@ -0,0 +1,327 @@
+import asyncio
+import time
+
+import pytest
+
+from herding_llamas.herder.llm_queue import TaskQueue, Worker
+
+
+def test_oldest_matching_task_is_claimed():
+    async def run():
+        queue = TaskQueue()
+        a = await queue.enqueue_task(None, "skill_A")
+        b = await queue.enqueue_task(None, "skill_B", ["node_2"])
+        c = await queue.enqueue_task(None, "skill_B")
+
+        # node_1 may not serve b, so it claims c without reordering b
+        assert (await queue.try_dequeue_task(["skill_B"], "node_1"))[0] == c
+        assert (await queue.try_dequeue_task(["skill_A", "skill_B"], "node_2"))[0] == a
+        assert (await queue.try_dequeue_task(["skill_A", "skill_B"], "node_2"))[0] == b
+        assert await queue.try_dequeue_task(["skill_A", "skill_B"], "node_2") == (
+            None,
+            None,
+        )
+        assert queue.qsize() == 0 and queue.pending == {}
+
+    asyncio.run(run())
+
+
+def test_only_eligible_workers_are_woken():
+    async def run():
+        queue = TaskQueue()
+        event_a = queue.register_worker("node_a", ["skill_A"])
+        event_b = queue.register_worker("node_b", ["skill_B"])
+        event_a.clear()
+        event_b.clear()
+        await queue.enqueue_task(None, "skill_A")
+        assert event_a.is_set() and not event_b.is_set()
+
+    asyncio.run(run())
+
+
+def test_worker_runs_task_and_signals_result():
+    async def run():
+        queue = TaskQueue()
+        worker = asyncio.create_task(Worker("node_1", queue, ["skill_A"]).start())
+
+        async def task_func(node_key):
+            return node_key
+
+        task_id = await queue.enqueue_task(task_func, "skill_A")
+        await asyncio.wait_for(queue.result_events[task_id].wait(), timeout=1)
+        assert queue.results.pop(task_id) == "node_1"
+        worker.cancel()
+
+    asyncio.run(run())
+
+
+def test_priority_and_weighted_fair_share():
+    async def run():
+        queue = TaskQueue()
+        bulk = [
+            await queue.enqueue_task(None, "skill_A", flow="batch", priority=1)
+            for _ in range(3)
+        ]
+        light = await queue.enqueue_task(None, "skill_A", flow="user", priority=1)
+        urgent = await queue.enqueue_task(None, "skill_A", flow="admin", priority=0)
+
+        order = [
+            (await queue.try_dequeue_task(["skill_A"], "node_1"))[0] for _ in range(5)
+        ]
+        # higher priority first, then the light flow is not stuck behind the batch
+        assert order == [urgent, bulk[0], light, bulk[1], bulk[2]]
+
+    asyncio.run(run())
+
+
+def test_weight_sets_share_under_contention():
+    async def run():
+        queue = TaskQueue()
+        for _ in range(6):
+            await queue.enqueue_task(None, "skill_A", flow="heavy", weight=2)
+            await queue.enqueue_task(
+                None, "skill_A", flow="light", weight=1, queue_class="bulk"
+            )
+
+        for _ in range(6):
+            await queue.try_dequeue_task(["skill_A"], "node_1")
+        stats = queue.queue_stats()
+        assert stats["default"]["count"] == 4 and stats["bulk"]["count"] == 2
+        assert stats["bulk"]["queued"] == 4
+
+    asyncio.run(run())
+
+
+def test_expired_tasks_are_dropped_before_dequeue():
+    async def run():
+        queue = TaskQueue()
+        stale = await queue.enqueue_task(None, "skill_A", deadline=time.monotonic() - 1)
+        fresh = await queue.enqueue_task(None, "skill_A")
+        assert (await queue.try_dequeue_task(["skill_A"], "node_1"))[0] == fresh
+        assert stale not in queue.tasks
+        assert queue.queue_stats()["default"]["expired"] == 1
+
+    asyncio.run(run())
+
+
+def test_admission_rejects_what_cannot_finish_in_time():
+    async def run():
+        queue = TaskQueue()
+        assert not queue.admit("skill_A", timeout=30)["admitted"]  # no worker
+
+        queue.register_worker("node_1", ["skill_A"])
+        assert queue.admit("skill_A", timeout=30)["admitted"]  # no observations
+
+        queue.record_service_time("node_1", 10.0)
+        for _ in range(3):
+            await queue.enqueue_task(None, "skill_A")
+        admission = queue.admit("skill_A", timeout=30)
+        assert not admission["admitted"] and admission["retry_after"] == 10
+        assert queue.admit("skill_A", timeout=30, priority=0)["admitted"]
+
+    asyncio.run(run())
+
+
+def test_worker_keeps_max_concurrency_tasks_in_flight():
+    async def run():
+        queue = TaskQueue()
+        worker = Worker("node_1", queue, ["skill_A"], max_concurrency=2)
+        worker.task = asyncio.create_task(worker.start())
+        release = asyncio.Event()
+
+        async def task_func(node_key):
+            await release.wait()
+            return node_key
+
+        task_ids = [await queue.enqueue_task(task_func, "skill_A") for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert worker.stats()["in_flight"] == 2 and queue.qsize() == 1
+
+        release.set()
+        for task_id in task_ids:
+            await asyncio.wait_for(queue.result_events[task_id].wait(), timeout=1)
+        assert sum(slot["tasks"] for slot in worker.stats()["slots"]) == 3
+        worker.task.cancel()
+
+    asyncio.run(run())
+
+
+def test_least_loaded_routing_prefers_faster_node():
+    async def run():
+        queue = TaskQueue()
+        fast_event = queue.register_worker("fast", ["skill_A"])
+        queue.register_worker("slow", ["skill_A"])
+        queue.record_service_time("fast", 1.0, "skill_A")
+        queue.record_service_time("slow", 5.0, "skill_A")
+
+        task_id = await queue.enqueue_task(None, "skill_A", routing="least_loaded")
+        fast_event.clear()
+        # the slow node leaves the task to the fast one and wakes it
+        assert await queue.try_dequeue_task(["skill_A"], "slow") == (None, None)
+        assert fast_event.is_set()
+        assert (await queue.try_dequeue_task(["skill_A"], "fast"))[0] == task_id
+
+        # with the fast node busy, the slow one is expected to finish first
+        queue.in_flight["fast"] = 5
+        await queue.enqueue_task(None, "skill_A", routing="least_loaded")
+        assert (await queue.try_dequeue_task(["skill_A"], "slow"))[0] is not None
+
+    asyncio.run(run())
+
+
+def test_waiter_giving_up_cancels_and_frees_result_slots():
+    async def run():
+        queue = TaskQueue()
+        worker = Worker("node_1", queue, ["skill_A"])
+        worker.task = asyncio.create_task(worker.start())
+        started = asyncio.Event()
+
+        async def task_func(node_key):
+            started.set()
+            await asyncio.sleep(60)
+
+        running = await queue.enqueue_task(task_func, "skill_A")
+        queued = await queue.enqueue_task(task_func, "skill_A")
+        await started.wait()
+
+        queue.cancel_task(queued)
+        queue.cancel_task(running)
+        await asyncio.sleep(0.01)
+        assert queue.qsize() == 0 and worker.stats()["in_flight"] == 0
+        assert queue.results == {} and queue.result_events == {}
+        assert queue.running == {}
+        worker.task.cancel()
+
+    asyncio.run(run())
+
+
+def test_failed_task_is_handed_to_the_waiter():
+    async def run():
+        queue = TaskQueue()
+        worker = Worker("node_1", queue, ["skill_A"])
+        worker.task = asyncio.create_task(worker.start())
+
+        async def task_func(node_key):
+            raise ConnectionError("node down")
+
+        task_id = await queue.enqueue_task(task_func, "skill_A")
+        await asyncio.wait_for(queue.result_events[task_id].wait(), timeout=1)
+        assert isinstance(queue.results[task_id], ConnectionError)
+        worker.task.cancel()
+
+    asyncio.run(run())
+
+
+def test_stopped_worker_fails_its_tasks_at_once():
+    async def run():
+        queue = TaskQueue()
+        worker = Worker("node_1", queue, ["skill_A"])
+        worker.task = asyncio.create_task(worker.start())
+        started = asyncio.Event()
+
+        async def task_func(node_key):
+            started.set()
+            await asyncio.sleep(60)
+
+        task_id = await queue.enqueue_task(task_func, "skill_A")
+        await started.wait()
+        worker.task.cancel()
+        await asyncio.wait_for(queue.result_events[task_id].wait(), timeout=1)
+        assert isinstance(queue.results[task_id], RuntimeError)
+
+    asyncio.run(run())
+
+
+def test_remapped_worker_keeps_its_tasks_in_flight():
+    async def run():
+        queue = TaskQueue()
+        worker = Worker("node_1", queue, ["skill_A"], max_concurrency=2)
+        worker.task = asyncio.create_task(worker.start())
+        started = asyncio.Event()
+
+        async def slow(node_key):
+            started.set()
+            await asyncio.sleep(0.1)
+            return "slow"
+
+        async def fast(node_key):
+            return "fast"
+
+        running = await queue.enqueue_task(slow, "skill_A")
+        await started.wait()
+        remapped = await queue.enqueue_task(fast, "skill_B")
+        worker.update_skills(["skill_A", "skill_B"])
+        assert queue.waiters["node_1"][0] == {"skill_A", "skill_B"}
+
+        await asyncio.wait_for(queue.result_events[remapped].wait(), timeout=1)
+        assert queue.results[remapped] == "fast"
+        await asyncio.wait_for(queue.result_events[running].wait(), timeout=1)
+        assert queue.results[running] == "slow"
+        worker.task.cancel()
+
+    asyncio.run(run())
+
+
+def test_routing_counts_backlog_reported_by_the_node():
+    async def run():
+        queue = TaskQueue()
+        queue.register_worker("busy", ["skill_A"])
+        queue.register_worker("idle", ["skill_A"])
+        queue.record_service_time("busy", 1.0, "skill_A")
+        queue.record_service_time("idle", 2.0, "skill_A")
+        # other clients keep the faster node busy
+        queue.report_node_load("busy", queued=3, running=1)
+
+        await queue.enqueue_task(None, "skill_A", routing="least_loaded")
+        assert await queue.try_dequeue_task(["skill_A"], "busy") == (None, None)
+        assert (await queue.try_dequeue_task(["skill_A"], "idle"))[0] is not None
+
+        # an old report no longer counts
+        queue.node_load["busy"] = (
+            4,
+            time.monotonic() - queue.NODE_LOAD_TTL_SECONDS - 1,
+        )
+        assert queue.node_stats("busy")["node_load"] == 0
+        await queue.enqueue_task(None, "skill_A", routing="least_loaded")
+        assert (await queue.try_dequeue_task(["skill_A"], "busy"))[0] is not None
+
+    asyncio.run(run())
+
+
+def test_routing_scales_with_output_length_and_tokens_per_second():
+    async def run():
+        queue = TaskQueue()
+        queue.register_worker("fast", ["short", "long"])
+        queue.register_worker("slow", ["short", "long"])
+        queue.record_tokens("fast", 400, 10.0, tokens_per_second=40, skill="long")
+        queue.record_tokens("slow", 20, 1.0, tokens_per_second=20, skill="short")
+        # never served "long", estimated from its length at the node's speed
+        assert queue.expected_service_time("slow", "long") == pytest.approx(20.0)
+        assert queue.expected_service_time("fast", "short") == pytest.approx(0.5)
+
+        with pytest.raises(ValueError):
+            await queue.enqueue_task(None, "short", routing="fastest")
+        assert queue.qsize() == 0
+
+    asyncio.run(run())
+
+
+def test_least_loaded_gives_the_slower_worker_work_once_the_faster_is_saturated():
+    async def run():
+        queue = TaskQueue()
+        queue.register_worker("fast", ["skill_A"])
+        queue.register_worker("slow", ["skill_A"])
+        queue.record_service_time("fast", 1.0, "skill_A")
+        queue.record_service_time("slow", 3.0, "skill_A")
+        task_ids = [
+            await queue.enqueue_task(None, "skill_A", routing="least_loaded")
+            for _ in range(4)
+        ]
+        # The fast worker would finish the first two tasks after 1 and 2 s, the
+        # third after 3 s: the slow worker is as quick and takes that one.
+        assert (await queue.try_dequeue_task(["skill_A"], "slow"))[0] == task_ids[2]
+        assert (await queue.try_dequeue_task(["skill_A"], "fast"))[0] == task_ids[0]
+        assert (await queue.try_dequeue_task(["skill_A"], "fast"))[0] == task_ids[1]
+        assert queue.qsize() == 1
+
+    asyncio.run(run())
@@ -0,0 +1,71 @@
+import json
+import random
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+from fastapi.testclient import TestClient
+
+from benchmarks.load_test import compare, percentile, read_requests, summarize
+from benchmarks.stub_node import create_app, parse_distribution
+
+
+def test_distributions_are_parsed_and_never_negative():
+    rng = random.Random(0)
+    assert parse_distribution("0.5")(rng) == 0.5
+    assert 1 <= parse_distribution("uniform:1,2")(rng) <= 2
+    assert all(parse_distribution("normal:0,1")(rng) >= 0 for _ in range(100))
+    with pytest.raises(ValueError):
+        parse_distribution("gamma:1,2")
+
+
+def test_stub_node_answers_like_a_llama_node():
+    app = create_app(first_token="0", tokens_per_second="1000", output_tokens="40")
+    with TestClient(app) as client:
+        models = client.get("/api/v1/models").json()
+        assert models["loaded_model"] == models["models"][0]["option"]
+        response = client.post(
+            "/api/v1/infer",
+            json={"infer_input": "a b c", "param": {"max_new_tokens": 10}},
+        ).json()
+    assert response["input_tokens"] == 3
+    assert response["output_tokens"] == 3 + 10
+    assert response["elapsed_seconds"] >= 10 / 1000
+
+
+def test_request_lines_and_summary(tmp_path):
+    path = tmp_path / "requests.jsonl"
+    lines = [
+        {"prompt_key": "p", "raw_inputs": {"text": "x"}, "param": {"seed": 1}},
+        {"request_id": "r-1", "title": "t", "body": "b", "token": "user_token"},
+    ]
+    path.write_text("\n".join(json.dumps(line) for line in lines) + "\n")
+    requests = read_requests(path, "llama_2_plain_vanilla")
+    assert requests[0] == lines[0]
+    assert requests[1] == {
+        "prompt_key": "llama_2_plain_vanilla",
+        "raw_inputs": {"text": "b"},
+        "token": "user_token",
+    }
+
+    assert percentile([1, 2, 3, 4, 5], 50) == 3
+    assert percentile([1, 2], 95) == pytest.approx(1.95)
+    results = [
+        {"status": 200, "cache_hit": False, "latency": 1.0, "queue": 0.5, "node": 0.4},
+        {"status": 200, "cache_hit": True, "latency": 0.1, "queue": None, "node": None},
+        {
+            "status": 503,
+            "cache_hit": False,
+            "latency": 3.0,
+            "queue": None,
+            "node": None,
+        },
+    ]
+    summary = summarize(results, seconds=2.0)
+    assert summary["ok"] == 2 and summary["cache_hits"] == 1
+    assert summary["errors"] == {"503": 1}
+    assert summary["throughput"] == 1.0
+    assert summary["queue_wait"]["p99"] == 0.5
+    assert "throughput:    1.000 ->    1.000 (+0.0%)" in compare(summary, summary)[0]
@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+prometheus_client = pytest.importorskip("prometheus_client")
+
+from herding_llamas.llama.executor import InferenceExecutor
+from herding_llamas.llama.metrics import LlamaCollector, observe_response
+
+
+def test_node_metrics_from_responses_and_collector(tiny_llama):
+    llama = tiny_llama()
+    llama.executor = InferenceExecutor()
+    response = llama.infer({"infer_input": "abc", "param": {"max_new_tokens": 3}})
+    observe_response(response)
+
+    registry = prometheus_client.REGISTRY
+    _new_tokens = response["output_tokens"] - response["input_tokens"]
+    assert (
+        registry.get_sample_value(
+            "llama_output_tokens_total", {"model_key": "placeholder"}
+        )
+        >= _new_tokens
+    )
+    assert registry.get_sample_value(
+        "llama_inference_seconds_count", {"model_key": "placeholder"}
+    )
+
+    collector_registry = prometheus_client.CollectorRegistry()
+    collector_registry.register(LlamaCollector(llama))
+    text = prometheus_client.generate_latest(collector_registry).decode()
+    assert 'llama_executor_requests{state="queued"} 0.0' in text
+    assert "llama_batched_requests_total 1.0" in text
+    assert (
+        'llama_prefix_cache_lookups_total{model_key="placeholder",result="hit"}' in text
+    )
+    assert 'llama_model_load_seconds{model_key="placeholder"}' in text
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("torch")
+
+
+def test_pool_keeps_recent_models_and_evicts_least_recently_used(tiny_llama):
+    from herding_llamas.llama.model import NotResident
+
+    llama = tiny_llama(model_pool={"max_models": 2})
+    request = {"infer_input": "abc", "param": {"max_new_tokens": 2}}
+    # requests never load a model, that would stall the node
+    with pytest.raises(NotResident):
+        llama.infer({**request, "model_key": "placeholder_b"})
+    llama.load_model("placeholder_b")
+    assert list(llama.models) == ["placeholder", "placeholder_b"]
+
+    # switching to a resident model is a pointer swap
+    assert llama.load_model("placeholder")["was_resident"]
+    llama.infer({**request, "model_key": "placeholder_b"})
+    assert llama.loads == ["placeholder", "placeholder_b"]
+
+    # a third model pushes out the least recently used one that is not
+    # serving as the default while it loads
+    llama.load_model("placeholder_c")
+    assert list(llama.models) == ["placeholder", "placeholder_c"]
+    assert llama.infer(dict(request))["model_name"] == "placeholder_c"
+
+
+def test_background_load_keeps_serving_until_the_swap(tiny_llama):
+    llama = tiny_llama()
+    llama.load_delay = 0.3
+    request = {"infer_input": "abc", "param": {"max_new_tokens": 2}}
+    assert llama.start_load("placeholder_b")["status"] == "loading"
+    assert llama.infer(dict(request))["model_name"] == "placeholder"
+
+    while llama.load_status()["status"] == "loading":
+        time.sleep(0.05)
+    assert llama.load_status()["status"] == "ready"
+    # only one model fits: the previous default is gone after the swap
+    assert list(llama.models) == ["placeholder_b"]
+    assert llama.infer(dict(request))["model_name"] == "placeholder_b"
+
+
+def test_concurrent_switches_start_one_load(tiny_llama):
+    llama = tiny_llama()
+    llama.load_delay = 0.3
+    threads = [
+        threading.Thread(target=llama.start_load, args=("placeholder_b",))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    while llama.load_status()["status"] == "loading":
+        time.sleep(0.05)
+    assert llama.loads == ["placeholder", "placeholder_b"]
@@ -0,0 +1,48 @@
+import asyncio
+
+import httpx
+
+from herding_llamas.herder.node_clients import NodeClients
+
+
+class MockClients(NodeClients):
+    def __init__(self, handler):
+        super().__init__()
+        self.handler = handler
+
+    def _create(self, conf):
+        return httpx.AsyncClient(
+            base_url=conf["base_url"], transport=httpx.MockTransport(self.handler)
+        )
+
+
+def test_rebuilt_client_lets_requests_in_flight_finish():
+    async def run():
+        release = asyncio.Event()
+        timeouts = []
+
+        async def handler(request):
+            timeouts.append(request.extensions["timeout"])
+            if request.url.path == "/slow":
+                await release.wait()
+            return httpx.Response(200, json={"path": request.url.path})
+
+        clients = MockClients(handler)
+        conf = {"base_url": "http://node", "API_KEY_NAME": "KEY", "connect_timeout": 2}
+        slow = asyncio.create_task(clients.request("node", conf, "GET", "/slow"))
+        await asyncio.sleep(0.01)
+        old = clients.clients["node"][1]
+
+        # a config change replaces the client, the old one stays open meanwhile
+        changed = {**conf, "read_timeout": 30}
+        response = await clients.request("node", changed, "GET", "/fast", timeout=5.0)
+        assert response.json() == {"path": "/fast"}
+        assert clients.clients["node"][1] is not old and not old.is_closed
+
+        release.set()
+        assert (await slow).json() == {"path": "/slow"}
+        assert old.is_closed and clients.retired == set()
+        # a per-call timeout keeps the configured connect timeout
+        assert timeouts[1] == {"connect": 2, "read": 5.0, "write": 5.0, "pool": 5.0}
+
+    asyncio.run(run())
@@ -0,0 +1,34 @@
+import pytest
+
+pytest.importorskip("torch")
+
+
+def test_prefix_cache_reuses_shared_prompt_start(tiny_llama):
+    llama = tiny_llama(prefix_cache={"min_tokens": 8})
+    plain = tiny_llama(prefix_cache={"max_memory_gb": 0})
+    system = "abc: defghij abc: "
+    param = {"max_new_tokens": 5, "stop_words": []}
+    for user_text in ["hij", "dd", "bead"]:
+        request = {"infer_input": system + user_text, "param": param}
+        cached = llama.infer_one(dict(request))
+        assert cached["response"] == plain.infer_one(dict(request))["response"]
+    assert cached["prefix_tokens_reused"] == len(system)
+
+    stats = llama.resident_stats()[0]["prefix_cache"]
+    assert stats["entries"] == 1
+    assert stats["hits"] == 2  # the first request only marks the prefix as shared
+    assert stats["tokens_reused"] == 2 * len(system)
+
+
+def test_prefix_cache_budget_counts_in_the_model_pool(tiny_llama):
+    llama = tiny_llama(model_pool={"max_models": 3})
+    _model_bytes = llama.model_bytes["placeholder"]
+    # two models fit, but not with a prefix cache of a model's size each
+    llama.conf["model_pool"]["max_memory_gb"] = 2.5 * _model_bytes / 1024**3
+    llama.conf["prefix_cache"]["max_memory_gb"] = _model_bytes / 1024**3
+    llama.load_model("placeholder_b")
+    assert list(llama.models) == ["placeholder_b"]
+
+    llama.conf["prefix_cache"]["max_memory_gb"] = 0
+    llama.load_model("placeholder")
+    assert list(llama.models) == ["placeholder_b", "placeholder"]
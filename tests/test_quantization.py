@@ -0,0 +1,55 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from herding_llamas.llama.model import ResidentModel
+
+
+def test_cpu_int8_loader_serves_placeholder(tmp_path, tiny_llama):
+    from herding_llamas.llama.loaders.load_cpu_int8 import load_cpu_int8
+
+    llama = tiny_llama()
+    llama.tokenizer.save_pretrained(tmp_path)
+    llama.model.save_pretrained(tmp_path)
+
+    llama.conf["cpu"] = {"num_threads": 2}
+    llama.conf["models"]["placeholder_cpu_int8"] = {"path": str(tmp_path)}
+    resident = ResidentModel("placeholder_cpu_int8", llama.conf)
+    _num_threads = torch.get_num_threads()
+    try:
+        load_cpu_int8(resident, "placeholder_cpu_int8")
+        assert torch.get_num_threads() == 2
+    finally:
+        torch.set_num_threads(_num_threads)
+    _quantized = torch.ao.nn.quantized.dynamic.Linear
+    assert isinstance(resident.model.lm_head, _quantized)
+    # GPT-2 keeps its attention and MLP weights in Conv1D layers
+    assert isinstance(resident.model.transformer.h[0].attn.c_attn, _quantized)
+    assert isinstance(resident.model.transformer.h[0].mlp.c_proj, _quantized)
+
+    llama.models["placeholder_cpu_int8"] = resident
+    response = llama.infer_one(
+        {
+            "infer_input": "abc",
+            "param": {"max_new_tokens": 4},
+            "model_key": "placeholder_cpu_int8",
+        }
+    )
+    assert response["model_name"] == "placeholder_cpu_int8"
+    assert response["output_tokens"] > response["input_tokens"]
+    assert response["tokens_per_second"] > 0
+
+
+def test_conv1d_layers_become_linear_with_the_same_output(tiny_llama):
+    from transformers.pytorch_utils import Conv1D
+
+    from herding_llamas.llama.loaders.load_cpu_int8 import conv1d_to_linear
+
+    model = tiny_llama().model
+    input_ids = torch.tensor([[1, 2, 3, 4]])
+    converted = conv1d_to_linear(copy.deepcopy(model))
+    assert not any(isinstance(m, Conv1D) for m in converted.modules())
+    with torch.no_grad():
+        torch.testing.assert_close(converted(input_ids).logits, model(input_ids).logits)
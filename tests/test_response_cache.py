@@ -0,0 +1,70 @@
+import json
+import time
+
+import pytest
+
+from herding_llamas.herder.response_cache import ResponseCache
+
+
+def test_hit_for_any_candidate_model():
+    cache = ResponseCache()
+    cache.put("model_b", "prompt", {"temperature": 0.1}, {"response": "42"})
+
+    assert cache.get(["model_a", "model_b"], "prompt", {"temperature": 0.1}) == {
+        "response": "42"
+    }
+    assert cache.get(["model_b"], "prompt", {"temperature": 0.2}) is None
+    assert cache.cache_stats()["hit_ratio"] == 0.5
+
+
+def test_lru_eviction_by_size_and_ttl():
+    cache = ResponseCache(max_bytes=60)
+    cache.put("model", "first", None, {"response": "x" * 10})
+    cache.put("model", "second", None, {"response": "x" * 10})
+    cache.get(["model"], "first", None)  # first is now most recently used
+    cache.put("model", "third", None, {"response": "x" * 10})
+
+    assert cache.get(["model"], "second", None) is None
+    assert cache.get(["model"], "first", None) is not None
+    assert cache.bytes <= 60 and cache.stats["evictions"] == 1
+
+    cache.ttl_seconds = -1
+    cache.put("model", "stale", None, {"response": "old"})
+    assert cache.get(["model"], "stale", None) is None
+
+
+def test_written_behind_and_reloaded(tmp_path):
+    pytest.importorskip("sqlalchemy")
+    from herding_llamas.herder.database import Database
+
+    database = Database(f"sqlite:///{tmp_path / 'herder.sqlite'}")
+    cache = ResponseCache(database=database)
+    cache.put("model", "prompt", None, {"response": "42"})
+    cache.ttl_seconds = -1
+    cache.put("model", "stale", None, {"response": "old"})
+    cache.close()
+
+    reloaded = ResponseCache(database=database)
+    assert reloaded.get(["model"], "prompt", None) == {"response": "42"}
+    assert reloaded.get(["model"], "stale", None) is None
+    assert reloaded.cache_stats()["entries"] == 1
+    reloaded.close()
+
+
+def test_evicted_and_expired_rows_are_deleted(tmp_path):
+    pytest.importorskip("sqlalchemy")
+    from herding_llamas.herder.database import Database, ResponseCacheEntry
+
+    database = Database(f"sqlite:///{tmp_path / 'herder.sqlite'}")
+    cache = ResponseCache(database=database, max_bytes=60)
+    cache.put("model", "first", None, {"response": "x" * 10})
+    cache.put("model", "second", None, {"response": "x" * 10})
+    cache.put("model", "third", None, {"response": "x" * 10})  # evicts first
+    cache.ttl_seconds = -1
+    cache.put("model", "second", None, {"response": "old"})
+    assert cache.get(["model"], "second", None) is None  # expired
+    cache.close()
+
+    with database.Session() as session:
+        rows = session.query(ResponseCacheEntry.response_json).all()
+    assert [json.loads(row.response_json) for row in rows] == [{"response": "x" * 10}]
@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("httpx")
+
+from benchmarks.simulate import node_models, run_virtual, simulate
+from herding_llamas.herder import llm_queue
+from herding_llamas.herder.database import Database, Inference
+
+
+def calls(count, seconds, node_key="node_a", prompt_key="p"):
+    return [
+        {
+            "node_key": node_key,
+            "prompt_key": prompt_key,
+            "user_key": f"user_{i % 3}",
+            "input_tokens": 10,
+            "output_tokens": 50,
+            "elapsed_seconds": seconds,
+        }
+        for i in range(count)
+    ]
+
+
+def test_virtual_clock_skips_waiting():
+    async def sleep_an_hour():
+        await asyncio.sleep(3600)
+        return llm_queue.time.monotonic()
+
+    _start = time.monotonic()
+    assert run_virtual(sleep_an_hour()) == pytest.approx(3600)
+    assert time.monotonic() - _start < 5
+    assert llm_queue.time is time  # restored
+
+
+def test_more_nodes_shorten_the_queue():
+    recorded = calls(20, seconds=6.0)
+    models = node_models(recorded)
+    one, three = [
+        run_virtual(simulate(models, recorded, nodes, rate_per_minute=20, minutes=30))
+        for nodes in [1, 3]
+    ]
+    # 20 requests/min at 6s each: twice what one node can serve
+    assert one["utilization"] > 0.95
+    assert one["queue_length"]["max"] > 100
+    assert three["utilization"] == pytest.approx(2 / 3, abs=0.1)
+    assert three["latency"]["p50"] < one["latency"]["p50"] / 10
+    assert three["requests"] == one["requests"] == three["completed"]
+
+
+def test_least_loaded_is_not_worse_on_nodes_of_different_speeds():
+    recorded = calls(10, seconds=1.0, node_key="fast") + calls(
+        10, seconds=3.0, node_key="slow"
+    )
+    models = node_models(recorded)
+    first_free, least_loaded = [
+        run_virtual(
+            simulate(models, recorded, 2, policy, rate_per_minute=70, minutes=30)
+        )
+        for policy in ["first_free", "least_loaded"]
+    ]
+    # the fast node alone cannot keep up: the slow one must take work
+    assert least_loaded["completed"] == least_loaded["requests"]
+    assert least_loaded["utilization"] > 0.7
+    assert least_loaded["queue_length"]["mean"] < 2 * first_free["queue_length"]["mean"]
+    assert least_loaded["latency"]["p95"] <= first_free["latency"]["p95"] * 1.1
+    assert least_loaded["latency"]["mean"] <= first_free["latency"]["mean"] * 1.1
+
+
+def test_deadlines_reject_what_cannot_finish():
+    recorded = calls(20, seconds=6.0)
+    result = run_virtual(
+        simulate(
+            node_models(recorded),
+            recorded,
+            1,
+            rate_per_minute=20,
+            minutes=30,
+            timeout=30,
+        )
+    )
+    assert result["rejected"] + result["timed_out"] > result["requests"] / 3
+    assert result["latency"]["p99"] <= 30
+
+
+def test_node_calls_are_read_without_cache_hits(tmp_path):
+    database = Database(f"sqlite:///{tmp_path / 'herder.sqlite'}")
+    session = database.get_session()
+    for node_key, cache_hit in [("a", False), ("b", False), ("a", True)]:
+        session.add(
+            Inference(
+                node_key=node_key,
+                prompt_key="p",
+                elapsed_seconds=2.0,
+                output_tokens=10,
+                cache_hit=cache_hit,
+            )
+        )
+    session.commit()
+    recorded = database.list_node_calls()
+    assert sorted(call["node_key"] for call in recorded) == ["a", "b"]
+    assert len(node_models(recorded)) == 2
+    assert len(node_models(recorded, node_key="b")) == 1
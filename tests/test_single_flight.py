@@ -0,0 +1,51 @@
+import asyncio
+
+from herding_llamas.herder.single_flight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    async def run():
+        single_flight = SingleFlight()
+        calls = []
+
+        async def func():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        results = await asyncio.gather(
+            *[single_flight.do("key", func) for _ in range(3)]
+        )
+        assert len(calls) == 1
+        assert [shared for _result, shared in results] == [False, True, True]
+        assert single_flight.calls == {}
+
+        await single_flight.do("key", func)  # done calls are not reused
+        assert len(calls) == 2
+
+    asyncio.run(run())
+
+
+def test_call_is_cancelled_only_when_all_callers_gave_up():
+    async def run():
+        single_flight = SingleFlight()
+        finished = []
+
+        async def func():
+            await asyncio.sleep(0.05)
+            finished.append(1)
+
+        first = asyncio.create_task(single_flight.do("key", func))
+        second = asyncio.create_task(single_flight.do("key", func))
+        await asyncio.sleep(0)
+        first.cancel()
+        await second
+        assert finished == [1]
+
+        impatient = asyncio.create_task(single_flight.do("key", func))
+        await asyncio.sleep(0)
+        impatient.cancel()
+        await asyncio.sleep(0.1)
+        assert finished == [1]
+
+    asyncio.run(run())
@@ -0,0 +1,29 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from herding_llamas.llama.model import StopWords
+
+
+def test_stop_words_flag_each_row_separately():
+    stop_words = StopWords([torch.tensor([3, 4]), torch.tensor([7])], "cpu")
+    input_ids = torch.tensor([[1, 3, 4], [3, 4, 1], [5, 6, 7], [4, 3, 4]])
+    assert stop_words.matches(input_ids).tolist() == [True, False, True, True]
+    # rows shorter than the longest stop sequence
+    assert stop_words.matches(torch.tensor([[7], [4]])).tolist() == [True, False]
+    assert not StopWords([], "cpu").matches(input_ids).any()
+
+
+def test_generation_stops_at_stop_word_per_row(tiny_llama):
+    llama = tiny_llama()
+    inputs = ["abc", "hij ab"]
+    param = {"max_new_tokens": 6, "stop_words": []}
+    free = llama.infer_batch([{"infer_input": x, "param": param} for x in inputs])
+    # stop on the first letter the first request generates on its own
+    stop_word = free[0]["response"].replace(" ", "")[len(inputs[0])]
+    param = {"max_new_tokens": 6, "stop_words": [stop_word]}
+    stopped = llama.infer_batch([{"infer_input": x, "param": param} for x in inputs])
+    assert stopped[0]["output_tokens"] < free[0]["output_tokens"]
+    for infer_input, response in zip(inputs, stopped):
+        single = llama.infer_one({"infer_input": infer_input, "param": param})
+        assert response["response"] == single["response"]
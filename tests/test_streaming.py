@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip("torch")
+
+
+def test_closing_a_stream_stops_generation(tiny_llama):
+    llama = tiny_llama()
+    resident = llama.resident(None)
+    lengths = []
+    _generate = resident.model.generate
+
+    def generate(**kwargs):
+        output = _generate(**kwargs)
+        lengths.append(output.shape[1])
+        return output
+
+    resident.model.generate = generate
+    param = {"max_new_tokens": 1000, "min_length": 1000}
+    chunks = llama.infer_stream({"infer_input": "abc", "param": param})
+    assert "token" in next(chunks)
+    chunks.close()
+    assert lengths and lengths[0] < 1000
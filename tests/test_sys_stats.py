@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+pytest.importorskip("psutil")
+pytest.importorskip("xmltodict")
+
+from herding_llamas.llama.sys_stats import SystemStats, TelemetryHistory
+
+
+def placeholder_stats(**kwargs):
+    system_stats = SystemStats(**kwargs)
+    system_stats.gpu_source = "placeholder"  # nvidia_example.xml
+    return system_stats
+
+
+def test_placeholder_gpu_info():
+    gpu_info = placeholder_stats().get_gpu_info()
+    assert len(gpu_info) == 1
+    assert gpu_info[0]["total"] == 11.0
+    assert gpu_info[0]["gpu_name"].endswith("(placeholder!)")
+
+
+def test_multi_gpu_xml():
+    gpu = (
+        "<gpu><product_name>GPU {}</product_name><fb_memory_usage>"
+        "<total>2048 MiB</total><used>512 MiB</used><free>1536 MiB</free>"
+        "</fb_memory_usage><utilization><gpu_util>{} %</gpu_util></utilization>"
+        "</gpu>"
+    )
+    xml = (
+        "<nvidia_smi_log><attached_gpus>2</attached_gpus>"
+        f"{gpu.format(0, 10)}{gpu.format(1, 90)}</nvidia_smi_log>"
+    )
+    gpu_info = placeholder_stats().parse_gpu_xml(xml)
+    assert [g["gpu_name"] for g in gpu_info] == ["GPU 0", "GPU 1"]
+    assert [g["gpu_utilization"] for g in gpu_info] == [10.0, 90.0]
+    assert gpu_info[1]["gpu_pct_used"] == 25.0
+
+
+def test_sampler_keeps_a_bounded_history():
+    system_stats = placeholder_stats(
+        interval_seconds=0.01, history_size=3, node_stats=lambda: {"queued": 2}
+    )
+    system_stats.start()
+    try:
+        while system_stats.telemetry.count < 3:
+            time.sleep(0.01)
+        time.sleep(0.05)
+    finally:
+        system_stats.stop()
+    assert system_stats.telemetry.count == 3
+    history = system_stats.history(minutes=1, points=1)
+    assert history["series"]["gpu_memory_used"] == [9.1]
+    assert history["series"]["queued"] == [2.0]
+    # endpoints get the latest sample without waiting for the CPU measurement
+    _start = time.time()
+    assert system_stats.collect_system_stats()["gpu_info"][0]["total"] == 11.0
+    assert time.time() - _start < 0.1
+
+
+def test_sampler_survives_a_failing_sample():
+    calls = []
+
+    def node_stats():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RuntimeError("node stats unavailable")
+        return {"queued": 1}
+
+    system_stats = placeholder_stats(interval_seconds=0.01, node_stats=node_stats)
+    system_stats.start()
+    try:
+        _deadline = time.time() + 5
+        while system_stats.telemetry.count < 2 and time.time() < _deadline:
+            time.sleep(0.01)
+    finally:
+        system_stats.stop()
+    assert system_stats.telemetry.count >= 2
+
+
+def test_telemetry_window_averages_buckets_and_wraps_around():
+    telemetry = TelemetryHistory(size=4)
+    for t in range(6):  # the first two samples are overwritten
+        telemetry.append(100.0 + t, {"cpu_utilization": t, "queued": None})
+    window = telemetry.window(seconds=6, points=3, now=106.0)
+    assert window["time"] == [101.0, 103.0, 105.0]
+    assert window["series"]["cpu_utilization"] == [None, 2.5, 4.5]
+    assert window["series"]["queued"] == [None, None, None]
@@ -0,0 +1,12 @@
+import pytest
+
+pytest.importorskip("torch")
+
+
+def test_responses_break_down_their_latency(tiny_llama):
+    llama = tiny_llama()
+    response = llama.infer({"infer_input": "hij ab", "param": {"max_new_tokens": 4}})
+    timings = response["timings"]
+    assert set(timings) == {"batch_wait", "tokenize", "generate", "decode"}
+    assert all(seconds >= 0 for seconds in timings.values())
+    assert timings["generate"] <= response["elapsed_seconds"]